@@ -0,0 +1,139 @@
+"""
+asyncio serving mode with dynamic micro-batching, same /recommend contract as server.py:
+
+    python async_server.py --max_batch_size 32 --max_wait_ms 2
+
+concurrent requests are collected for up to max_wait_ms (or until max_batch_size of them arrive),
+features for the whole batch are built and scored with a single model.predict on a worker thread.
+/metrics reports achieved batch sizes, queueing time and result cache counters
+"""
+import argparse
+import asyncio
+
+from aiohttp import web
+
+from lib.artifacts import load_artifacts
+from lib.batching import MicroBatcher
+from lib.cache import CachedRecommender, LRUCache
+from lib.client_state import ClientStateStore
+from lib.config import TrainConfig
+from lib.hardcode import TOP_ITEMS
+from lib.logger import configure_logger
+from lib.recommender import load_recommender
+
+logger = configure_logger(logger_name='async_server', log_dir='')
+
+
+def safe_batch_fn(recommender):
+    def batch_fn(queries: list) -> list:
+        try:
+            return recommender.recommend_batch(queries)
+        except Exception:
+            # one broken query should not take down the whole batch, the batch is retried query by query
+            logger.exception('batch failed, recommending one by one')
+
+        recs = []
+        for query in queries:
+            try:
+                recs.append(recommender.recommend(query))
+            except Exception:
+                logger.exception('query failed')
+                recs.append(TOP_ITEMS)
+
+        return recs
+
+    return batch_fn
+
+
+async def ready(request: web.Request) -> web.Response:
+    return web.Response(text='OK')
+
+
+async def recommend(request: web.Request) -> web.Response:
+    try:
+        query = await request.json()
+        recs = await request.app['batcher'].submit(query)
+    except asyncio.QueueFull:
+        return web.json_response({'recommended_products': TOP_ITEMS}, status=503)
+    except Exception:
+        logger.exception('query failed')
+        recs = TOP_ITEMS
+
+    return web.json_response({'recommended_products': recs})
+
+
+async def metrics(request: web.Request) -> web.Response:
+    return web.json_response({
+        **request.app['batcher'].stats.to_dict(),
+        'cache': request.app['cache'].stats(),
+    })
+
+
+async def reload(request: web.Request) -> web.Response:
+    """
+    reloads artifacts, cached results of the previous version are dropped (the server is a single process)
+    """
+    app = request.app
+    loop = asyncio.get_event_loop()
+    artifacts = await loop.run_in_executor(None, load_artifacts, app['config'].artifacts_dir)
+    if artifacts.version != app['recommender'].model_version:
+        recommender = await loop.run_in_executor(None, load_recommender, artifacts, app['client_state_store'])
+        app['recommender'].reload(recommender, artifacts.version)
+        logger.info(f'reloaded artifacts version: {artifacts.version}')
+
+    return web.json_response({'version': app['recommender'].model_version})
+
+
+def create_app(args) -> web.Application:
+    logger.info('starting to load all stuff')
+    config = TrainConfig.from_json(args.config_path)
+    artifacts = load_artifacts(config.artifacts_dir)
+    cache = LRUCache(max_bytes=int(args.cache_size_mb * 2 ** 20), ttl=args.cache_ttl)
+    client_state_store = ClientStateStore(args.client_states) if args.client_states else None
+    recommender = CachedRecommender(load_recommender(artifacts, client_state_store), artifacts.version, cache)
+
+    app = web.Application()
+    app['config'] = config
+    app['cache'] = cache
+    app['client_state_store'] = client_state_store
+    app['recommender'] = recommender
+    app['batcher'] = MicroBatcher(
+        safe_batch_fn(recommender),
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        max_queue_size=args.max_queue_size,
+        num_threads=args.threads,
+    )
+
+    async def start_batcher(app):
+        await app['batcher'].start()
+
+    async def stop_batcher(app):
+        await app['batcher'].stop()
+
+    app.on_startup.append(start_batcher)
+    app.on_cleanup.append(stop_batcher)
+    app.router.add_get('/ready', ready)
+    app.router.add_post('/recommend', recommend)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_post('/reload', reload)
+
+    logger.info(f'ready! artifacts version: {artifacts.version}')
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config_path', default='configs/config.json')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=2)
+    parser.add_argument('--max_queue_size', type=int, default=1024)
+    parser.add_argument('--threads', type=int, default=1, help='threads running batches')
+    parser.add_argument('--cache_size_mb', type=float, default=0, help='result cache size, 0 - no cache')
+    parser.add_argument('--cache_ttl', type=float, default=300)
+    parser.add_argument('--client_states', type=int, default=0, help='clients with incremental history aggregates')
+    args = parser.parse_args()
+
+    web.run_app(create_app(args), host=args.host, port=args.port)
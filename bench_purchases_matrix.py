@@ -0,0 +1,68 @@
+"""
+builds user x item purchases matrix of train records with the old builder (per-user coo rows + vstack)
+and with create_sparse_purchases_matrix, reports build time and peak memory of both:
+
+    python bench_purchases_matrix.py -c configs/config.json [--decay]
+
+peak memory is measured with tracemalloc (numpy arrays are tracked too) and doesn't include the records
+"""
+import argparse
+import time
+import tracemalloc
+from collections import Counter
+
+import pandas as pd
+from scipy.sparse import vstack
+
+from lib.config import TrainConfig
+from lib.i2i_model import ProductIdMap, create_sparse_purchases_matrix, create_sparse_row_from_counter, \
+    create_sparse_row_from_record
+from lib.train_utils import read_clients_purchases
+
+
+def vstack_purchases_matrix(purchases: list, product_id_map: ProductIdMap, decay: bool = False):
+    rows = []
+    for record in purchases:
+        if decay:
+            if any(transaction['products'] for transaction in record['transaction_history']):
+                rows.append(create_sparse_row_from_record(record, product_id_map))
+            continue
+        product_counts = Counter(product_id_map.to_ids([
+            product['product_id']
+            for transaction in record['transaction_history']
+            for product in transaction['products']
+        ]).tolist())
+        if product_counts:
+            rows.append(create_sparse_row_from_counter(len(product_id_map), product_counts))
+
+    return vstack(rows).tocsr()
+
+
+def measure(fn, *args, **kwargs) -> tuple:
+    tracemalloc.start()
+    start = time.time()
+    result = fn(*args, **kwargs)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config_path', default='configs/config.json')
+    parser.add_argument('--decay', action='store_true')
+    args = parser.parse_args()
+
+    config = TrainConfig.from_json(args.config_path)
+    records, _ = read_clients_purchases(config.client_purchases_file, config.train_start, config.train_end)
+    product_id_map = ProductIdMap(pd.read_csv(config.products_file)['product_id'].values)
+
+    new, new_time, new_peak = measure(create_sparse_purchases_matrix, records, product_id_map, args.decay)
+    old, old_time, old_peak = measure(vstack_purchases_matrix, records, product_id_map, args.decay)
+    matrix_mb = (new.data.nbytes + new.indices.nbytes + new.indptr.nbytes) / 2 ** 20
+
+    print(f'{len(records)} clients, matrix {new.shape}, nnz {new.nnz}, csr size {matrix_mb:.1f}MB')
+    print(f'vstack:  {old_time:.2f}s, peak {old_peak / 2 ** 20:.1f}MB')
+    print(f'direct:  {new_time:.2f}s, peak {new_peak / 2 ** 20:.1f}MB')
+    print(f'equal: {(old != new).nnz == 0}')
@@ -0,0 +1,156 @@
+"""
+starts the production server (gunicorn.conf.py) with different numbers of workers and reports per-worker memory
+and aggregate throughput:
+
+    python bench_server.py --workers 1 2 4 8 --clients 16 --duration 20
+
+queries are replayed in a loop, so the result cache of the server is off unless --cache_size_mb is given
+(a separate run with the cache shows hits of repeated queries, not the cost of recommend).
+memory is read from /proc after the load phase: rss counts shared pages in every process,
+pss splits them between processes, so sum of pss is the real footprint of the pool
+"""
+import argparse
+import json
+import os
+import subprocess
+import threading
+import time
+
+import requests
+
+
+def read_queries(fp: str) -> list:
+    with open(fp, 'r') as f:
+        return [json.loads(line.split('\t')[0]) for line in f]
+
+
+def wait_ready(url: str, timeout: float = 120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f'{url}/ready', timeout=1).status_code == 200:
+                return
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f'{url} is not ready after {timeout}s')
+
+
+def worker_pids(master_pid: int) -> list:
+    with open(f'/proc/{master_pid}/task/{master_pid}/children', 'r') as f:
+        return [int(pid) for pid in f.read().split()]
+
+
+def memory_kb(pid: int) -> dict:
+    memory = {}
+    with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+        for line in f:
+            name, value = line.split(':', 1)
+            if name in ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty'):
+                memory[name.lower()] = int(value.split()[0])
+
+    return memory
+
+
+def run_load(url: str, queries: list, clients: int, duration: float) -> dict:
+    counts = {'ok': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client(offset: int):
+        session = requests.Session()
+        ok, errors = 0, 0
+        i = offset
+        while time.time() < deadline:
+            try:
+                resp = session.post(f'{url}/recommend', json=queries[i % len(queries)], timeout=5)
+                if resp.status_code == 200:
+                    ok += 1
+                else:
+                    errors += 1
+            except requests.exceptions.RequestException:
+                errors += 1
+            i += 1
+        with lock:
+            counts['ok'] += ok
+            counts['errors'] += errors
+
+    start = time.time()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    return {
+        'requests': counts['ok'],
+        'errors': counts['errors'],
+        'rps': round(counts['ok'] / elapsed, 1),
+    }
+
+
+def bench(args, workers: int, queries: list) -> dict:
+    url = f'http://127.0.0.1:{args.port}'
+    env = dict(
+        os.environ,
+        WORKERS=str(workers),
+        THREADS=str(args.threads),
+        BIND=f'127.0.0.1:{args.port}',
+        CONFIG_PATH=args.config_path,
+        CACHE_SIZE_MB=str(args.cache_size_mb),
+    )
+    proc = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', 'server:app'], env=env)
+    try:
+        wait_ready(url)
+        run_load(url, queries, args.clients, args.warmup)
+        load = run_load(url, queries, args.clients, args.duration)
+        workers_memory = [memory_kb(pid) for pid in worker_pids(proc.pid)]
+        master_memory = memory_kb(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    return {
+        'workers': workers,
+        'threads': args.threads,
+        'clients': args.clients,
+        'cache_size_mb': args.cache_size_mb,
+        **load,
+        'master_rss_kb': master_memory['rss'],
+        'worker_rss_kb': [memory['rss'] for memory in workers_memory],
+        'worker_pss_kb': [memory['pss'] for memory in workers_memory],
+        'worker_private_kb': [memory['private_clean'] + memory['private_dirty'] for memory in workers_memory],
+        'total_pss_kb': master_memory['pss'] + sum(memory['pss'] for memory in workers_memory),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config_path', default='configs/config.json')
+    parser.add_argument('--queries', default='data/check_queries.tsv')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--cache_size_mb', type=float, default=0, help='result cache of the server, 0 - no cache')
+    args = parser.parse_args()
+
+    queries = read_queries(args.queries)
+    results = []
+    for workers in args.workers:
+        result = bench(args, workers, queries)
+        print(json.dumps(result))
+        results.append(result)
+
+    base_rps = max(results[0]['rps'] / results[0]['workers'], 1e-9)
+    for result in results:
+        print(
+            f"workers={result['workers']:<3} rps={result['rps']:<8} "
+            f"scaling={result['rps'] / base_rps / result['workers']:.2f} "
+            f"avg worker rss={sum(result['worker_rss_kb']) // len(result['worker_rss_kb']) // 1024}MB "
+            f"avg worker private={sum(result['worker_private_kb']) // len(result['worker_private_kb']) // 1024}MB "
+            f"total pss={result['total_pss_kb'] // 1024}MB"
+        )
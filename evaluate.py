@@ -0,0 +1,80 @@
+"""
+offline MAP@30 (+ recall, ndcg and hit rate @30) of recommenders on a range of clients of clients_purchases.tsv,
+in process, without the server:
+
+    python evaluate.py -c configs/config.json --start 0 --end 100000 --jobs 8 \
+        [--artifacts_dir artifacts other_artifacts] [--dot] [--output results.json]
+
+every artifacts dir (artifacts_dir of the config by default) is loaded once, clients are decoded once
+and evaluated by all recommenders in the same forked workers. --dot adds the candidates of every
+recommender ranked by client_product_dot only. the range is the test clients of the config by default
+"""
+import argparse
+import json
+import os
+import time
+
+from lib.artifacts import load_artifacts
+from lib.config import TrainConfig
+from lib.evaluation import EvaluationData, evaluate
+from lib.logger import configure_logger
+from lib.metrics import METRICS
+from lib.recommender import DotProductRecommender, load_recommender
+
+logger = configure_logger(logger_name='evaluate', log_dir='logs')
+
+
+def load_recommenders(artifacts_dirs: list, dot: bool = False) -> dict:
+    recommenders = {}
+    for artifacts_dir in artifacts_dirs:
+        artifacts = load_artifacts(artifacts_dir)
+        name = os.path.basename(os.path.normpath(artifacts_dir))
+        if name in recommenders:
+            name = artifacts_dir
+        recommenders[name] = load_recommender(artifacts)
+        logger.info(f'loaded {name}, artifacts version: {artifacts.version}')
+        if dot:
+            recommenders[f'{name}:dot'] = DotProductRecommender(recommenders[name])
+
+    return recommenders
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config_path', default='configs/config.json')
+    parser.add_argument('--artifacts_dir', nargs='+', default=None)
+    parser.add_argument('--clients_file', default='./data/clients.csv')
+    parser.add_argument('--start', type=int, default=None)
+    parser.add_argument('--end', type=int, default=None)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--dot', action='store_true')
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    config = TrainConfig.from_json(args.config_path)
+    recommenders = load_recommenders(args.artifacts_dir or [config.artifacts_dir], args.dot)
+
+    start = time.time()
+    data = EvaluationData.from_clients_purchases(
+        config.client_purchases_file,
+        config.test_start if args.start is None else args.start,
+        config.test_end if args.end is None else args.end,
+        args.clients_file if os.path.exists(args.clients_file) else None,
+        args.jobs,
+    )
+    logger.info(f'decoded {len(data)} clients with test transactions in {time.time() - start:.1f}s')
+
+    start = time.time()
+    results = evaluate(recommenders, data, args.jobs, args.batch_size)
+    seconds = time.time() - start
+    logger.info(f'evaluated in {seconds:.1f}s ({len(data) * len(recommenders) / max(seconds, 1e-9):.0f} clients/s)')
+
+    for name, result in results.items():
+        metrics = ', '.join(f'{metric}@30: {result.mean(metric):.5f}' for metric in METRICS)
+        stages = ', '.join(f'{stage} {ms:.2f}' for stage, ms in result.to_dict()['ms_per_client'].items())
+        logger.info(f'[{name}] {metrics}, clients: {len(result)}, ms per client: {stages}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'seconds': seconds, 'results': [result.to_dict() for result in results.values()]}, f, indent=4)
@@ -0,0 +1,30 @@
+"""
+production serving: gunicorn -c gunicorn.conf.py server:app
+
+the app (artifacts, models) is loaded once in the master process (preload_app) and workers are forked from it.
+numpy arrays are memory-mapped from the artifacts directory and gc.freeze() moves everything loaded so far
+to the permanent generation, so workers don't write to those pages and they stay shared between processes.
+
+WORKERS (default: number of cores), THREADS (default: 1), BIND (default: 0.0.0.0:8000), TIMEOUT (default: 30)
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('THREADS', 1))
+timeout = int(os.environ.get('TIMEOUT', 30))
+preload_app = True
+
+# config is executed before the app is preloaded: no gc in master while loading and forking,
+# otherwise collections rewrite gc headers of loaded objects (see gc.freeze docs)
+gc.disable()
+
+
+def when_ready(server):
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+ARTIFACTS_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+
+
+class Artifacts:
+    """
+    versioned directory with everything the server needs:
+     - manifest.json: format version, content hash, dtype/shape of every array and copied files
+     - <name>.npy for every array (embeddings, product features, id vocabularies),
+       opened with np.load(mmap_mode='r'), so worker processes on one box share a single
+       page cache copy instead of holding private heap copies
+     - model files (catboost, implicit) copied as is
+    `artifact_dir` is the version directory itself (see save_artifacts), not the symlink to the current one
+    """
+
+    def __init__(self, artifact_dir: Path, manifest: dict, arrays: dict):
+        self.artifact_dir = artifact_dir
+        self.manifest = manifest
+        self.arrays = arrays
+
+    @property
+    def version(self) -> str:
+        return self.manifest['content_hash']
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.artifact_dir, self.manifest['files'][name])
+
+
+def versions_dir(artifact_dir: Path) -> str:
+    return f'{os.path.normpath(artifact_dir)}.versions'
+
+
+def save_artifacts(artifact_dir: Path, arrays: dict, files: dict = None, keep_versions: int = 2) -> dict:
+    """
+    arrays: name -> np.array (no object dtype), files: name -> path of a file to copy
+
+    files of a loaded version are never rewritten: np.save into a file that a running process has mapped
+    truncates it and the process dies with SIGBUS on the next read. every export is written to a new
+    directory <artifact_dir>.versions/<content_hash>, and `artifact_dir` is a symlink switched to it
+    with os.replace, so processes keep their mappings of the old inodes and reload when they see the new target.
+    the last `keep_versions` versions are kept, a directory left from an older layout is moved there first
+    """
+    versions = versions_dir(artifact_dir)
+    os.makedirs(versions, exist_ok=True)
+    tmp_dir = os.path.join(versions, f'tmp-{os.getpid()}-{time.time_ns()}')
+    os.makedirs(tmp_dir)
+
+    content_hash = hashlib.sha1()
+    manifest = {'version': ARTIFACTS_VERSION, 'arrays': {}, 'files': {}}
+    for name, array in sorted(arrays.items()):
+        array = np.ascontiguousarray(array)
+        file_name = f'{name}.npy'
+        np.save(os.path.join(tmp_dir, file_name), array, allow_pickle=False)
+        manifest['arrays'][name] = {'file': file_name, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        content_hash.update(name.encode())
+        content_hash.update(array.tobytes())
+
+    for name, fp in sorted((files or {}).items()):
+        file_name = os.path.basename(fp)
+        shutil.copyfile(fp, os.path.join(tmp_dir, file_name))
+        manifest['files'][name] = file_name
+        content_hash.update(name.encode())
+        with open(fp, 'rb') as f:
+            content_hash.update(f.read())
+
+    manifest['content_hash'] = content_hash.hexdigest()
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    version_dir = os.path.join(versions, manifest['content_hash'])
+    if os.path.exists(version_dir):
+        # same content, maybe the one being served
+        shutil.rmtree(tmp_dir)
+    else:
+        os.rename(tmp_dir, version_dir)
+    switch_version(artifact_dir, version_dir)
+    remove_old_versions(artifact_dir, keep_versions)
+
+    return manifest
+
+
+def switch_version(artifact_dir: Path, version_dir: Path):
+    artifact_dir = os.path.normpath(artifact_dir)
+    if os.path.isdir(artifact_dir) and not os.path.islink(artifact_dir):
+        # a plain directory of the older layout, renaming keeps mappings of its files valid
+        os.rename(artifact_dir, os.path.join(versions_dir(artifact_dir), f'old-{time.time_ns()}'))
+    link = f'{artifact_dir}.tmp-{os.getpid()}'
+    os.symlink(os.path.relpath(version_dir, os.path.dirname(artifact_dir) or '.'), link)
+    os.replace(link, artifact_dir)
+
+
+def remove_old_versions(artifact_dir: Path, keep_versions: int):
+    """
+    files of removed versions stay readable by processes that have them mapped
+    """
+    current = os.path.realpath(artifact_dir)
+    versions = versions_dir(artifact_dir)
+    old = [
+        os.path.join(versions, name)
+        for name in os.listdir(versions)
+        if not name.startswith('tmp-') and os.path.realpath(os.path.join(versions, name)) != current
+    ]
+    old.sort(key=os.path.getmtime, reverse=True)
+    for version_dir in old[max(keep_versions - 1, 0):]:
+        shutil.rmtree(version_dir, ignore_errors=True)
+
+
+def load_artifacts(artifact_dir: Path, mmap_mode: str = 'r') -> Artifacts:
+    # the version the symlink points to now, files of a loaded version don't change
+    artifact_dir = os.path.realpath(artifact_dir)
+    with open(os.path.join(artifact_dir, MANIFEST_FILE), 'r') as f:
+        manifest = json.load(f)
+
+    if manifest['version'] != ARTIFACTS_VERSION:
+        raise ValueError(f'artifacts version {manifest["version"]}, expected {ARTIFACTS_VERSION}')
+
+    arrays = {}
+    for name, meta in manifest['arrays'].items():
+        array = np.load(os.path.join(artifact_dir, meta['file']), mmap_mode=mmap_mode, allow_pickle=False)
+        if array.dtype.str != meta['dtype'] or list(array.shape) != meta['shape']:
+            raise ValueError(f'artifact {name} does not match manifest')
+        arrays[name] = array
+
+    return Artifacts(artifact_dir, manifest, arrays)
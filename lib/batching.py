@@ -0,0 +1,127 @@
+import asyncio
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+
+class BatchStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batch_sizes = Counter()
+        self.queue_wait_sum = 0.
+        self.batch_time_sum = 0.
+
+    def add_batch(self, size: int, queue_wait: float, batch_time: float):
+        self.requests += size
+        self.batches += 1
+        self.batch_sizes[size] += 1
+        self.queue_wait_sum += queue_wait
+        self.batch_time_sum += batch_time
+
+    def to_dict(self) -> dict:
+        return {
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'batches': self.batches,
+            'avg_batch_size': self.requests / self.batches if self.batches else 0,
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+            'avg_queue_wait_ms': 1000 * self.queue_wait_sum / self.requests if self.requests else 0,
+            'avg_batch_time_ms': 1000 * self.batch_time_sum / self.batches if self.batches else 0,
+        }
+
+
+class MicroBatcher:
+    """
+    collects concurrent requests into batches: a batch is closed `max_wait` seconds after its first request arrived
+    or when it has `max_batch_size` requests, then `batch_fn(items) -> results` runs on a worker thread
+    and results are fanned out to the waiting requests.
+    while a batch is being processed the next one accumulates, so under load batches grow by themselves.
+    `submit` raises asyncio.QueueFull if more than `max_queue_size` requests are waiting
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable,
+        max_batch_size: int = 32,
+        max_wait: float = 0.002,
+        max_queue_size: int = 1024,
+        num_threads: int = 1,
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.num_threads = num_threads
+        self.stats = BatchStats()
+        self._queue = None
+        self._batch_ready = None
+        self._executor = None
+        self._tasks = []
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._batch_ready = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        self._tasks = [asyncio.ensure_future(self._run()) for _ in range(self.num_threads)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, item):
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self._queue.put_nowait((item, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.stats.rejected += 1
+            raise
+        if self._queue.qsize() >= self.max_batch_size - 1:
+            self._batch_ready.set()
+
+        return await future
+
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        # window starts when the first request arrived, so requests queued while
+        # the previous batch was running don't wait again
+        timeout = batch[0][2] + self.max_wait - time.perf_counter()
+        if timeout > 0 and self._queue.qsize() < self.max_batch_size - 1:
+            self._batch_ready.clear()
+            try:
+                # waiting on event, not on queue.get: cancelling it can't lose a request
+                await asyncio.wait_for(self._batch_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._collect()
+            items = [item for item, _, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self._executor, self.batch_fn, items)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                end = time.perf_counter()
+                self.stats.add_batch(len(batch), sum(start - queued for _, _, queued in batch), end - start)
+
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,136 @@
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def history_fingerprint(user_transactions: dict, model_version: str = '') -> str:
+    """
+    cheap key of a request: client, age/gender (model features) and (datetime, store, sum, size) of every
+    transaction instead of full product lists - a transaction with the same header is the same transaction.
+    transactions are kept in request order: last store (and the favorite store tie-break) follow it
+    """
+    transactions = [
+        (tr['datetime'], tr.get('store_id'), tr.get('purchase_sum'), len(tr.get('products', [])))
+        for tr in user_transactions.get('transaction_history', [])
+    ]
+    key = (
+        model_version,
+        user_transactions.get('client_id'),
+        user_transactions.get('age'),
+        user_transactions.get('gender'),
+        transactions,
+    )
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+
+def recommendations_size(recs: list) -> int:
+    return sys.getsizeof(recs) + sum(sys.getsizeof(product_id) for product_id in recs)
+
+
+class LRUCache:
+    """
+    thread-safe LRU with ttl, bounded by approximate size of stored values in bytes (`size_fn`),
+    least recently used entries are evicted until the new one fits
+    """
+
+    def __init__(self, max_bytes: int = 64 * 2 ** 20, ttl: float = 300, size_fn=recommendations_size):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_fn = size_fn
+        self.entries = OrderedDict()  # key -> (value, size, expires_at)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value):
+        size = self.size_fn(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            while self.bytes + size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+            self.entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.bytes += size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key: str):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0,
+        }
+
+
+class CachedRecommender:
+    """
+    caches `recommend` results of a recommender by history fingerprint + model version,
+    `reload` swaps the recommender and drops everything computed by the old one
+    """
+
+    def __init__(self, recommender, model_version: str, cache: LRUCache):
+        # one attribute, so a concurrent reload can't pair results of one model with version of another
+        self.state = (recommender, model_version)
+        self.cache = cache
+
+    @property
+    def model_version(self) -> str:
+        return self.state[1]
+
+    def reload(self, recommender, model_version: str):
+        self.state = (recommender, model_version)
+        self.cache.clear()
+
+    def recommend(self, user_transactions: dict, limit: int = 30) -> list:
+        return self.recommend_batch([user_transactions], limit)[0]
+
+    def recommend_batch(self, users_transactions: list, limit: int = 30) -> list:
+        recommender, model_version = self.state
+        keys = [f'{history_fingerprint(user, model_version)}:{limit}' for user in users_transactions]
+        recs = [self.cache.get(key) for key in keys]
+        missed = [i for i, user_recs in enumerate(recs) if user_recs is None]
+        if missed:
+            computed = recommender.recommend_batch([users_transactions[i] for i in missed], limit)
+            for i, user_recs in zip(missed, computed):
+                self.cache.put(keys[i], user_recs)
+                recs[i] = user_recs
+
+        return recs
@@ -0,0 +1,224 @@
+import copy
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from lib.transaction_store import ClientView
+
+
+def transaction_headers(client: ClientView, transactions: np.array) -> list:
+    """
+    digest of every client's transaction at `transactions` positions: (seconds since test_start, store, sum,
+    number of lines) + product ids and quantities of its lines, so a stored state is reused only for
+    the same transactions, not for other ones with the same header
+    """
+    sizes = client.transaction_sizes
+    starts = (np.cumsum(sizes) - sizes).tolist()
+    sizes = sizes.tolist()
+    products = client.products()
+    quantities = client.quantities.astype(np.float64)
+    headers = []
+    for i, header in zip(transactions.tolist(), zip(
+            client.seconds[transactions].tolist(),
+            client.store_ids()[transactions].tolist(),
+            client.purchase_sums[transactions].tolist(),
+            client.transaction_sizes[transactions].tolist(),
+    )):
+        lines = slice(starts[i], starts[i] + sizes[i])
+        digest = hashlib.blake2b(repr(header).encode(), digest_size=16)
+        digest.update('\0'.join(products[lines].tolist()).encode())
+        digest.update(quantities[lines].tobytes())
+        headers.append(digest.digest())
+
+    return headers
+
+
+class ClientState:
+    """
+    running aggregates of client history in datetime order, everything `create_client_features` needs
+    that depends only on history (not on models):
+     - per transaction: count, purchase sums, store counts, hash of transaction digests (transaction_headers)
+     - per (client, product), aligned with sorted `products`: quantity sum, purchase lines count,
+       first/last transaction id and age
+    `extend` adds transactions that are later than all added ones in time proportional to their size
+    """
+
+    def __init__(self):
+        self.n_transactions = 0
+        self.psum_sum = 0
+        self.store_counts = Counter()
+        self.headers_hash = hashlib.blake2b(digest_size=16)
+        # purchase lines: tid of the last line and ages of the first and the last ones
+        self.max_tid = 0
+        self.first_line_age = None
+        self.last_line_age = None
+        self.products = np.array([], dtype=str)
+        self.count = np.array([], dtype=np.int64)
+        self.tr_count = np.array([], dtype=np.int64)
+        self.first_tid = np.array([], dtype=np.int64)
+        self.last_tid = np.array([], dtype=np.int64)
+        self.first_age = np.array([], dtype=np.int64)
+        self.last_age = np.array([], dtype=np.int64)
+
+    @classmethod
+    def from_view(cls, client: ClientView):
+        state = cls()
+        state.extend(client, client.datetime_order())
+        return state
+
+    def copy(self):
+        # arrays are never modified in place, only replaced
+        state = copy.copy(self)
+        state.store_counts = Counter(self.store_counts)
+        state.headers_hash = self.headers_hash.copy()
+        return state
+
+    def is_prefix_of(self, headers: list) -> bool:
+        """
+        headers - transaction_headers of a history in datetime order
+        """
+        if len(headers) < self.n_transactions:
+            return False
+        headers_hash = hashlib.blake2b(digest_size=16)
+        for header in headers[:self.n_transactions]:
+            headers_hash.update(header)
+
+        return headers_hash.digest() == self.headers_hash.digest()
+
+    def favorite_store(self, store_ids: list) -> str:
+        # same tie break as Counter(store_ids).most_common(1): first store in request order
+        top = max(self.store_counts.values())
+        return next(store_id for store_id in store_ids if self.store_counts[store_id] == top)
+
+    def extend(self, client: ClientView, transactions: np.array, headers: list = None):
+        """
+        client's transactions at `transactions` positions, in datetime order and not earlier than already added ones
+        """
+        for header in headers if headers is not None else transaction_headers(client, transactions):
+            self.headers_hash.update(header)
+        for purchase_sum in client.purchase_sums[transactions].tolist():
+            self.psum_sum += purchase_sum
+        self.store_counts.update(client.store_ids()[transactions].tolist())
+
+        # purchase lines of the transactions, in the same order
+        sizes = client.transaction_sizes
+        starts = (np.cumsum(sizes) - sizes)[transactions]
+        sizes = sizes[transactions]
+        lines = np.arange(sizes.sum()) + np.repeat(starts - (np.cumsum(sizes) - sizes), sizes)
+        self.add_lines(
+            client.products()[lines],
+            client.quantities[lines].astype(np.float64),
+            sizes,
+            client.days[transactions].astype(np.int64),
+        )
+
+    def add_lines(self, product_ids: np.array, quantities: np.array, transaction_sizes: np.array, ages: np.array):
+        """
+        purchase lines of the next transactions (sizes and ages per transaction)
+        """
+        transaction_ids = np.repeat(
+            np.arange(self.n_transactions + 1, self.n_transactions + len(transaction_sizes) + 1),
+            transaction_sizes,
+        )
+        transaction_ages = np.repeat(ages, transaction_sizes)
+        self.n_transactions += len(transaction_sizes)
+        if not len(product_ids):
+            return
+
+        self.max_tid = transaction_ids[-1]
+        self.last_line_age = transaction_ages[-1]
+        if self.first_line_age is None:
+            self.first_line_age = transaction_ages[0]
+
+        # group new lines by product, stable sort keeps lines of each product in purchase order
+        products, inverse = np.unique(product_ids, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(np.bincount(inverse))[:-1]])
+        tr_count = np.bincount(inverse)
+        last_tid = np.maximum.reduceat(transaction_ids[order], starts)
+        first_tid = np.minimum.reduceat(transaction_ids[order], starts)
+        last_age = np.minimum.reduceat(transaction_ages[order], starts)
+        first_age = np.maximum.reduceat(transaction_ages[order], starts)
+
+        if not len(self.products):
+            self.products = products
+            # bincount adds quantities in purchase order, the same way as python's sum does
+            self.count = np.bincount(inverse, weights=quantities).astype(quantities.dtype)
+            self.tr_count = tr_count
+            self.first_tid, self.last_tid = first_tid, last_tid
+            self.first_age, self.last_age = first_age, last_age
+            return
+
+        merged_products = np.union1d(self.products, products)
+        old_rows = np.searchsorted(merged_products, self.products)
+        new_rows = np.searchsorted(merged_products, products)
+
+        def merge(old_values, new_values, fn, fill):
+            values = np.full(len(merged_products), fill, dtype=np.result_type(old_values, new_values))
+            values[old_rows] = old_values
+            values[new_rows] = fn(values[new_rows], new_values)
+            return values
+
+        int_max, int_min = np.iinfo(np.int64).max, np.iinfo(np.int64).min
+        self.tr_count = merge(self.tr_count, tr_count, np.add, 0)
+        self.first_tid = merge(self.first_tid, first_tid, np.minimum, int_max)
+        self.last_tid = merge(self.last_tid, last_tid, np.maximum, 0)
+        self.first_age = merge(self.first_age, first_age, np.maximum, int_min)
+        self.last_age = merge(self.last_age, last_age, np.minimum, int_max)
+        count = np.zeros(len(merged_products), dtype=np.result_type(self.count, quantities))
+        count[old_rows] = self.count
+        # line by line in purchase order, so float quantity sums match a full recomputation exactly
+        np.add.at(count, new_rows[inverse], quantities)
+        self.count = count
+        self.products = merged_products
+
+
+class ClientStateStore:
+    """
+    LRU of client states by client_id. if a request's history extends the stored one
+    (the same transactions + later ones), only new transactions are aggregated,
+    otherwise the state is rebuilt from the whole history
+    """
+
+    def __init__(self, max_clients: int = 100000):
+        self.max_clients = max_clients
+        self.states = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, client: ClientView) -> ClientState:
+        client_id = client.client_id
+        transactions = client.datetime_order()
+        headers = transaction_headers(client, transactions)
+        with self.lock:
+            state = self.states.get(client_id)
+
+        hit = state is not None and state.is_prefix_of(headers)
+        if hit:
+            if len(transactions) > state.n_transactions:
+                # copy, the stored state may be used by another thread right now
+                n = state.n_transactions
+                state = state.copy()
+                state.extend(client, transactions[n:], headers[n:])
+        else:
+            state = ClientState()
+            state.extend(client, transactions, headers)
+
+        with self.lock:
+            # counters are shared by server threads, += is not atomic
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.states[client_id] = state
+            self.states.move_to_end(client_id)
+            while len(self.states) > self.max_clients:
+                self.states.popitem(last=False)
+
+        return state
+
+    def stats(self) -> dict:
+        return {'clients': len(self.states), 'hits': self.hits, 'misses': self.misses}
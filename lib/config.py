@@ -60,6 +60,9 @@ class TrainConfig(Config):
         test_end: int,
         implicit: dict,
         catboost: dict,
+        artifacts_dir: str = 'artifacts',
+        transaction_store_dir: str = None,
+        n_jobs: int = 1,
     ):
         self.data_dir = data_dir
         self.log_dir = log_dir
@@ -71,6 +74,11 @@ class TrainConfig(Config):
         self.client_purchases_file = os.path.join(data_dir, client_purchases_file)
         self.products_enriched_file = os.path.join(data_dir, products_enriched_file)
         self.product_store_stats_file = os.path.join(data_dir, product_store_stats_file)
+        self.artifacts_dir = os.path.join(data_dir, artifacts_dir)
+        # columnar copy of client_purchases_file (reformat_data.py --store_dir), used instead of it if set
+        self.transaction_store_dir = os.path.join(data_dir, transaction_store_dir) if transaction_store_dir else None
+        # processes for reading records and creating features
+        self.n_jobs = n_jobs
 
         self.train_start = train_start
         self.train_end = train_end
@@ -0,0 +1,152 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from lib.metrics import METRICS, recommendation_metrics
+from lib.train_utils import read_clients_purchases
+from lib.utils import fork_map, timed
+
+K = 30
+
+
+class EvaluationData:
+    """
+    queries decoded once for all evaluated recommenders (forked workers share them):
+    train history of a client as a /recommend request (+ age and gender, if clients are given)
+    and product ids of its next transaction. clients without test transactions are skipped
+    """
+
+    def __init__(self, queries: list, gt_items: list):
+        self.queries = queries
+        self.gt_items = gt_items
+
+    def __len__(self):
+        return len(self.queries)
+
+    @classmethod
+    def from_records(cls, train_records: list, test_records: list, clients: pd.DataFrame = None):
+        demography = {}
+        if clients is not None:
+            demography = clients.set_index('client_id')[['age', 'gender']].to_dict('index')
+
+        queries = []
+        gt_items = []
+        for train_record, test_record in zip(train_records, test_records):
+            if not test_record['transaction_history']:
+                continue
+            query = dict(train_record)
+            query.update(demography.get(train_record['client_id'], {}))
+            queries.append(query)
+            gt_items.append([p['product_id'] for p in test_record['transaction_history'][0]['products']])
+
+        return cls(queries, gt_items)
+
+    @classmethod
+    def from_clients_purchases(
+            cls,
+            fp: Path,
+            start: int,
+            end: int,
+            clients_fp: Path = None,
+            n_jobs: int = 1,
+    ):
+        train_records, test_records = read_clients_purchases(fp, start, end, n_jobs)
+        clients = pd.read_csv(clients_fp) if clients_fp else None
+        return cls.from_records(train_records, test_records, clients)
+
+    @classmethod
+    def from_check_queries(cls, fp: Path):
+        # check_queries.tsv: request json \t {"product_ids": [...]} of the next transaction
+        queries = []
+        gt_items = []
+        with open(fp, 'r') as f:
+            for line in f:
+                query, next_transaction = line.strip().split('\t')
+                queries.append(json.loads(query))
+                gt_items.append(json.loads(next_transaction)['product_ids'])
+
+        return cls(queries, gt_items)
+
+
+class EvaluationResult:
+    """
+    {metric: value of every client in data order} of lib.metrics.METRICS + seconds of stages summed over workers:
+    `recommend` (the whole recommend_batch), stages of the recommender (features, predict, ...) and `metric`
+    """
+
+    def __init__(self, name: str, metrics: dict, timings: dict, k: int = K):
+        self.name = name
+        self.metrics = metrics
+        self.timings = timings
+        self.k = k
+
+    def __len__(self):
+        return len(self.metrics['map'])
+
+    def mean(self, metric: str) -> float:
+        return float(self.metrics[metric].mean()) if len(self) else 0.
+
+    @property
+    def map(self) -> float:
+        return self.mean('map')
+
+    def to_dict(self) -> dict:
+        clients = max(len(self), 1)
+        result = {'name': self.name, 'clients': len(self)}
+        result.update({f'{metric}@{self.k}': self.mean(metric) for metric in METRICS})
+        result['ms_per_client'] = {stage: 1000 * seconds / clients for stage, seconds in self.timings.items()}
+        return result
+
+
+def _evaluate_range(evaluation: tuple, bounds: tuple) -> dict:
+    recommenders, data, batch_size, k = evaluation
+    start, end = bounds
+    results = {}
+    for name, recommender in recommenders.items():
+        metrics = {metric: [] for metric in METRICS}
+        timings = {}
+        for batch_start in range(start, end, batch_size):
+            batch_end = min(batch_start + batch_size, end)
+            with timed(timings, 'recommend'):
+                recommendations = recommender.recommend_batch(data.queries[batch_start:batch_end], k, timings=timings)
+            with timed(timings, 'metric'):
+                batch_metrics = recommendation_metrics(data.gt_items[batch_start:batch_end], recommendations, k)
+            for metric, values in batch_metrics.items():
+                metrics[metric].append(values)
+        results[name] = metrics, timings
+
+    return results
+
+
+def evaluate(
+        recommenders: dict,
+        data: EvaluationData,
+        n_jobs: int = 1,
+        batch_size: int = 256,
+        k: int = K,
+) -> dict:
+    """
+    {name: EvaluationResult} of {name: recommender} (anything with recommend_batch(queries, limit, timings)).
+    clients are cut into consecutive shards, every shard is evaluated by all recommenders in the same
+    forked worker, scores are concatenated in shard order, so the result doesn't depend on n_jobs
+    """
+    # a few shards per worker, so a slow shard doesn't leave the others idle
+    shard_size = max(batch_size, -(-len(data) // (4 * n_jobs)))
+    bounds = [(start, min(start + shard_size, len(data))) for start in range(0, len(data), shard_size)]
+    shards = fork_map(_evaluate_range, (recommenders, data, batch_size, k), bounds, n_jobs)
+
+    results = {}
+    for name in recommenders:
+        timings = {}
+        for shard in shards:
+            for stage, seconds in shard[name][1].items():
+                timings[stage] = timings.get(stage, 0.) + seconds
+        metrics = {
+            metric: np.concatenate([np.zeros(0)] + [values for shard in shards for values in shard[name][0][metric]])
+            for metric in METRICS
+        }
+        results[name] = EvaluationResult(name, metrics, timings, k)
+
+    return results
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from lib.artifacts import ARTIFACTS_VERSION, MANIFEST_FILE, load_artifacts
+
+NUMERIC = 'numeric'
+CATEGORICAL = 'categorical'
+# fixed size of .npy header, so it can be rewritten with the final number of rows
+HEADER_SIZE = 128
+
+
+def npy_header(dtype, length: int) -> bytes:
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (length,)})
+    header = header.ljust(HEADER_SIZE - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class FeatureWriter:
+    """
+    feature frames appended chunk by chunk to a directory of .npy columns, only the current chunk is in memory:
+     - numeric columns as float32
+     - other (string) columns as int32 codes (-1 for None) + <name>.categories.npy with values of codes
+    manifest.json has the artifacts format (load_artifacts opens the columns with mmap)
+    + column kinds in order and number of rows, it is written on `close`
+    """
+
+    def __init__(self, features_dir: Path):
+        self.features_dir = features_dir
+        os.makedirs(features_dir, exist_ok=True)
+        manifest_fp = os.path.join(features_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_fp):
+            os.remove(manifest_fp)
+
+        self.columns = None
+        self.files = {}
+        self.hashes = {}
+        self.categories = {}
+        self.rows = 0
+
+    def _open(self, frame: pd.DataFrame):
+        self.columns = {
+            name: NUMERIC if pd.api.types.is_numeric_dtype(frame[name].dtype) else CATEGORICAL
+            for name in frame.columns
+        }
+        for name, kind in self.columns.items():
+            self.files[name] = open(os.path.join(self.features_dir, f'{name}.npy'), 'wb')
+            self.files[name].write(npy_header(self.dtype(name), 0))
+            self.hashes[name] = hashlib.sha1(name.encode())
+            if kind == CATEGORICAL:
+                self.categories[name] = {}
+
+    def dtype(self, name: str):
+        return np.int32 if self.columns[name] == CATEGORICAL else np.float32
+
+    def append(self, frame: pd.DataFrame):
+        if self.columns is None:
+            self._open(frame)
+        elif list(frame.columns) != list(self.columns):
+            raise ValueError(f'columns of the chunk differ: {list(frame.columns)}')
+
+        for name, kind in self.columns.items():
+            values = frame[name].values
+            if kind == CATEGORICAL:
+                values = self._codes(name, np.asarray(values, dtype=object))
+            data = np.ascontiguousarray(values, dtype=self.dtype(name)).tobytes()
+            self.files[name].write(data)
+            self.hashes[name].update(data)
+        self.rows += len(frame)
+
+    def _codes(self, name: str, values: np.array) -> np.array:
+        codes, uniques = pd.factorize(values)
+        vocabulary = self.categories[name]
+        # chunk codes -> codes of the whole file, the last one is for None (-1)
+        mapping = np.array([vocabulary.setdefault(value, len(vocabulary)) for value in uniques] + [-1], dtype=np.int32)
+        return mapping[codes]
+
+    def close(self) -> dict:
+        manifest = {'version': ARTIFACTS_VERSION, 'arrays': {}, 'files': {}, 'columns': {}, 'rows': self.rows}
+        content_hash = hashlib.sha1()
+        for name, kind in (self.columns or {}).items():
+            f = self.files[name]
+            f.seek(0)
+            f.write(npy_header(self.dtype(name), self.rows))
+            f.close()
+            manifest['arrays'][name] = {
+                'file': f'{name}.npy',
+                'dtype': np.dtype(self.dtype(name)).str,
+                'shape': [self.rows],
+            }
+            manifest['columns'][name] = kind
+            content_hash.update(self.hashes[name].digest())
+
+            if kind == CATEGORICAL:
+                categories = np.array(list(self.categories[name]), dtype=str)
+                np.save(os.path.join(self.features_dir, f'{name}.categories.npy'), categories, allow_pickle=False)
+                manifest['arrays'][f'{name}.categories'] = {
+                    'file': f'{name}.categories.npy',
+                    'dtype': categories.dtype.str,
+                    'shape': list(categories.shape),
+                }
+                content_hash.update(categories.tobytes())
+
+        manifest['content_hash'] = content_hash.hexdigest()
+        with open(os.path.join(self.features_dir, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f, indent=4)
+
+        return manifest
+
+
+def write_features(features_dir: Path, frames) -> dict:
+    writer = FeatureWriter(features_dir)
+    for frame in frames:
+        writer.append(frame)
+    return writer.close()
+
+
+def load_features(features_dir: Path, columns: list = None, mmap_mode: str = 'r') -> pd.DataFrame:
+    """
+    columns of the file (all, or the ones in `columns` that the file has) in file order,
+    categorical columns are decoded back to python strings
+    """
+    artifacts = load_artifacts(features_dir, mmap_mode)
+    selected = [name for name in artifacts.manifest['columns'] if columns is None or name in columns]
+    data = {}
+    for name in selected:
+        values = artifacts.arrays[name]
+        if artifacts.manifest['columns'][name] == CATEGORICAL:
+            # code -1 is the appended None
+            categories = np.append(artifacts.arrays[f'{name}.categories'].astype(object), None)
+            values = categories[values]
+        data[name] = values
+
+    return pd.DataFrame(data, columns=selected)
@@ -1,3 +1,8 @@
+from datetime import datetime
+
+# day 0 of the test period, ages of transactions are counted from it
+test_start = datetime(2019, 3, 2, 0, 0, 0)
+
 MAX_RECS = 30
 
 TOP_ITEMS = [
@@ -1,35 +1,57 @@
 import json
-from itertools import combinations
-from collections import Counter, defaultdict
+from collections import Counter
 from pathlib import Path
 from typing import List
-from datetime import datetime
 
 import numpy as np
-import implicit
-from scipy.sparse import lil_matrix, csr_matrix, coo_matrix, vstack
+from scipy.sparse import csr_matrix, coo_matrix, diags
 
 from lib.config import ImplicitConfig
 from lib.metrics import normalized_average_precision
-
-
-test_start = datetime(2019, 3, 2, 0, 0, 0)
+from lib.transaction_store import TransactionStore
+from lib.utils import fork_map
 
 
 class ProductIdMap:
+    """
+    product_id <-> int id, id is position in `product_ids`.
+    only numpy arrays inside (no dict of python strings): the map can live in memory-mapped artifacts,
+    and lookups in forked workers don't touch refcounts of vocabulary objects, so its pages stay shared
+    """
 
     def __init__(self, product_ids: list):
-        self.id2product = dict(enumerate(product_ids))
-        self.product2id = {v: k for k, v in self.id2product.items()}
+        self.product_ids = np.asarray(product_ids, dtype=str)
+        self.sorter = np.argsort(self.product_ids, kind='stable')
+
+    def to_id(self, product: str) -> int:
+        return int(self.to_ids([product])[0])
+
+    def lookup(self, products) -> np.array:
+        """
+        ids of products, -1 for unknown ones
+        """
+        products = np.asarray(products, dtype=str)
+        if not len(products) or not len(self.product_ids):
+            return np.full(len(products), -1, dtype=np.int64)
+        positions = np.searchsorted(self.product_ids, products, sorter=self.sorter)
+        ids = self.sorter[np.minimum(positions, len(self.sorter) - 1)]
+        ids[self.product_ids[ids] != products] = -1
+
+        return ids
 
-    def to_id(self, product: str):
-        return self.product2id[product]
+    def to_ids(self, products) -> np.array:
+        ids = self.lookup(products)
+        unknown = ids < 0
+        if unknown.any():
+            raise KeyError(str(np.asarray(products, dtype=str)[unknown][0]))
 
-    def to_product(self, id_: int):
-        return self.id2product[id_]
+        return ids
+
+    def to_product(self, id_: int) -> str:
+        return str(self.product_ids[id_])
 
     def __len__(self):
-        return len(self.product2id)
+        return len(self.product_ids)
 
 
 def create_sparse_row(num_products: tuple, indices: list):
@@ -48,56 +70,235 @@ def create_sparse_row_from_counter(num_products: tuple, counter: Counter):
 
 
 def create_sparse_row_from_record(user_record: dict, product_id_map: ProductIdMap):
-    product_counts = defaultdict(int)
-    for transaction in user_record['transaction_history']:
-        age = max(0, (test_start - datetime.fromisoformat(transaction['datetime'])).days)
-        for product in transaction['products']:
-            pid = product_id_map.to_id(product['product_id'])
-            score = (age + 1) ** (-1 / 5)
-            product_counts[pid] += score
+    _, items, weights = create_user_item_weights([user_record], product_id_map)
+    return coo_matrix((weights, (np.zeros_like(items), items)), shape=(1, len(product_id_map)))
+
+
+def create_user_item_weights(user_records: list, product_id_map: ProductIdMap, decay: bool = True) -> tuple:
+    """
+    time-decayed item weights of many users at once (or number of lines with decay=False):
+    (user index, item id, weight) sorted by user and item id, weights of lines are summed in history order
+    """
+    store = TransactionStore.from_records(user_records, product_id_map)
+    return create_user_item_weights_from_store(store, decay)
+
+
+def decay_weights(days: np.array) -> np.array:
+    """
+    (age + 1) ** (-1 / 5) of transactions, age is days before test_start (0 for later ones),
+    python's pow once per distinct age: numpy's one may differ in the last bit
+    """
+    ages, inverse = np.unique(np.maximum(0, days), return_inverse=True)
+    return np.array([(age + 1) ** (-1 / 5) for age in ages.tolist()], dtype=np.float64)[inverse]
 
-    return create_sparse_row_from_counter(len(product_id_map), product_counts)
 
+def create_user_item_weights_from_store(store: TransactionStore, decay: bool = True) -> tuple:
+    """
+    create_user_item_weights of store clients: decay weight (age + 1) ** (-1 / 5) is computed once per distinct age
+    """
+    start, end = store.lines
+    n_items = len(store.products)
+    line_transactions = store.line_transactions()
+    line_weights = np.ones(end - start)
+    if decay:
+        line_weights = decay_weights(store.transaction_days[slice(*store.transactions)])[line_transactions]
 
-def create_sparse_purchases_matrix(purchases: List[dict], product_id_map: ProductIdMap) -> coo_matrix:
-    rows = []
-    for record in purchases:
-        product_counts = Counter([
-            product_id_map.to_id(product['product_id'])
-            for transaction in record['transaction_history']
-            for product in transaction['products']
-        ])
-        if product_counts:
-            rows.append(create_sparse_row_from_counter(len(product_id_map), product_counts))
+    keys = store.transaction_clients()[line_transactions] * n_items + store.product_ids[start:end]
+    keys, inverse = np.unique(keys, return_inverse=True)
+    weights = np.bincount(inverse, weights=line_weights, minlength=len(keys))
 
-    return vstack(rows)
+    return keys // n_items, keys % n_items, weights
+
+
+def create_sparse_purchases_matrix(
+        purchases: List[dict],
+        product_id_map: ProductIdMap,
+        decay: bool = False,
+        chunk_size: int = 2000,
+) -> csr_matrix:
+    """
+    user x item matrix: number of purchase lines (or sum of time-decayed weights, as create_sparse_row_from_record)
+    of every item, users without purchases are skipped.
+    users are converted in chunks, rows come out sorted by user and item, so csr arrays are just concatenated
+    chunk results: peak memory is about two copies of indices + data.
+    `purchases` may be a TransactionStore (with the same products vocabulary), then chunks are built from its columns
+    """
+    from_store = isinstance(purchases, TransactionStore)
+    if from_store and not np.array_equal(purchases.products, product_id_map.product_ids):
+        raise ValueError('transaction store and product id map have different product ids')
+
+    indptr, indices, data = [np.zeros(1, dtype=np.int64)], [np.zeros(0, dtype=np.int32)], [np.zeros(0)]
+    for start in range(0, len(purchases), chunk_size):
+        if from_store:
+            users, items, weights = create_user_item_weights_from_store(
+                purchases.clients(start, start + chunk_size),
+                decay,
+            )
+        else:
+            users, items, weights = create_user_item_weights(
+                purchases[start:start + chunk_size],
+                product_id_map,
+                decay,
+            )
+        row_sizes = np.bincount(users)
+        indptr.append(indptr[-1][-1] + np.cumsum(row_sizes[row_sizes > 0]))
+        indices.append(items.astype(np.int32))
+        data.append(weights)
+
+    indptr = np.concatenate(indptr)
+    return csr_matrix(
+        (np.concatenate(data), np.concatenate(indices), indptr),
+        shape=(len(indptr) - 1, len(product_id_map)),
+    )
+
+
+def create_baskets_matrix(purchases: List[dict], product_id_map: ProductIdMap, decay: bool = False) -> tuple:
+    """
+    basket x item matrix (one row per transaction, value - number of lines of the item in the basket)
+    and weight of every basket: 1 or time decay (age + 1) ** (-1 / 5), as in create_sparse_row_from_record
+    """
+    store = purchases
+    if not isinstance(purchases, TransactionStore):
+        store = TransactionStore.from_records(purchases, product_id_map)
+    start, end = store.lines
+    transaction_start, transaction_end = store.transactions
+    n_baskets = transaction_end - transaction_start
+
+    baskets = coo_matrix(
+        (np.ones(end - start, dtype=np.int32), (store.line_transactions(), store.product_ids[start:end])),
+        shape=(n_baskets, len(product_id_map)),
+    ).tocsr()
+    if decay:
+        basket_weights = decay_weights(store.transaction_days[transaction_start:transaction_end])
+    else:
+        basket_weights = np.ones(n_baskets, dtype=np.int32)
+    return baskets, basket_weights
+
+
+def _chunk_cooccurrence(baskets: tuple, bounds: tuple) -> csr_matrix:
+    baskets, basket_weights = baskets
+    start, end = bounds
+    chunk, weights = baskets[start:end], basket_weights[start:end]
+    # every pair of lines in a basket: m_i * m_j for different items, m_i * (m_i - 1) on the diagonal
+    cooccurrence = chunk.T @ diags(weights, dtype=weights.dtype) @ chunk
+    self_pairs = weights @ chunk
+    return (cooccurrence - diags(self_pairs, dtype=self_pairs.dtype)).tocsr()
+
+
+def prune_top_k(matrix: csr_matrix, k: int) -> csr_matrix:
+    """
+    keeps k largest values of every row (ties - smaller column first)
+    """
+    matrix = matrix.tocoo()
+    order = np.lexsort((matrix.col, -matrix.data, matrix.row))
+    rows = matrix.row[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = order[rank < k]
+    return csr_matrix((matrix.data[keep], (matrix.row[keep], matrix.col[keep])), shape=matrix.shape)
 
 
 def create_i2i_sparse_matrix(
         purchases: List[dict],
-        product_id_map: ProductIdMap
+        product_id_map: ProductIdMap,
+        weighting: str = 'raw',
+        top_k: int = None,
+        chunk_size: int = 100000,
+        n_jobs: int = 1,
 ) -> csr_matrix:
-    mat = lil_matrix((len(product_id_map), len(product_id_map)), dtype=np.int8)
+    """
+    item x item co-occurrence within baskets: baskets.T @ baskets, summed over chunks of `chunk_size` baskets
+    (memory is bounded by a chunk), chunks are processed by `n_jobs` forked processes.
+    weighting:
+     - raw: number of pairs of lines in the same basket (int32)
+     - decayed: every basket pair counts with time decay weight of the basket
+     - normalized: raw / sqrt(baskets with item i * baskets with item j), cosine of item basket vectors
+    top_k: keep only k largest values in every row
+    """
+    if weighting not in ('raw', 'decayed', 'normalized'):
+        raise ValueError(f'unknown weighting: {weighting}')
+
+    baskets, basket_weights = create_baskets_matrix(purchases, product_id_map, decay=weighting == 'decayed')
+    chunks = [(start, min(start + chunk_size, baskets.shape[0])) for start in range(0, baskets.shape[0], chunk_size)]
+    # chunks are summed in order, so float sums don't depend on scheduling
+    chunk_matrices = fork_map(_chunk_cooccurrence, (baskets, basket_weights), chunks, n_jobs, lazy=True)
+    cooccurrence = _sum_matrices(chunk_matrices, len(product_id_map))
+
+    if weighting == 'normalized':
+        norm = np.asarray((baskets > 0).sum(axis=0), dtype=np.float64).ravel()
+        norm = np.divide(1, np.sqrt(norm), out=np.zeros_like(norm), where=norm > 0)
+        cooccurrence = (diags(norm) @ cooccurrence @ diags(norm)).astype(np.float32)
+    cooccurrence.eliminate_zeros()
+    if top_k is not None:
+        cooccurrence = prune_top_k(cooccurrence, top_k)
+
+    return cooccurrence.tocsr()
+
+
+def _sum_matrices(matrices, size: int) -> csr_matrix:
+    total = None
+    for matrix in matrices:
+        total = matrix if total is None else total + matrix
+
+    return total if total is not None else csr_matrix((size, size), dtype=np.int32)
+
+
+class ItemVectors:
+    """
+    item factors as one float32 matrix aligned with `product_id_map`,
+    mask[i] is False for products without a vector (their row is zeros)
+    """
+
+    def __init__(self, vectors: np.array, mask: np.array, product_id_map: ProductIdMap):
+        self.vectors = vectors
+        self.mask = mask
+        self.product_id_map = product_id_map
+
+    @classmethod
+    def from_dict(cls, item_vectors: dict, product_id_map: ProductIdMap):
+        num_factors = len(next(iter(item_vectors.values())))
+        vectors = np.zeros((len(product_id_map), num_factors), dtype=np.float32)
+        mask = np.zeros(len(product_id_map), dtype=bool)
+        ids = product_id_map.to_ids(list(item_vectors))
+        vectors[ids] = list(item_vectors.values())
+        mask[ids] = True
+
+        return cls(vectors, mask, product_id_map)
+
+    def to_arrays(self) -> dict:
+        return {'item_vectors': self.vectors, 'item_vectors_mask': self.mask}
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, product_id_map: ProductIdMap):
+        return cls(arrays['item_vectors'], arrays['item_vectors_mask'], product_id_map)
 
-    for record in purchases:
-        for transaction in record['transaction_history']:
-            product_ids = [
-                product['product_id']
-                for product in transaction['products']
-            ]
-            for product_a, product_b in combinations(product_ids, 2):
-                idx_a, idx_b = product_id_map.to_id(product_a), product_id_map.to_id(product_b)
-                mat[idx_a, idx_b] += 1
-                mat[idx_b, idx_a] += 1
+    def __len__(self):
+        return int(self.mask.sum())
+
+    def client_vector(self, ids: np.array, weights: np.array = None) -> np.array:
+        """
+        mean vector of purchased items (ids with repeats, one per purchase line,
+        or unique ids with number of lines in `weights`), zeros if none has a vector
+        """
+        mask = self.mask[ids]
+        if not mask.any():
+            return np.zeros(self.vectors.shape[1], dtype=np.float64)
+        if weights is None:
+            return self.vectors[ids[mask]].mean(axis=0, dtype=np.float64)
+
+        return np.average(self.vectors[ids[mask]], axis=0, weights=weights[mask].astype(np.float64))
 
-    return mat.tocsr()
+    def client_product_dot(self, client_vector: np.array, ids: np.array) -> np.array:
+        """
+        dot products of client vector with all candidates in one mat-vec, 0 for items without a vector
+        """
+        return np.where(self.mask[ids], self.vectors[ids] @ client_vector, 0)
 
 
-def load_item_vectors(fp: Path):
+def load_item_vectors(fp: Path, product_id_map: ProductIdMap) -> ItemVectors:
     with open(fp, 'r') as f:
         vectors = json.load(f)
 
-    return {k: np.array(v) for k, v in vectors.items()}
+    return ItemVectors.from_dict(vectors, product_id_map)
 
 
 class ImplicitRecommender:
@@ -122,25 +323,123 @@ class ImplicitRecommender:
         return [(self.product_id_map.to_product(rec), score) for rec, score in recs]
 
 
+class ItemNeighbors:
+    """
+    item-item model (implicit CosineRecommender / ItemItemRecommender) exported to a CSR table of
+    top-K neighbors: neighbors of item i are indices[indptr[i]:indptr[i + 1]] with similarity scores.
+    score of a candidate is sum of user's item weights * similarity over user's items,
+    as implicit's recommend computes it, but with numpy only and for many users at once
+    """
+
+    def __init__(self, indptr: np.array, indices: np.array, scores: np.array, product_id_map: ProductIdMap):
+        self.indptr = indptr
+        self.indices = indices
+        self.scores = scores
+        self.product_id_map = product_id_map
+
+    @classmethod
+    def from_similarity(cls, similarity: csr_matrix, product_id_map: ProductIdMap):
+        similarity = csr_matrix(similarity)
+        return cls(
+            similarity.indptr.astype(np.int64),
+            similarity.indices.astype(np.int32),
+            similarity.data.astype(np.float32),
+            product_id_map,
+        )
+
+    @classmethod
+    def from_implicit(cls, recommender: 'ImplicitRecommender'):
+        return cls.from_similarity(recommender.model.similarity, recommender.product_id_map)
+
+    def to_arrays(self) -> dict:
+        return {
+            'item_neighbors.indptr': self.indptr,
+            'item_neighbors.indices': self.indices,
+            'item_neighbors.scores': self.scores,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, product_id_map: ProductIdMap):
+        return cls(
+            arrays['item_neighbors.indptr'],
+            arrays['item_neighbors.indices'],
+            arrays['item_neighbors.scores'],
+            product_id_map,
+        )
+
+    def recommend(self, user_record: dict, filter_seen: bool = False, num_recs: int = 30) -> list:
+        return self.recommend_batch([user_record], filter_seen, num_recs)[0]
+
+    def recommend_batch(self, user_records: list, filter_seen: bool = False, num_recs: int = 30) -> list:
+        """
+        [(product_id, score), ...] by score desc for every user, ties are ordered by item id
+        """
+        store = TransactionStore.from_records(user_records, self.product_id_map)
+        return self.recommend_store(store, filter_seen, num_recs)
+
+    def recommend_store(self, store: TransactionStore, filter_seen: bool = False, num_recs: int = 30) -> list:
+        return self.recommend_weights(len(store), *create_user_item_weights_from_store(store), filter_seen, num_recs)
+
+    def recommend_weights(
+            self,
+            n_users: int,
+            users: np.array,
+            items: np.array,
+            weights: np.array,
+            filter_seen: bool = False,
+            num_recs: int = 30,
+    ) -> list:
+        """
+        recommendations from (user index, item id, weight) of create_user_item_weights
+        """
+        n_items = len(self.product_id_map)
+
+        # gather neighbor rows of all (user, item) pairs into one flat array
+        starts, ends = self.indptr[items], self.indptr[items + 1]
+        lengths = ends - starts
+        positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+        candidate_keys = np.repeat(users, lengths) * n_items + self.indices[positions]
+        contributions = np.repeat(weights, lengths) * self.scores[positions]
+
+        # accumulate by (user, candidate), in the same order as implicit does
+        keys, inverse = np.unique(candidate_keys, return_inverse=True)
+        scores = np.bincount(inverse, weights=contributions)
+        if filter_seen:
+            unseen = ~np.isin(keys, users * n_items + items)
+            keys, scores = keys[unseen], scores[unseen]
+        candidate_users, candidates = keys // n_items, keys % n_items
+
+        order = np.lexsort((candidates, -scores, candidate_users))
+        candidate_users, candidates, scores = candidate_users[order], candidates[order], scores[order]
+        # first num_recs of every user
+        rank = np.arange(len(order)) - np.searchsorted(candidate_users, candidate_users)
+        top = rank < num_recs
+        offsets = np.searchsorted(candidate_users[top], np.arange(n_users + 1)).tolist()
+        products = self.product_id_map.product_ids[candidates[top]].tolist()
+        scores = scores[top].tolist()
+
+        return [list(zip(products[start:end], scores[start:end])) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
 def train_implicit_vectors(
         train_records: list,
         config: ImplicitConfig,
         product_id_map: ProductIdMap
-):
+) -> ItemVectors:
+    import implicit
+
     matrix = create_sparse_purchases_matrix(train_records, product_id_map)
     model = implicit.als.AlternatingLeastSquares(
         factors=config.num_factors,
         iterations=config.epochs
     )
     model.fit(matrix.T)
-    item_vectors = {
-        product_id_map.to_product(i): list(map(float, factor))
-        for i, factor in enumerate(model.item_factors)  # user factors, cuz in implicit its inverted
-    }
-    with open(config.vectors_file, 'w') as f:
-        json.dump(item_vectors, f)
-
-    return item_vectors
+    # user factors, cuz in implicit its inverted
+    return ItemVectors(
+        np.asarray(model.item_factors, dtype=np.float32),
+        np.ones(len(product_id_map), dtype=bool),
+        product_id_map,
+    )
 
 
 def validate(recommender, train_records: list, test_records: list, filter_seen: bool = False):
@@ -1,18 +1,127 @@
-def average_precision(actual, recommended, k=30):
-    ap_sum = 0
-    hits = 0
-    for i in range(k):
-        product_id = recommended[i] if i < len(recommended) else None
-        if product_id in actual:
-            hits += 1
-            ap_sum += hits / (i + 1)
-    return ap_sum / min(len(actual), k)
+import numpy as np
+
+METRICS = ('map', 'recall', 'ndcg', 'hit_rate')
+
+
+def group_order(groups: np.array, scores: np.array, n_groups: int) -> np.array:
+    """
+    rows sorted by group, then by score desc, ties keep row order (np.lexsort((-scores, groups))).
+    rows are sorted by one int64 key: group * rows + position by score, it's faster than lexsort
+    """
+    scores = -np.asarray(scores, dtype=np.float64)
+    if n_groups * max(len(scores), 1) >= 2 ** 63:
+        return np.lexsort((scores, groups))
+    score_order = np.argsort(scores, kind='stable')
+    score_ranks = np.empty(len(score_order), dtype=np.int64)
+    score_ranks[score_order] = np.arange(len(score_order))
+    return np.argsort(groups * len(score_order) + score_ranks)
+
+
+def group_metrics(groups: np.array, scores: np.array, labels: np.array, gt_counts: np.array, k: int = 30) -> dict:
+    """
+    metrics@k of every group in flat arrays, without sorting groups one by one:
+     - groups: int code in [0, len(gt_counts)) of every row (candidate), rows of a group needn't be adjacent
+     - scores: rows of a group are ranked by score desc, ties keep row order
+     - labels: > 0 for relevant candidates
+     - gt_counts: number of relevant items of every group, candidates or not
+    map and recall are normalized by min(gt_count, k) (as MAP@30 of the contest), ndcg by the dcg of
+    min(gt_count, k) hits on top. metrics of groups with gt_count 0 are 0
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    gt_counts = np.asarray(gt_counts, dtype=np.int64)
+    n_groups = len(gt_counts)
+
+    order = group_order(groups, scores, n_groups)
+    sorted_groups = groups[order]
+    ranks = np.arange(1, len(order) + 1) - np.searchsorted(sorted_groups, np.arange(n_groups))[sorted_groups]
+    top = (np.asarray(labels)[order] > 0) & (ranks <= k)
+    hit_groups, hit_ranks = sorted_groups[top], ranks[top]
+    # hits so far at the rank of every hit, hits are sorted by group and rank
+    hit_numbers = np.arange(1, len(hit_groups) + 1) - np.searchsorted(hit_groups, hit_groups)
+
+    hits = np.bincount(hit_groups, minlength=n_groups)
+    precision_sums = np.bincount(hit_groups, weights=hit_numbers / hit_ranks, minlength=n_groups)
+    dcg = np.bincount(hit_groups, weights=1 / np.log2(hit_ranks + 1), minlength=n_groups)
+    denominators = np.minimum(gt_counts, k)
+    ideal_dcg = np.concatenate([[0.], np.cumsum(1 / np.log2(np.arange(2, k + 2)))])[denominators]
+
+    def normalized(values: np.array, norms: np.array) -> np.array:
+        return np.divide(values, norms, out=np.zeros(n_groups), where=denominators > 0)
+
+    return {
+        'map': normalized(precision_sums, denominators),
+        'recall': normalized(hits.astype(np.float64), denominators),
+        'ndcg': normalized(dcg, ideal_dcg),
+        'hit_rate': normalized((hits > 0).astype(np.float64), np.ones(n_groups)),
+    }
+
+
+def ranking_metrics(groups: np.array, scores: np.array, labels: np.array, gt_counts: np.array, k: int = 30) -> dict:
+    """
+    means of group_metrics over groups with relevant items
+    """
+    valid = np.asarray(gt_counts) > 0
+    return {
+        name: float(values[valid].mean()) if valid.any() else 0.
+        for name, values in group_metrics(groups, scores, labels, gt_counts, k).items()
+    }
+
+
+def recommendation_metrics(actual: list, recommended: list, k: int = 30) -> dict:
+    """
+    group_metrics of ranked recommendation lists of users against their lists of actual items
+    """
+    actual = [set(items) for items in actual]
+    lengths = [min(len(recs), k) for recs in recommended]
+    groups = np.repeat(np.arange(len(recommended)), lengths)
+    labels = np.array([
+        product_id in items
+        for items, recs in zip(actual, recommended)
+        for product_id in recs[:k]
+    ], dtype=bool)
+    # the position in the list is the rank
+    scores = -np.arange(len(groups), dtype=np.float64)
+    gt_counts = np.array([len(items) for items in actual], dtype=np.int64)
+
+    return group_metrics(groups, scores, labels, gt_counts, k)
 
 
 def normalized_average_precision(actual, recommended, k=30):
-    actual = set(actual)
-    if len(actual) == 0:
-        return 0.0
+    return float(recommendation_metrics([actual], [recommended], k)['map'][0])
+
+
+class CatBoostRankingMetric:
+    """
+    one of METRICS as a catboost custom eval_metric (CPU only).
+    catboost gives `evaluate` approxes and targets of a whole pool without group ids, so group ids
+    of every pool it is computed on (learn and eval sets) are given here, pools are told apart by size.
+    gt counts of rows are optional, by default it's the number of positive targets of the group
+    """
+
+    def __init__(self, pools: list, metric: str = 'map', k: int = 30):
+        if metric not in METRICS:
+            raise ValueError(f'unknown metric: {metric}, expected one of {METRICS}')
+        self.metric = metric
+        self.k = k
+        self.pools = {}
+        for pool_groups, pool_gt_counts in pools:
+            if len(pool_groups) in self.pools:
+                raise ValueError(f'pools have the same size {len(pool_groups)}, they can not be told apart')
+            _, first_rows, codes = np.unique(np.asarray(pool_groups), return_index=True, return_inverse=True)
+            gt_counts = None if pool_gt_counts is None else np.asarray(pool_gt_counts)[first_rows]
+            self.pools[len(pool_groups)] = codes, gt_counts
+
+    def is_max_optimal(self) -> bool:
+        return True
+
+    def evaluate(self, approxes, target, weight) -> tuple:
+        codes, gt_counts = self.pools[len(target)]
+        labels = np.asarray(target)
+        if gt_counts is None:
+            gt_counts = np.bincount(codes, weights=labels > 0, minlength=codes.max() + 1).astype(np.int64)
+        values = group_metrics(codes, np.asarray(approxes[0]), labels, gt_counts, self.k)[self.metric]
+        valid = gt_counts > 0
+        return float(values[valid].sum()), float(valid.sum())
 
-    ap = average_precision(actual, recommended, k=k)
-    return ap
\ No newline at end of file
+    def get_final_error(self, error: float, weight: float) -> float:
+        return error / weight if weight else 0.
@@ -1,153 +1,184 @@
-from collections import defaultdict
-from itertools import chain, groupby
-from operator import itemgetter
-from datetime import datetime
-
-
 import pandas as pd
 import numpy as np
 
-from lib.i2i_model import ImplicitRecommender
-from lib.product_store_features import ProductStoreStats, get_user_favorite_store, \
-    get_user_last_store
+from lib.client_state import ClientState, ClientStateStore
+from lib.i2i_model import ItemNeighbors, ItemVectors
+from lib.product_aggregates import aggregate_products
+from lib.product_store_features import ProductStoreStats
+from lib.transaction_store import ClientView, TransactionStore
 
-test_start = datetime(2019, 3, 2, 0, 0, 0)
 
+def create_features_from_transactions(
+        users_data: list,
+        item_vectors: ItemVectors,
+        implicit_recommender: ItemNeighbors = None,
+        product_store_stats: ProductStoreStats = None,
+        client_state_store: ClientStateStore = None,
+        batch_size: int = 1000,
+) -> dict:
+    """
+    features of all users, records are normalized into a TransactionStore by `batch_size` users
+    (or `users_data` is a store already)
+    """
+    users_features = []
+    for start in range(0, len(users_data), batch_size):
+        if isinstance(users_data, TransactionStore):
+            store = users_data.clients(start, start + batch_size)
+        else:
+            store = TransactionStore.from_records(users_data[start:start + batch_size], item_vectors.product_id_map)
+        users_features.extend(create_clients_features(
+            store,
+            item_vectors,
+            implicit_recommender,
+            product_store_stats,
+            client_state_store,
+        ))
+
+    return concatenate_features(users_features)
+
+
+def concatenate_features(users_features: list) -> dict:
+    users_features = [user_features for user_features in users_features if user_features]
+    if not users_features:
+        return {}
+
+    return {
+        k: np.concatenate([user_features[k] for user_features in users_features])
+        for k in users_features[0]
+    }
 
-def get_client_product_dot(client_vector: np.array, product: str, product_vectors: dict) -> float:
-    client_product_dot = 0
-    if product in product_vectors:
-        client_product_dot = np.dot(
-            client_vector,
-            product_vectors[product]
-        )
-    return client_product_dot
 
+def create_user_features(
+        user_data: dict,
+        item_vectors: ItemVectors,
+        implicit_recommender: ItemNeighbors = None,
+        product_store_stats: ProductStoreStats = None,
+        client_state_store: ClientStateStore = None,
+) -> dict:
+    store = TransactionStore.from_records([user_data], item_vectors.product_id_map)
+    return create_clients_features(store, item_vectors, implicit_recommender, product_store_stats, client_state_store)[0]
 
-def create_features_from_transactions(
-        users_data: list,
-        product_vectors: dict,
-        implicit_recommender: ImplicitRecommender = None,
+
+def create_clients_features(
+        store: TransactionStore,
+        item_vectors: ItemVectors,
+        implicit_recommender: ItemNeighbors = None,
         product_store_stats: ProductStoreStats = None,
-) -> pd.DataFrame:
+        client_state_store: ClientStateStore = None,
+) -> list:
+    """
+    features of every client of a (request batch) store, implicit candidates of all of them in one pass
+    """
+    implicit_recs = [None] * len(store)
+    if implicit_recommender is not None:
+        implicit_recs = implicit_recommender.recommend_store(store, False, 50)
 
-    features = defaultdict(list)
+    return [
+        create_client_features(client, item_vectors, client_implicit_recs, product_store_stats, client_state_store)
+        for client, client_implicit_recs in zip(store, implicit_recs)
+    ]
 
-    for user_data in users_data:
-        trs = sorted(user_data['transaction_history'], key=lambda x: x['datetime'])
-        if not trs:
-            continue
-        if implicit_recommender is not None:
-            recs = dict(implicit_recommender.recommend(user_data, False, 50))
-
-        client_id = user_data['client_id']
-        favorite_store, last_store = get_user_favorite_store(user_data), get_user_last_store(user_data)
-        products = list(chain(*(x['products'] for x in trs)))
-        product_ids = [product['product_id'] for product in products]
-        client_vector = create_client_vector(product_ids, product_vectors)
-        transaction_ids = [
-            i + 1
-            for i, x in enumerate(trs)
-            for _ in range(len(x['products']))
-        ]
-        transaction_ages = [
-            (test_start - datetime.fromisoformat(x['datetime'])).days
-            for x in trs
-            for _ in range(len(x['products']))
+
+def create_client_features(
+        client: ClientView,
+        item_vectors: ItemVectors,
+        implicit_recs: list = None,
+        product_store_stats: ProductStoreStats = None,
+        client_state_store: ClientStateStore = None,
+) -> dict:
+    """
+    candidate rows of one client as dict of np.arrays (empty dict if client has no transactions):
+    all products client bought (sorted by product_id) + unseen implicit candidates.
+    per-product stats of history come from `ClientState` - built from scratch or, with `client_state_store`,
+    updated with transactions added since the previous request of this client.
+    `implicit_recs` - implicit_recommender.recommend(user_data, False, 50)
+    """
+    if not len(client):
+        return {}
+    if client_state_store is not None:
+        state = client_state_store.get(client)
+    else:
+        state = ClientState.from_view(client)
+    if not state.max_tid:
+        raise ValueError(f'no purchases in history of client {client.client_id}')
+    if implicit_recs is not None:
+        recs = dict(implicit_recs)
+
+    client_id = client.client_id
+    store_ids = client.store_ids().tolist()
+    favorite_store = state.favorite_store(store_ids)
+    last_store = store_ids[-1]
+    max_transaction_id = state.max_tid
+    total_transactions = state.n_transactions
+    average_psum = state.psum_sum / total_transactions
+
+    products = state.products.astype(object)
+    ids = item_vectors.product_id_map.to_ids(products)
+    # every purchase line of a product counts in the mean vector
+    client_vector = item_vectors.client_vector(ids, weights=state.tr_count)
+
+    candidates = []
+    if implicit_recs is not None:
+        seen_products = set(products)
+        candidates = [
+            (product_id, score)
+            for product_id, score in recs.items()
+            if product_id not in seen_products
         ]
-        for i, tid in enumerate(transaction_ids):
-            products[i]['tid'] = tid
-            products[i]['tr_age'] = transaction_ages[i]
-
-        total_transactions = len(trs)
-        average_psum = sum([tr['purchase_sum'] for tr in trs]) / total_transactions
-
-        key = itemgetter('product_id')
-        for product, part in groupby(sorted(products, key=key), key=key):
-            part = list(part)
-            # client features (same for all products)
-            features['total_pucrhases'].append(total_transactions)
-            features['average_psum'].append(average_psum)
-            features['client_id'].append(client_id)
-            features['last_transaction_age'].append(transaction_ages[-1])
-            features['first_transaction_age'].append(transaction_ages[0])
-            features['favorite_store_id'].append(favorite_store)
-            features['last_store_id'].append(last_store)
-            features['fav_store_count'].append(product_store_stats.store_cnt(favorite_store))
-            features['last_store_count'].append(product_store_stats.store_cnt(last_store))
-
-            # product dependent featurs
-            product_count = sum([product['quantity'] for product in part])
-            features['product_id'].append(product)
-            features['count'].append(product_count)
-            features['tr_count'].append(len(part))
-            features['p_tr_share'].append(len(part) / max(transaction_ids))
-            features['last_transaction'].append(max([p['tid'] for p in part]) / max(transaction_ids))
-            features['first_transaction'].append(min([p['tid'] for p in part]) / max(transaction_ids))
-            features['last_product_transaction_age'].append(min([p['tr_age'] for p in part]))
-            features['first_product_transaction_age'].append(max([p['tr_age'] for p in part]))
-
-            fav_product_store_share = product_store_stats.product_store_share(product, favorite_store)
-            last_product_store_share = product_store_stats.product_store_share(product, last_store)
-            features['fav_product_store_share'].append(fav_product_store_share)
-            features['last_product_store_share'].append(last_product_store_share)
-            fav_store_product_share = product_store_stats.store_product_share(product, favorite_store)
-            last_store_product_share = product_store_stats.store_product_share(product, last_store)
-            features['fav_store_product_share'].append(fav_store_product_share)
-            features['last_store_product_share'].append(last_store_product_share)
-
-            client_product_dot = get_client_product_dot(
-                client_vector,
-                product,
-                product_vectors
-            )
-            features['client_product_dot'].append(client_product_dot)
-            if implicit_recommender is not None:
-                features['implicit_score'].append(recs.get(product, 0))
-
-        seen_products = set(product_ids)
-
-        if implicit_recommender is not None:
-            common_features = {
-                'total_pucrhases',
-                'average_psum',
-                'client_id',
-                'product_id',
-                'implicit_score',
-                'client_product_dot',
-                'last_transaction_age',
-                'favorite_store_id',
-                'last_store_id',
-                'fav_store_count',
-                'last_store_count',
-            }
-            for product_id, score in recs.items():
-                if product_id not in seen_products:
-                    features['total_pucrhases'].append(total_transactions)
-                    features['average_psum'].append(average_psum)
-                    features['client_id'].append(client_id)
-                    features['product_id'].append(product_id)
-                    features['implicit_score'].append(score)
-                    features['last_transaction_age'].append(transaction_ages[-1])
-                    features['favorite_store_id'].append(favorite_store)
-                    features['last_store_id'].append(last_store)
-                    features['fav_store_count'].append(product_store_stats.store_cnt(favorite_store))
-                    features['last_store_count'].append(product_store_stats.store_cnt(last_store))
-                    client_product_dot = get_client_product_dot(
-                        client_vector,
-                        product_id,
-                        product_vectors
-                    )
-                    features['client_product_dot'].append(client_product_dot)
-                    for k in features:
-                        if k not in common_features:
-                            features[k].append(0)
+    candidate_ids = np.array([product_id for product_id, _ in candidates], dtype=object)
+    n_rows = len(products) + len(candidates)
+
+    def client_feature(value):
+        return np.full(n_rows, value)
+
+    def product_feature(values):
+        # implicit candidates are not in history, so their product stats are zeros
+        values = np.asarray(values)
+        return np.concatenate([values, np.zeros(len(candidates), dtype=values.dtype)])
+
+    product_store_shares, store_product_shares = product_store_stats.store_shares(products, [favorite_store, last_store])
+
+    features = {
+        'total_pucrhases': client_feature(total_transactions),
+        'average_psum': client_feature(average_psum),
+        'client_id': client_feature(client_id).astype(object),
+        'last_transaction_age': client_feature(state.last_line_age),
+        'first_transaction_age': product_feature(np.full(len(products), state.first_line_age)),
+        'favorite_store_id': client_feature(favorite_store).astype(object),
+        'last_store_id': client_feature(last_store).astype(object),
+        'fav_store_count': client_feature(product_store_stats.store_cnt(favorite_store)),
+        'last_store_count': client_feature(product_store_stats.store_cnt(last_store)),
+        'product_id': np.concatenate([products, candidate_ids]),
+        'count': product_feature(state.count),
+        'tr_count': product_feature(state.tr_count),
+        'p_tr_share': product_feature(state.tr_count / max_transaction_id),
+        'last_transaction': product_feature(state.last_tid / max_transaction_id),
+        'first_transaction': product_feature(state.first_tid / max_transaction_id),
+        'last_product_transaction_age': product_feature(state.last_age),
+        'first_product_transaction_age': product_feature(state.first_age),
+        'fav_product_store_share': product_feature(product_store_shares[0]),
+        'last_product_store_share': product_feature(product_store_shares[1]),
+        'fav_store_product_share': product_feature(store_product_shares[0]),
+        'last_store_product_share': product_feature(store_product_shares[1]),
+        'client_product_dot': item_vectors.client_product_dot(
+            client_vector,
+            np.concatenate([ids, item_vectors.product_id_map.to_ids(candidate_ids)]),
+        ),
+    }
+    if implicit_recs is not None:
+        features['implicit_score'] = np.array(
+            [recs.get(product, 0) for product in products] + [score for _, score in candidates],
+            dtype=np.float64,
+        )
 
     return features
 
 
 def create_target_from_transactions(test_users_transactions: list) -> pd.DataFrame:
     # just get items users bought in their first transaction of test period
+    if isinstance(test_users_transactions, TransactionStore):
+        return create_target_from_store(test_users_transactions)
+
     columns = {
         'client_id': [],
         'product_id': [],
@@ -167,21 +198,22 @@ def create_target_from_transactions(test_users_transactions: list) -> pd.DataFra
     return df
 
 
-def create_client_vector(product_ids: list, product_vectors: dict) -> np.array:
-    client_vector = None
-    cnt = 0
-    for product_id in product_ids:
-        if product_id in product_vectors:
-            cnt += 1
-            if client_vector is None:
-                client_vector = np.array(product_vectors[product_id])
-            else:
-                client_vector += product_vectors[product_id]
+def create_target_from_store(store: TransactionStore) -> pd.DataFrame:
+    has_transactions = np.diff(store.client_offsets) > 0
+    first_transactions = store.client_offsets[:-1][has_transactions]
+    starts = store.transaction_offsets[first_transactions]
+    sizes = store.transaction_offsets[first_transactions + 1] - starts
+    lines = np.arange(sizes.sum()) + np.repeat(starts - (np.cumsum(sizes) - sizes), sizes)
 
-    return client_vector / cnt
+    df = pd.DataFrame({
+        'client_id': np.repeat(store.client_ids[has_transactions], sizes).astype(object),
+        'product_id': store.products[store.product_ids[lines]].astype(object),
+    })
+    df['target'] = 1
+    return df
 
 
-def create_product_features_from_users_data(users_data: list) -> pd.DataFrame:
+def create_product_features_from_users_data(users_data: list, n_jobs: int = 1) -> pd.DataFrame:
     """
     differenct product stats & aggregates
     *_dt: statistics on relative date (min_dt=0 -> product was purchased at least once in last train day)
@@ -189,58 +221,9 @@ def create_product_features_from_users_data(users_data: list) -> pd.DataFrame:
     *_p: staticstins on product price (trn_sum_from_iss)
     unique_cliets: number of unique clients purchased product TODO: normalize?
 
-
-
+    one pass of running aggregates (lib/product_aggregates.py), with n_jobs > 1 shards of clients are merged
     """
-    product_stats = defaultdict(lambda: defaultdict(list))
-    total_clients = 0
-    for record in users_data:
-        client_id = record['client_id']
-        total_clients += 1
-        for tr in record['transaction_history']:
-            relative_dt = (test_start - datetime.fromisoformat(tr['datetime'])).days
-            store_id = tr['store_id']
-            for product in tr['products']:
-                product_id = product['product_id']
-                quantity = product['quantity']
-                price = product['price']
-                product_stats[product_id]['dts'].append(relative_dt)
-                product_stats[product_id]['q'].append(quantity)
-                product_stats[product_id]['p'].append(price / quantity if quantity else price)
-                product_stats[product_id]['client_id'].append(client_id)
-                product_stats[product_id]['store_id'].append(store_id)
-                product_stats[product_id]['tr_size'].append(len(tr['products']))
-
-    product_features = defaultdict(list)
-
-    for product_id, features in product_stats.items():
-        product_features['product_id'].append(product_id)
-        #dt
-        product_features['max_dt'].append(max(features['dts']))
-        product_features['min_dt'].append(min(features['dts']))
-        product_features['avg_dt'].append(sum(features['dts']) / len(features['dts']))
-        # quantity
-        product_features['max_q'].append(max(features['q']))
-        product_features['min_q'].append(min(features['q']))
-        product_features['avg_q'].append(sum(features['q']) / len(features['q']))
-        # price
-        product_features['max_p'].append(max(features['p']))
-        product_features['min_p'].append(min(features['p']))
-        product_features['avg_p'].append(sum(features['p']) / len(features['p']))
-        # tr size
-        product_features['max_tr_size'].append(max(features['tr_size']))
-        product_features['min_tr_size'].append(min(features['tr_size']))
-        product_features['avg_tr_size'].append(sum(features['tr_size']) / len(features['tr_size']))
-
-        unique_clients = len(set(features['client_id']))
-        product_features['unique_clients'].append(unique_clients)
-        product_features['unique_clients_n'].append(unique_clients / total_clients)
-        product_features['product_count'].append(len(features['p']))
-
-        unique_stores = len(set(features['store_id']))
-        product_features['unique_stores'].append(unique_stores)
-
-    return pd.DataFrame(product_features)
+    return aggregate_products(users_data, n_jobs).to_frame()
 
 
 def create_gt_items_count_df(target: pd.DataFrame) -> pd.DataFrame:
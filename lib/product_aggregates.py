@@ -0,0 +1,273 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from lib.hardcode import test_start
+from lib.transaction_store import TransactionStore
+from lib.utils import fork_map
+
+# aggregated values of purchase lines: relative date, quantity, price of one item, size of the transaction
+VALUES = ('dt', 'q', 'p', 'tr_size')
+INT_VALUES = ('dt', 'tr_size')
+
+
+class ProductAggregates:
+    """
+    running per-product aggregates of purchase lines: count, min/max/sum of VALUES, number of clients
+    and of stores that bought the product. everything is an array over products (and products x stores
+    for seen stores, with capacity grown geometrically), so memory doesn't grow with the number of lines.
+    lines are added in chunks of whole clients (a client is counted once per product of a chunk),
+    products are numbered in order of the first line, as dict of lists in
+    `create_product_features_from_users_data` did.
+    float sums are accumulated line by line in file order, so averages of one pass are identical to
+    sum(list) / len(list). `merge` of aggregates of consecutive shards is exact for everything but float sums,
+    where the order of additions may change the last bit of avg_q / avg_p
+    """
+
+    def __init__(self):
+        self.product_ids = []
+        self.product_index = {}
+        self.store_index = {}
+        self.total_clients = 0
+        self.count = np.zeros(0, dtype=np.int64)
+        self.clients = np.zeros(0, dtype=np.int64)
+        self.sums = {name: np.zeros(0, dtype=self._dtype(name)) for name in VALUES}
+        self.mins = {name: np.zeros(0, dtype=self._dtype(name)) for name in VALUES}
+        self.maxs = {name: np.zeros(0, dtype=self._dtype(name)) for name in VALUES}
+        self.stores = np.zeros((0, 0), dtype=bool)
+
+    @staticmethod
+    def _dtype(name: str):
+        return np.int64 if name in INT_VALUES else np.float64
+
+    @staticmethod
+    def _limits(name: str) -> tuple:
+        if name in INT_VALUES:
+            return np.iinfo(np.int64).max, np.iinfo(np.int64).min
+        return np.inf, -np.inf
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def _product_rows(self, product_ids: list, first_lines: np.array = None) -> np.array:
+        """
+        rows of products, unknown ones are appended in order of `first_lines`
+        """
+        rows = np.array([self.product_index.get(product_id, -1) for product_id in product_ids], dtype=np.int64)
+        new = np.flatnonzero(rows < 0)
+        if first_lines is not None:
+            new = new[np.argsort(first_lines[new], kind='stable')]
+        for i in new.tolist():
+            rows[i] = len(self.product_ids)
+            self.product_index[product_ids[i]] = rows[i]
+            self.product_ids.append(product_ids[i])
+
+        added = len(self.product_ids) - len(self.count)
+        if added:
+            self.count = np.concatenate([self.count, np.zeros(added, dtype=np.int64)])
+            self.clients = np.concatenate([self.clients, np.zeros(added, dtype=np.int64)])
+            for name in VALUES:
+                low, high = self._limits(name)
+                self.sums[name] = np.concatenate([self.sums[name], np.zeros(added, dtype=self._dtype(name))])
+                self.mins[name] = np.concatenate([self.mins[name], np.full(added, low, dtype=self._dtype(name))])
+                self.maxs[name] = np.concatenate([self.maxs[name], np.full(added, high, dtype=self._dtype(name))])
+            self._reserve_stores(len(self.product_ids), len(self.store_index))
+        return rows
+
+    def _reserve_stores(self, n_products: int, n_stores: int):
+        """
+        products x stores matrix is allocated with spare rows / columns, doubled when they run out,
+        so a chunk with new products or stores doesn't copy the whole matrix every time
+        """
+        rows, columns = self.stores.shape
+        if n_products <= rows and n_stores <= columns:
+            return
+        shape = (
+            rows if n_products <= rows else max(n_products, 2 * rows),
+            columns if n_stores <= columns else max(n_stores, 2 * columns),
+        )
+        stores = np.zeros(shape, dtype=bool)
+        stores[:rows, :columns] = self.stores
+        self.stores = stores
+
+    @property
+    def used_stores(self) -> np.array:
+        return self.stores[:len(self.product_ids), :len(self.store_index)]
+
+    def _store_columns(self, store_ids: list) -> np.array:
+        for store_id in store_ids:
+            self.store_index.setdefault(store_id, len(self.store_index))
+        self._reserve_stores(len(self.product_ids), len(self.store_index))
+        return np.array([self.store_index[store_id] for store_id in store_ids], dtype=np.int64)
+
+    def add_lines(
+            self,
+            n_clients: int,
+            line_clients: np.array,
+            line_products: np.array,
+            product_ids: np.array,
+            line_stores: np.array,
+            store_ids: np.array,
+            values: dict,
+    ):
+        """
+        a chunk of whole clients: line_products / line_stores are indices in product_ids / store_ids,
+        line_clients - index of the client in the chunk, values - VALUES of every line
+        """
+        self.total_clients += n_clients
+        if not len(line_products):
+            return
+
+        codes, first_lines, inverse = np.unique(line_products, return_index=True, return_inverse=True)
+        rows = self._product_rows(np.asarray(product_ids)[codes].tolist(), first_lines)[inverse]
+        store_codes, store_inverse = np.unique(line_stores, return_inverse=True)
+        columns = self._store_columns(np.asarray(store_ids)[store_codes].tolist())[store_inverse]
+        n_products = len(self)
+
+        self.count += np.bincount(rows, minlength=n_products)
+        self.stores[rows, columns] = True
+        # every client once per product
+        pairs = np.unique(line_clients.astype(np.int64) * n_products + rows)
+        self.clients += np.bincount(pairs % n_products, minlength=n_products)
+
+        order = np.argsort(rows, kind='stable')
+        sorted_rows = rows[order]
+        starts = np.flatnonzero(np.concatenate([[True], sorted_rows[1:] != sorted_rows[:-1]]))
+        chunk_rows = sorted_rows[starts]
+        for name in VALUES:
+            line_values = np.asarray(values[name], dtype=self._dtype(name))
+            if name in INT_VALUES:
+                self.sums[name] += np.bincount(rows, weights=line_values, minlength=n_products).astype(np.int64)
+            else:
+                # running sum goes first in its bin, then lines in order: the same additions as sum(list)
+                self.sums[name] = np.bincount(
+                    np.concatenate([np.arange(n_products), rows]),
+                    weights=np.concatenate([self.sums[name], line_values]),
+                    minlength=n_products,
+                )
+            sorted_values = line_values[order]
+            mins, maxs = np.minimum.reduceat(sorted_values, starts), np.maximum.reduceat(sorted_values, starts)
+            self.mins[name][chunk_rows] = np.minimum(self.mins[name][chunk_rows], mins)
+            self.maxs[name][chunk_rows] = np.maximum(self.maxs[name][chunk_rows], maxs)
+
+    def add_records(self, records: list):
+        line_clients = []
+        line_products = []
+        line_stores = []
+        values = {name: [] for name in VALUES}
+        for client_index, record in enumerate(records):
+            for tr in record['transaction_history']:
+                relative_dt = (test_start - datetime.fromisoformat(tr['datetime'])).days
+                size = len(tr['products'])
+                for product in tr['products']:
+                    line_clients.append(client_index)
+                    line_products.append(product['product_id'])
+                    line_stores.append(tr['store_id'])
+                    values['dt'].append(relative_dt)
+                    values['q'].append(product['quantity'])
+                    values['p'].append(product['price'])
+                    values['tr_size'].append(size)
+
+        product_ids, line_products = np.unique(np.array(line_products, dtype=str), return_inverse=True)
+        store_ids, line_stores = np.unique(np.array(line_stores, dtype=str), return_inverse=True)
+        values['p'] = unit_prices(np.array(values['p'], dtype=np.float64), np.array(values['q'], dtype=np.float64))
+        self.add_lines(
+            len(records),
+            np.array(line_clients, dtype=np.int64),
+            line_products,
+            product_ids,
+            line_stores,
+            store_ids,
+            values,
+        )
+
+    def add_store(self, store: TransactionStore):
+        start, end = store.lines
+        transaction_start, _ = store.transactions
+        line_transactions = store.line_transactions()
+        transactions = transaction_start + line_transactions
+        quantities = store.quantities[start:end].astype(np.float64)
+        self.add_lines(
+            len(store),
+            store.transaction_clients()[line_transactions],
+            store.product_ids[start:end],
+            store.products,
+            store.transaction_stores[transactions],
+            store.store_ids,
+            {
+                'dt': store.transaction_days[transactions],
+                'q': quantities,
+                'p': unit_prices(store.prices[start:end].astype(np.float64), quantities),
+                'tr_size': store.transaction_sizes()[line_transactions],
+            },
+        )
+
+    def merge(self, other: 'ProductAggregates'):
+        """
+        adds aggregates of the next clients (a shard after this one)
+        """
+        rows = self._product_rows(other.product_ids)
+        columns = self._store_columns(list(other.store_index))
+        self.total_clients += other.total_clients
+        self.count[rows] += other.count
+        self.clients[rows] += other.clients
+        for name in VALUES:
+            self.sums[name][rows] += other.sums[name]
+            self.mins[name][rows] = np.minimum(self.mins[name][rows], other.mins[name])
+            self.maxs[name][rows] = np.maximum(self.maxs[name][rows], other.maxs[name])
+        for column, other_column in zip(columns.tolist(), other.store_index.values()):
+            self.stores[rows, column] |= other.used_stores[:, other_column]
+
+    def to_frame(self) -> pd.DataFrame:
+        features = {'product_id': np.array(self.product_ids, dtype=object)}
+        for name in VALUES:
+            features[f'max_{name}'] = self.maxs[name]
+            features[f'min_{name}'] = self.mins[name]
+            features[f'avg_{name}'] = self.sums[name] / self.count
+        features['unique_clients'] = self.clients
+        features['unique_clients_n'] = self.clients / self.total_clients
+        features['product_count'] = self.count
+        features['unique_stores'] = self.used_stores.sum(axis=1)
+
+        return pd.DataFrame(features)
+
+
+def unit_prices(prices: np.array, quantities: np.array) -> np.array:
+    # price of one item, the whole price if quantity is 0
+    return np.divide(prices, quantities, out=prices.copy(), where=quantities != 0)
+
+
+def _chunks(users_data, start: int, end: int, batch_size: int):
+    for chunk_start in range(start, end, batch_size):
+        yield users_data[chunk_start:min(chunk_start + batch_size, end)]
+
+
+def _aggregate_range(users_data: tuple, bounds: tuple) -> ProductAggregates:
+    users_data, batch_size = users_data
+    start, end = bounds
+    aggregates = ProductAggregates()
+    for chunk in _chunks(users_data, start, end, batch_size):
+        if isinstance(chunk, TransactionStore):
+            aggregates.add_store(chunk)
+        else:
+            aggregates.add_records(chunk)
+    return aggregates
+
+
+def aggregate_products(users_data, n_jobs: int = 1, batch_size: int = 1000) -> ProductAggregates:
+    """
+    records or TransactionStore (one record per client) in chunks of batch_size clients,
+    with n_jobs > 1 consecutive shards are aggregated by forked workers and merged in order
+    """
+    if n_jobs <= 1:
+        return _aggregate_range((users_data, batch_size), (0, len(users_data)))
+
+    shard_size = max(1, -(-len(users_data) // n_jobs))
+    bounds = [(start, min(start + shard_size, len(users_data))) for start in range(0, len(users_data), shard_size)]
+    shards = fork_map(_aggregate_range, (users_data, batch_size), bounds, n_jobs)
+
+    aggregates = ProductAggregates()
+    for shard in shards:
+        aggregates.merge(shard)
+    return aggregates
@@ -1,94 +1,177 @@
-from collections import defaultdict, Counter
-from operator import itemgetter
+import numpy as np
 
-
-def ddf():
-    return defaultdict(int)
+from lib.i2i_model import ProductIdMap
+from lib.transaction_store import TransactionStore
 
 
 class ProductStoreStats:
-
-    def __init__(self):
-        self.store_product_count = defaultdict(ddf)
-        self.store_count = defaultdict(int)
-        self.product_count = defaultdict(int)
-        self.product_id_map = {}
-        self.store_id_map = {}
-
-    def add(self, product_id: str, store_id: str):
-        self.store_product_count[store_id][product_id] += 1
-        self.store_count[store_id] += 1
-        self.product_count[product_id] += 1
-
-    def optimize(self):
-        self.product_id_map = {pid: i for i, pid in enumerate(self.product_count)}
-        self.store_id_map = {sid: i for i, sid in enumerate(self.store_count)}
-        self.product_count = {
-            self.product_id_map[pid]: cnt
-            for pid, cnt in self.product_count.items()
-        }
-        self.store_count = {
-            self.store_id_map[sid]: cnt
-            for sid, cnt in self.store_count.items()
-        }
-        self.store_product_count = {
-            self.store_id_map[sid]: {
-                self.product_id_map[pid]: cnt
-                for pid, cnt in product.items()
-            }
-            for sid, product in self.store_product_count.items()
+    """
+    purchase lines counted by (store, product):
+     - CSR matrix stores x products: `indptr`, `indices` (int32 product ids, sorted within a store), `counts`
+     - `product_count`, `store_count`: lines of a product / in a store
+     - id vocabularies `product_id_map`, `store_id_map` (ProductIdMap, row / column i is id i)
+    only arrays inside, so the stats are saved as artifacts and memory-mapped by serving workers.
+    bulk methods take arrays of products and of stores (or one store for all products)
+    and return zeros for unknown products, stores and pairs
+    """
+
+    def __init__(
+            self,
+            product_ids: np.array = (),
+            store_ids: np.array = (),
+            indptr: np.array = None,
+            indices: np.array = None,
+            counts: np.array = None,
+            product_count: np.array = None,
+            store_count: np.array = None,
+    ):
+        self.product_id_map = ProductIdMap(product_ids)
+        self.store_id_map = ProductIdMap(store_ids)
+        n_products, n_stores = len(self.product_id_map), len(self.store_id_map)
+        self.indptr = np.zeros(n_stores + 1, dtype=np.int32) if indptr is None else indptr
+        self.indices = np.zeros(0, dtype=np.int32) if indices is None else indices
+        self.counts = np.zeros(0, dtype=np.int32) if counts is None else counts
+        self.product_count = np.zeros(n_products, dtype=np.int64) if product_count is None else product_count
+        self.store_count = np.zeros(n_stores, dtype=np.int64) if store_count is None else store_count
+
+    @classmethod
+    def from_lines(cls, line_products: np.array, line_stores: np.array, product_ids: np.array, store_ids: np.array):
+        """
+        line_products, line_stores - indices in product_ids / store_ids of every purchase line
+        """
+        n_products, n_stores = len(product_ids), len(store_ids)
+        keys, counts = np.unique(line_stores.astype(np.int64) * n_products + line_products, return_counts=True)
+        rows = keys // n_products
+        return cls(
+            product_ids,
+            store_ids,
+            np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_stores))]).astype(np.int32),
+            (keys % n_products).astype(np.int32),
+            counts.astype(np.int32),
+            np.bincount(line_products, minlength=n_products).astype(np.int64),
+            np.bincount(line_stores, minlength=n_stores).astype(np.int64),
+        )
+
+    def to_arrays(self) -> dict:
+        return {
+            'product_store_stats.product_ids': self.product_id_map.product_ids,
+            'product_store_stats.store_ids': self.store_id_map.product_ids,
+            'product_store_stats.indptr': self.indptr,
+            'product_store_stats.indices': self.indices,
+            'product_store_stats.counts': self.counts,
+            'product_store_stats.product_count': self.product_count,
+            'product_store_stats.store_count': self.store_count,
         }
 
+    @classmethod
+    def from_arrays(cls, arrays: dict):
+        return cls(
+            arrays['product_store_stats.product_ids'],
+            arrays['product_store_stats.store_ids'],
+            arrays['product_store_stats.indptr'],
+            arrays['product_store_stats.indices'],
+            arrays['product_store_stats.counts'],
+            arrays['product_store_stats.product_count'],
+            arrays['product_store_stats.store_count'],
+        )
+
+    def row_counts(self, store: int, products: np.array) -> np.array:
+        """
+        lines of products in a store by int ids, binary search in the sorted row of the store
+        """
+        start, end = int(self.indptr[store]), int(self.indptr[store + 1])
+        if start == end:
+            return np.zeros(len(products), dtype=np.int64)
+        positions = start + np.minimum(np.searchsorted(self.indices[start:end], products), end - start - 1)
+        return np.where(self.indices[positions] == products, self.counts[positions], 0).astype(np.int64)
+
+    def shares(self, product_ids, store_ids) -> tuple:
+        """
+        for pairs of products and stores (or one store for all products):
+        (share of lines of the product bought in the store, share of lines of the store with the product)
+        """
+        products = self.product_id_map.lookup(product_ids)
+        stores = self.store_id_map.lookup(np.atleast_1d(store_ids))
+        products, stores = np.broadcast_arrays(products, stores)
+        product_store_shares = np.zeros(len(products), dtype=np.float64)
+        store_product_shares = np.zeros(len(products), dtype=np.float64)
+        known = (products >= 0) & (stores >= 0)
+        for store in np.unique(stores[known]).tolist():
+            mask = known & (stores == store)
+            counts = self.row_counts(store, products[mask])
+            product_store_shares[mask] = counts / self.product_count[products[mask]]
+            store_product_shares[mask] = counts / self.store_count[store]
+        return product_store_shares, store_product_shares
+
+    def store_shares(self, product_ids, store_ids: list) -> tuple:
+        """
+        `shares` of the same products in every store of `store_ids`, arrays of (len(store_ids), len(product_ids)),
+        products are looked up once
+        """
+        products = self.product_id_map.lookup(product_ids)
+        stores = self.store_id_map.lookup(store_ids)
+        product_store_shares = np.zeros((len(stores), len(products)), dtype=np.float64)
+        store_product_shares = np.zeros((len(stores), len(products)), dtype=np.float64)
+        known = products >= 0
+        known_products = products[known]
+        for i, store in enumerate(stores.tolist()):
+            if store < 0:
+                continue
+            counts = self.row_counts(store, known_products)
+            product_store_shares[i, known] = counts / self.product_count[known_products]
+            store_product_shares[i, known] = counts / self.store_count[store]
+        return product_store_shares, store_product_shares
+
+    def product_store_shares(self, product_ids, store_ids) -> np.array:
+        return self.shares(product_ids, store_ids)[0]
+
+    def store_product_shares(self, product_ids, store_ids) -> np.array:
+        return self.shares(product_ids, store_ids)[1]
+
+    def store_counts(self, store_ids) -> np.array:
+        stores = self.store_id_map.lookup(np.atleast_1d(store_ids))
+        counts = np.zeros(len(stores), dtype=np.int64)
+        counts[stores >= 0] = self.store_count[stores[stores >= 0]]
+        return counts
+
     def store_cnt(self, store_id: str) -> int:
-        if store_id in self.store_id_map:
-            store_id = self.store_id_map[store_id]
-            return self.store_count.get(store_id, 0)
-        return 0
+        return int(self.store_counts([store_id])[0])
 
     def product_store_share(self, product_id: str, store_id: str) -> float:
-        try:
-            if store_id in self.store_id_map and product_id in self.product_id_map:
-                product_id, store_id = self.product_id_map[product_id], self.store_id_map[store_id]
-                if product_id in self.product_count:
-                    return self.store_product_count[store_id][product_id] / self.product_count[product_id]
-        except:
-            return 0
+        return float(self.product_store_shares([product_id], store_id)[0])
 
     def store_product_share(self, product_id: str, store_id: str) -> float:
-        try:
-            if store_id in self.store_id_map and product_id in self.product_id_map:
-                product_id, store_id = self.product_id_map[product_id], self.store_id_map[store_id]
-                if store_id in self.store_count:
-                    return self.store_product_count[store_id][product_id] / self.store_count[store_id]
-        except:
-            return 0
+        return float(self.store_product_shares([product_id], store_id)[0])
 
 
 def create_product_store_stats(users_data: list) -> ProductStoreStats:
-    stats = ProductStoreStats()
+    if isinstance(users_data, TransactionStore):
+        return create_product_store_stats_from_store(users_data)
+
+    line_products = []
+    line_stores = []
     for record in users_data:
         for tr in record['transaction_history']:
             store_id = tr['store_id']
             for product in tr['products']:
-                product_id = product['product_id']
-                stats.add(product_id, store_id)
-
-    stats.optimize()
-
-    return stats
-
-
-def get_user_favorite_store(user_record: dict) -> str:
-    store_ids = [
-        tr['store_id']
-        for tr in user_record['transaction_history']
-    ]
-    return Counter(store_ids).most_common(1)[0][0]
-
-
-def get_user_last_store(user_record: dict) -> str:
-    store_ids = [
-        tr['store_id']
-        for tr in user_record['transaction_history']
-    ]
-    return store_ids[-1]
+                line_products.append(product['product_id'])
+                line_stores.append(store_id)
+
+    product_ids, line_products = np.unique(np.array(line_products, dtype=str), return_inverse=True)
+    store_ids, line_stores = np.unique(np.array(line_stores, dtype=str), return_inverse=True)
+    return ProductStoreStats.from_lines(line_products, line_stores, product_ids, store_ids)
+
+
+def create_product_store_stats_from_store(store: TransactionStore) -> ProductStoreStats:
+    """
+    the same stats as create_product_store_stats of store records, counted on columns
+    """
+    start, end = store.lines
+    transaction_start, _ = store.transactions
+    # only products and stores that have lines in this range of clients
+    products, line_products = np.unique(store.product_ids[start:end], return_inverse=True)
+    stores, line_stores = np.unique(
+        store.transaction_stores[transaction_start + store.line_transactions()],
+        return_inverse=True,
+    )
+    return ProductStoreStats.from_lines(line_products, line_stores, store.products[products], store.store_ids[stores])
@@ -0,0 +1,94 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from lib.i2i_model import ProductIdMap
+from lib.utils import maybe_float
+
+# kept as raw strings ('' if missing), catboost hashes them as is
+categorical_columns = ['level_1', 'level_2', 'level_3', 'level_4', 'brand_id', 'vendor_id']
+# '0' / '1' in csv
+flag_columns = ['is_own_trademark', 'is_alcohol']
+
+
+class ProductTable:
+    """
+    product features (products_enriched.csv) as contiguous columns, row i is product with id i
+    in `product_id_map`, so joining features to candidates is a single gather by id array.
+    numeric columns are float64 parsed with `maybe_float` (missing -> 0), `missing` keeps masks
+    of empty fields of columns that have them, for the training join
+    """
+
+    def __init__(self, product_ids: np.array, columns: dict, missing: dict = None):
+        self.product_ids = product_ids
+        self.product_id_map = ProductIdMap(product_ids)
+        self.columns = columns
+        self.missing = missing or {}
+
+    @classmethod
+    def from_csv(cls, fp: Path):
+        with open(fp, 'r') as f:
+            header = f.readline().strip().split(',')
+            rows = [line.strip().split(',') for line in f]
+
+        values = dict(zip(header, zip(*rows)))
+        product_ids = np.array(values.pop('product_id'))
+        columns = {}
+        missing = {}
+        for name, column in values.items():
+            mask = np.array([not x for x in column], dtype=bool)
+            if mask.any():
+                missing[name] = mask
+            if name in categorical_columns:
+                columns[name] = np.array(column)
+            elif name in flag_columns:
+                columns[name] = np.array([maybe_float(x) != 0 for x in column], dtype=np.float64)
+            else:
+                columns[name] = np.array([maybe_float(x) for x in column], dtype=np.float64)
+
+        return cls(product_ids, columns, missing)
+
+    def to_arrays(self) -> dict:
+        arrays = {f'product_table.{name}': values for name, values in self.columns.items()}
+        arrays.update({f'product_table_missing.{name}': mask for name, mask in self.missing.items()})
+        arrays['product_ids'] = self.product_ids
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: dict):
+
+        def with_prefix(prefix: str) -> dict:
+            return {
+                name[len(prefix):]: values
+                for name, values in arrays.items()
+                if name.startswith(prefix)
+            }
+
+        return cls(arrays['product_ids'], with_prefix('product_table.'), with_prefix('product_table_missing.'))
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def to_ids(self, product_ids) -> np.array:
+        return self.product_id_map.to_ids(product_ids)
+
+    def gather(self, ids: np.array, columns: list = None) -> dict:
+        columns = self.columns if columns is None else columns
+        return {name: self.columns[name][ids] for name in columns}
+
+    def join(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        training counterpart of gather: adds product columns to a frame with product_id column.
+        missing values are NaN, as pd.merge with products_enriched.csv gave them (stats of never
+        purchased products included), train.train fills categorical ones with 0
+        """
+        df = df.copy()
+        ids = self.to_ids(df['product_id'])
+        for name, values in self.gather(ids).items():
+            if name in self.missing:
+                values = values.astype(object if name in categorical_columns else np.float64)
+                values[self.missing[name][ids]] = np.nan
+            df[name] = values
+
+        return df
@@ -1,14 +1,17 @@
 from collections import Callable
-from operator import itemgetter
 
-import pandas as pd
+import numpy as np
 from catboost import CatBoost
 
+from lib.artifacts import Artifacts
+from lib.client_state import ClientStateStore
 from lib.hardcode import TOP_ITEMS
-from lib.i2i_model import ImplicitRecommender
-from lib.preprocessing import create_features_from_transactions
+from lib.i2i_model import ItemNeighbors, ItemVectors
+from lib.preprocessing import concatenate_features, create_clients_features
 from lib.product_store_features import ProductStoreStats
-from lib.utils import deduplicate, inplace_hash_join
+from lib.product_table import ProductTable
+from lib.transaction_store import TransactionStore
+from lib.utils import deduplicate, timed, top_k_indices
 
 cols = [
     'total_pucrhases', 'average_psum', 'count', 'p_tr_share', 'last_transaction',
@@ -33,49 +36,191 @@ cat_cols = [
 ]
 
 
+def create_batch_features(
+        users_transactions: list,
+        item_vectors: ItemVectors,
+        implicit_model: ItemNeighbors,
+        product_store_stats: ProductStoreStats,
+        client_state_store: ClientStateStore = None,
+) -> tuple:
+    """
+    features of all users in one dict of arrays + row offsets of each user,
+    rows of user i are features[offsets[i]:offsets[i + 1]].
+    histories of the batch are decoded into one TransactionStore, implicit candidates
+    of all users come from one pass over the neighbor table
+    """
+    store = TransactionStore.from_records(users_transactions, item_vectors.product_id_map)
+    users_features = create_clients_features(
+        store,
+        item_vectors,
+        implicit_model,
+        product_store_stats,
+        client_state_store,
+    )
+    rows_per_user = [len(user_features.get('product_id', ())) for user_features in users_features]
+    offsets = np.concatenate([[0], np.cumsum(rows_per_user, dtype=int)])
+
+    return concatenate_features(users_features), offsets
+
+
+def create_feature_matrix(
+        features: dict,
+        product_table: ProductTable,
+        feature_names: list,
+        dtype=object,
+) -> np.array:
+    """
+    preallocated model input with columns in `feature_names` order, filled straight from
+    the features dict and product columns gathered by candidate ids
+    (no pd.DataFrame, fillna, astype and column reselect)
+
+    dtype=object is for catboost: numeric columns are rounded to float32 (as catboost does itself),
+    categorical ones keep python values - None -> 0, segment_id -> int, same as in training
+    """
+    product_ids = product_table.to_ids(features['product_id'])
+    product_columns = [name for name in feature_names if name not in features]
+    product_features = product_table.gather(product_ids, product_columns)
+    matrix = np.empty((len(product_ids), len(feature_names)), dtype=dtype)
+    for i, name in enumerate(feature_names):
+        values = features[name] if name in features else product_features[name]
+
+        if name in cat_cols:
+            if name == 'segment_id':
+                values = values.astype(int)
+            elif values.dtype == object:
+                values = [0 if value is None else value for value in values]
+            matrix[:, i] = values
+        elif dtype is object:
+            matrix[:, i] = values.astype(np.float32)
+        else:
+            matrix[:, i] = values
+
+    return matrix
+
+
+def split_recommendations(product_ids: list, scores: np.array, offsets: np.array, limit: int) -> list:
+    recommendations = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        top = top_k_indices(scores[start:end], limit)
+        user_product_ids = [product_ids[start + i] for i in top]
+        recommendations.append(deduplicate(user_product_ids + TOP_ITEMS)[:limit])
+
+    return recommendations
+
+
 class CatBoostRecommenderWithPopularFallback:
 
     def __init__(
         self,
         model: CatBoost,
-        implicit_model: ImplicitRecommender,
+        implicit_model: ItemNeighbors,
         feature_names: list,
-        item_vectors: dict,
-        products_data: dict,
+        item_vectors: ItemVectors,
+        product_table: ProductTable,
         product_store_stats: ProductStoreStats,
+        client_state_store: ClientStateStore = None,
     ):
         self.model = model
         self.implicit_model = implicit_model
         self.item_vectors = item_vectors
-        self.products_data = products_data
+        self.product_table = product_table
         self.feature_names = feature_names
         self.product_store_stats = product_store_stats
+        self.client_state_store = client_state_store
 
     def recommend(self, user_transactions: dict, limit: int = 30) -> list:
-        features = create_features_from_transactions(
-            [user_transactions],
-            self.item_vectors,
-            self.implicit_model,
-            self.product_store_stats,
-        )
-        inplace_hash_join(features, self.products_data)
-        features = pd.DataFrame(features)
-        features['age'] = user_transactions.get('age', 30)
-        features['gender'] = user_transactions.get('gender', 'U')
-        for col in cat_cols:
-            features[col] = features[col].fillna(0)
-        features.segment_id = features.segment_id.astype(int)
-        scores = self.model.predict(features[self.feature_names])
-        recs = sorted(zip(features['product_id'], scores), key=itemgetter(1), reverse=True)
-        product_ids = [rec[0] for rec in recs]
-
-        return deduplicate(product_ids + TOP_ITEMS)[:limit]
+        return self.recommend_batch([user_transactions], limit)[0]
+
+    def recommend_batch(self, users_transactions: list, limit: int = 30, timings: dict = None) -> list:
+        """
+        same as `recommend` for every user, but features of all users are built
+        into one matrix and scored with a single `predict` call.
+        seconds of the stages (features, matrix, predict, ranking) are added to `timings` if it is given
+        """
+        with timed(timings, 'features'):
+            features, offsets = create_batch_features(
+                users_transactions,
+                self.item_vectors,
+                self.implicit_model,
+                self.product_store_stats,
+                self.client_state_store,
+            )
+        if not offsets[-1]:
+            return [TOP_ITEMS[:limit] for _ in users_transactions]
+
+        with timed(timings, 'matrix'):
+            rows_per_user = np.diff(offsets)
+            features['age'] = np.repeat([user.get('age', 30) for user in users_transactions], rows_per_user)
+            features['gender'] = np.repeat([user.get('gender', 'U') for user in users_transactions], rows_per_user)
+            matrix = create_feature_matrix(features, self.product_table, self.feature_names)
+        with timed(timings, 'predict'):
+            scores = self.model.predict(matrix)
+
+        with timed(timings, 'ranking'):
+            return split_recommendations(features['product_id'], scores, offsets, limit)
 
     def validate(self, user_transactions: dict, gt_items: list, metric_fn: Callable) -> float:
         recs = self.recommend(user_transactions)
         return metric_fn(gt_items, recs)
 
 
+class DotProductRecommender:
+    """
+    candidates of a recommender ranked by `client_product_dot` only, baseline of the model in validation
+    """
+
+    def __init__(self, recommender: CatBoostRecommenderWithPopularFallback):
+        self.recommender = recommender
+
+    def recommend(self, user_transactions: dict, limit: int = 30) -> list:
+        return self.recommend_batch([user_transactions], limit)[0]
+
+    def recommend_batch(self, users_transactions: list, limit: int = 30, timings: dict = None) -> list:
+        with timed(timings, 'features'):
+            features, offsets = create_batch_features(
+                users_transactions,
+                self.recommender.item_vectors,
+                self.recommender.implicit_model,
+                self.recommender.product_store_stats,
+                self.recommender.client_state_store,
+            )
+        if not offsets[-1]:
+            return [TOP_ITEMS[:limit] for _ in users_transactions]
+
+        with timed(timings, 'ranking'):
+            return split_recommendations(features['product_id'], features['client_product_dot'], offsets, limit)
+
+    def validate(self, user_transactions: dict, gt_items: list, metric_fn: Callable) -> float:
+        recs = self.recommend(user_transactions)
+        return metric_fn(gt_items, recs)
+
+
+def load_product_store_stats(artifacts: Artifacts) -> ProductStoreStats:
+    # artifacts exported before the stats were added have none, store features are zeros then
+    if 'product_store_stats.indptr' not in artifacts.arrays:
+        return ProductStoreStats()
+    return ProductStoreStats.from_arrays(artifacts.arrays)
+
+
+def load_recommender(
+        artifacts: Artifacts,
+        client_state_store: ClientStateStore = None,
+) -> CatBoostRecommenderWithPopularFallback:
+    product_table = ProductTable.from_arrays(artifacts.arrays)
+    model = CatBoost()
+    model.load_model(artifacts.path('catboost_model'))
+
+    return CatBoostRecommenderWithPopularFallback(
+        model=model,
+        implicit_model=ItemNeighbors.from_arrays(artifacts.arrays, product_table.product_id_map),
+        item_vectors=ItemVectors.from_arrays(artifacts.arrays, product_table.product_id_map),
+        product_table=product_table,
+        product_store_stats=load_product_store_stats(artifacts),
+        feature_names=cols,
+        client_state_store=client_state_store,
+    )
+
+
 lgb_cols = [
     'total_pucrhases', 'average_psum', 'count', 'p_tr_share', 'last_transaction',
     'last_transaction_age',
@@ -102,36 +247,43 @@ class LGBMRecommender:
     def __init__(
         self,
         model,
-        implicit_model: ImplicitRecommender,
+        implicit_model: ItemNeighbors,
         feature_names: list,
-        item_vectors: dict,
-        products_data: dict,
+        item_vectors: ItemVectors,
+        product_table: ProductTable,
         product_store_stats: ProductStoreStats,
+        client_state_store: ClientStateStore = None,
     ):
         self.model = model
         self.implicit_model = implicit_model
         self.item_vectors = item_vectors
-        self.products_data = products_data
+        self.product_table = product_table
         self.feature_names = feature_names
         self.product_store_stats = product_store_stats
+        self.client_state_store = client_state_store
 
     def recommend(self, user_transactions: dict, limit: int = 30) -> list:
-        features = create_features_from_transactions(
-            [user_transactions],
-            self.item_vectors,
-            self.implicit_model,
-            self.product_store_stats,
-        )
-        inplace_hash_join(features, self.products_data)
-        features = pd.DataFrame(features)
-        for col in cat_cols[1:]:
-            features[col] = features[col].fillna(0)
-        features.segment_id = features.segment_id.astype(int)
-        scores = self.model.predict(features[self.feature_names])
-        recs = sorted(zip(features['product_id'], scores), key=itemgetter(1), reverse=True)
-        product_ids = [rec[0] for rec in recs]
-
-        return deduplicate(product_ids + TOP_ITEMS)[:limit]
+        return self.recommend_batch([user_transactions], limit)[0]
+
+    def recommend_batch(self, users_transactions: list, limit: int = 30, timings: dict = None) -> list:
+        with timed(timings, 'features'):
+            features, offsets = create_batch_features(
+                users_transactions,
+                self.item_vectors,
+                self.implicit_model,
+                self.product_store_stats,
+                self.client_state_store,
+            )
+        if not offsets[-1]:
+            return [TOP_ITEMS[:limit] for _ in users_transactions]
+
+        with timed(timings, 'matrix'):
+            matrix = create_feature_matrix(features, self.product_table, self.feature_names, np.float64)
+        with timed(timings, 'predict'):
+            scores = self.model.predict(matrix)
+
+        with timed(timings, 'ranking'):
+            return split_recommendations(features['product_id'], scores, offsets, limit)
 
     def validate(self, user_transactions: dict, gt_items: list, metric_fn: Callable) -> float:
         recs = self.recommend(user_transactions)
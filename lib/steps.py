@@ -0,0 +1,296 @@
+import ast
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from multiprocessing.connection import wait
+from pathlib import Path
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def file_fingerprint(fp: Path) -> list:
+    """
+    [size, mtime_ns] of a file, of every file (with relative path) of a directory, None if missing
+    """
+    if os.path.isdir(fp):
+        return sorted(
+            [os.path.relpath(os.path.join(root, name), fp)] + file_fingerprint(os.path.join(root, name))
+            for root, _, names in os.walk(fp)
+            for name in names
+        )
+    if not os.path.exists(fp):
+        return None
+    stat = os.stat(fp)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def local_imports(name: str) -> list:
+    """
+    repo modules (lib/*.py) imported by a source file, relative to the repo root
+    """
+    with open(os.path.join(ROOT_DIR, name), 'r') as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            # from lib.x import y or from lib import x
+            modules.append(node.module)
+            modules.extend(f'{node.module}.{alias.name}' for alias in node.names)
+    paths = [module.replace('.', '/') + '.py' for module in modules if module.startswith('lib.')]
+    return [path for path in paths if os.path.exists(os.path.join(ROOT_DIR, path))]
+
+
+def code_closure(files: list) -> list:
+    """
+    files + lib modules they import, transitively
+    """
+    closure = set()
+    stack = list(files)
+    while stack:
+        name = stack.pop()
+        if name not in closure:
+            closure.add(name)
+            if name.endswith('.py'):
+                stack.extend(local_imports(name))
+    return sorted(closure)
+
+
+def code_version(files: list) -> str:
+    # files relative to the repo root, with lib modules they import
+    code_hash = hashlib.sha1()
+    for name in code_closure(files):
+        code_hash.update(name.encode())
+        with open(os.path.join(ROOT_DIR, name), 'rb') as f:
+            code_hash.update(f.read())
+    return code_hash.hexdigest()
+
+
+class Step:
+    """
+    a node of the pipeline:
+     - run(*values of inputs) computes the value of the step and writes `outputs` (files or directories)
+     - load() reads the value back from `outputs`
+     - key is a hash of `params` (config section), `code` (source files the result depends on,
+       lib modules they import are added), `files` (fingerprints of source data) and artifact ids of `inputs`
+    a step without outputs (reading records) is not cached, it is run when some running step needs it
+    """
+
+    def __init__(
+            self,
+            name: str,
+            run,
+            load=None,
+            inputs: tuple = (),
+            outputs: tuple = (),
+            params: dict = None,
+            code: tuple = (),
+            files: tuple = (),
+    ):
+        self.name = name
+        self.run = run
+        self.load = load
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.params = params or {}
+        self.code = tuple(code)
+        self.files = tuple(files)
+
+    @property
+    def cached(self) -> bool:
+        return bool(self.outputs)
+
+    def key(self, input_ids: dict) -> str:
+        content = {
+            'name': self.name,
+            'params': self.params,
+            'code': code_version(self.code),
+            'files': {str(fp): file_fingerprint(fp) for fp in self.files},
+            'inputs': {name: input_ids[name] for name in self.inputs},
+        }
+        return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    def outputs_fingerprint(self) -> dict:
+        return {str(fp): file_fingerprint(fp) for fp in self.outputs}
+
+
+class StepRunner:
+    """
+    runs steps needed for targets. a cached step is fresh if its inputs are fresh and <stamp_dir>/<name>.json
+    has its key and fingerprints of outputs as they are now. the stamp also has the artifact id
+    (key + output fingerprints) that keys of downstream steps are made of, so rerunning a step
+    (forced or with a new key) invalidates everything below it.
+    with n_jobs > 1 steps whose inputs are ready run concurrently in forked processes:
+    values of inputs are computed / loaded in the main process before the fork
+    """
+
+    def __init__(self, steps: list, stamp_dir: Path, force: tuple = (), n_jobs: int = 1, logger=None):
+        self.steps = {}
+        for step in steps:
+            unknown = [name for name in step.inputs if name not in self.steps]
+            if unknown:
+                raise ValueError(f'step {step.name}: inputs {unknown} must be declared before it')
+            self.steps[step.name] = step
+
+        unknown = set(force) - set(self.steps) - {'all'}
+        if unknown:
+            raise ValueError(f'unknown steps: {sorted(unknown)}')
+        self.force = set(self.steps) if 'all' in force else set(force)
+        self.stamp_dir = stamp_dir
+        self.n_jobs = n_jobs
+        self.logger = logger or logging.getLogger(__name__)
+        self.values = {}
+        self.done = set()
+
+    def stamp_path(self, name: str) -> str:
+        return os.path.join(self.stamp_dir, f'{name}.json')
+
+    def read_stamp(self, name: str) -> dict:
+        if not os.path.exists(self.stamp_path(name)):
+            return None
+        with open(self.stamp_path(name), 'r') as f:
+            return json.load(f)
+
+    def write_stamp(self, name: str, key: str, seconds: float):
+        os.makedirs(self.stamp_dir, exist_ok=True)
+        outputs = self.steps[name].outputs_fingerprint()
+        stamp = {
+            'key': key,
+            'artifact': hashlib.sha1(json.dumps([key, outputs], sort_keys=True).encode()).hexdigest(),
+            'outputs': outputs,
+            'seconds': seconds,
+        }
+        tmp_fp = f'{self.stamp_path(name)}.tmp'
+        with open(tmp_fp, 'w') as f:
+            json.dump(stamp, f, indent=4)
+        os.replace(tmp_fp, self.stamp_path(name))
+
+    def artifact_id(self, name: str) -> str:
+        if not self.steps[name].cached:
+            return self.key(name)
+        stamp = self.read_stamp(name)
+        return stamp['artifact'] if stamp else None
+
+    def key(self, name: str) -> str:
+        step = self.steps[name]
+        return step.key({input_name: self.artifact_id(input_name) for input_name in step.inputs})
+
+    def is_fresh(self, name: str) -> bool:
+        step = self.steps[name]
+        if not step.cached:
+            return all(self.is_fresh(input_name) for input_name in step.inputs)
+        if name in self.done:
+            return True
+        if name in self.force or not all(self.is_fresh(input_name) for input_name in step.inputs):
+            return False
+        stamp = self.read_stamp(name)
+        return stamp is not None and stamp['key'] == self.key(name) and stamp['outputs'] == step.outputs_fingerprint()
+
+    def plan(self, targets: list) -> list:
+        """
+        cached steps to run for targets in declaration order
+        """
+        stale = set()
+        visited = set()
+
+        def visit(name: str):
+            if name in visited:
+                return
+            visited.add(name)
+            step = self.steps[name]
+            if self.is_fresh(name):
+                return
+            if step.cached:
+                stale.add(name)
+            for input_name in step.inputs:
+                visit(input_name)
+
+        for target in targets:
+            if target not in self.steps:
+                raise ValueError(f'unknown step: {target}')
+            visit(target)
+
+        return [name for name in self.steps if name in stale]
+
+    def value(self, name: str):
+        """
+        value of a fresh or finished step, loaded once from its outputs
+        """
+        if name not in self.values:
+            step = self.steps[name]
+            if step.cached:
+                self.logger.info(f'[{name}] loading {self.artifact_id(name)[:10]}')
+                self.values[name] = step.load()
+            else:
+                start = time.time()
+                self.values[name] = step.run(*[self.value(input_name) for input_name in step.inputs])
+                self.logger.info(f'[{name}] done in {time.time() - start:.1f}s (not cached)')
+        return self.values[name]
+
+    def _execute(self, name: str):
+        step = self.steps[name]
+        # inputs have finished, so their artifact ids are final
+        key = self.key(name)
+        start = time.time()
+        value = step.run(*[self.value(input_name) for input_name in step.inputs])
+        seconds = time.time() - start
+        self.write_stamp(name, key, seconds)
+        return value, seconds
+
+    def _execute_in_child(self, name: str):
+        # the stamp is written by the child, the parent loads the value when it needs it
+        self._execute(name)
+
+    def run(self, targets: list) -> dict:
+        """
+        runs stale steps needed for targets, returns {target: value}
+        """
+        planned = self.plan(targets)
+        for name in self.steps:
+            if name in planned:
+                reason = 'forced' if name in self.force else 'miss'
+                self.logger.info(f'[{name}] {reason}')
+            elif self.steps[name].cached and self.is_fresh(name):
+                self.logger.info(f'[{name}] hit {self.artifact_id(name)[:10]}')
+
+        if self.n_jobs > 1:
+            self._run_concurrently(planned)
+        else:
+            for name in planned:
+                self.logger.info(f'[{name}] running...')
+                self.values[name], seconds = self._execute(name)
+                self.done.add(name)
+                self.logger.info(f'[{name}] done in {seconds:.1f}s')
+
+        return {target: self.value(target) for target in targets}
+
+    def _run_concurrently(self, planned: list):
+        context = multiprocessing.get_context('fork')
+        pending = list(planned)
+        running = {}
+        while pending or running:
+            unfinished = set(pending) | {name for name, _, _ in running.values()}
+            ready = [name for name in pending if not unfinished.intersection(self.steps[name].inputs)]
+            for name in ready[:self.n_jobs - len(running)]:
+                # inputs are computed here, so the forked process gets them without pickling
+                for input_name in self.steps[name].inputs:
+                    self.value(input_name)
+                process = context.Process(target=self._execute_in_child, args=(name,), name=f'step-{name}')
+                process.start()
+                running[process.sentinel] = (name, process, time.time())
+                pending.remove(name)
+                self.logger.info(f'[{name}] running in process {process.pid}...')
+
+            for sentinel in wait(list(running)):
+                name, process, start = running.pop(sentinel)
+                process.join()
+                if process.exitcode != 0:
+                    for _, other, _ in running.values():
+                        other.terminate()
+                    raise RuntimeError(f'step {name} failed with exit code {process.exitcode}')
+                self.done.add(name)
+                self.logger.info(f'[{name}] done in {time.time() - start:.1f}s')
@@ -1,18 +1,117 @@
+import gc
 import json
+import multiprocessing
+import os
+from contextlib import contextmanager
 from pathlib import Path
 
+import numpy as np
 
-def read_clients_purchases(fp: Path, start: int = 0, end: int = 1000) -> list:
+INDEX_SUFFIX = '.idx.npy'
+
+
+def build_line_index(fp: Path, block_size: int = 64 * 2 ** 20) -> np.array:
+    """
+    byte offsets of line starts + file size at the end: line i is [index[i], index[i + 1])
+    """
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(fp, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            offsets.append(position + newlines.astype(np.int64) + 1)
+            position += len(block)
+
+    index = np.concatenate(offsets)
+    if index[-1] != position:
+        # last line without \n
+        index = np.append(index, position)
+    return index
+
+
+def load_line_index(fp: Path) -> np.array:
+    """
+    sidecar <fp>.idx.npy, (re)built if missing or older than the file
+    """
+    index_fp = f'{fp}{INDEX_SUFFIX}'
+    if os.path.exists(index_fp) and os.path.getmtime(index_fp) >= os.path.getmtime(fp):
+        index = np.load(index_fp)
+        if index[-1] == os.path.getsize(fp):
+            return index
+
+    index = build_line_index(fp)
+    try:
+        np.save(index_fp, index)
+    except OSError:
+        # read-only data dir, just don't cache it
+        pass
+    return index
+
+
+def read_lines(fp: Path, start: int = 0, end: int = None, index: np.array = None) -> list:
+    """
+    lines [start, end) of the file (without \n), reads only their bytes
+    """
+    if index is None:
+        index = load_line_index(fp)
+    end = len(index) - 1 if end is None else min(end, len(index) - 1)
+    start = min(start, end)
+    with open(fp, 'rb') as f:
+        f.seek(index[start])
+        data = f.read(index[end] - index[start])
+
+    return data.decode().split('\n')[:end - start]
+
+
+@contextmanager
+def gc_paused():
+    # decoded records have no reference cycles, while generational gc passes over
+    # millions of new dicts take ~40% of json decoding (and of unpickling worker results)
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _decode_records(task: tuple) -> tuple:
+    fp, start, end, index = task
     train_records = []
     test_records = []
-    with open(fp, 'r') as f:
-        for line_no, line in enumerate(f):
-            if line_no < start:
-                continue
-            elif line_no < end:
-                train, test = line.strip().split('\t')
-                train, test = json.loads(train), json.loads(test)
-                train_records.append(train)
-                test_records.append(test)
+    with gc_paused():
+        for line in read_lines(fp, start, end, index):
+            train, test = line.strip().split('\t')
+            train_records.append(json.loads(train))
+            test_records.append(json.loads(test))
+
+    return train_records, test_records
+
+
+def read_clients_purchases(fp: Path, start: int = 0, end: int = 1000, n_jobs: int = 1) -> list:
+    """
+    train and test records of lines [start, end), seeks to them by the line index,
+    with n_jobs > 1 the range is json-decoded in parts by a process pool
+    """
+    index = load_line_index(fp)
+    end = min(end, len(index) - 1)
+    start = min(start, end)
+    if n_jobs <= 1:
+        return _decode_records((fp, start, end, index))
+
+    bounds = np.linspace(start, end, n_jobs + 1).astype(int).tolist()
+    # workers get only offsets of their lines
+    tasks = [
+        (fp, 0, part_end - part_start, index[part_start:part_end + 1])
+        for part_start, part_end in zip(bounds[:-1], bounds[1:])
+    ]
+    with multiprocessing.Pool(n_jobs) as pool, gc_paused():
+        parts = pool.map(_decode_records, tasks)
 
+    train_records = [record for part, _ in parts for record in part]
+    test_records = [record for _, part in parts for record in part]
     return train_records, test_records
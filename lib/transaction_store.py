@@ -0,0 +1,302 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from lib.artifacts import load_artifacts, save_artifacts
+from lib.hardcode import test_start
+from lib.utils import fork_map
+
+# clients_purchases.tsv columns, the store keeps one directory per part
+PARTS = ('train', 'test')
+
+
+class ClientView:
+    """
+    one client of a TransactionStore: positions of its transactions / purchase lines in store arrays,
+    columns are slices of them (views of memory-mapped arrays, nothing is parsed or copied)
+    """
+
+    def __init__(self, store: 'TransactionStore', index: int):
+        self.store = store
+        self.client_id = str(store.client_ids[index])
+        self.start, self.end = int(store.client_offsets[index]), int(store.client_offsets[index + 1])
+        self.line_start = int(store.transaction_offsets[self.start])
+        self.line_end = int(store.transaction_offsets[self.end])
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def seconds(self) -> np.array:
+        return self.store.transaction_seconds[self.start:self.end]
+
+    @property
+    def days(self) -> np.array:
+        return self.store.transaction_days[self.start:self.end]
+
+    @property
+    def store_codes(self) -> np.array:
+        return self.store.transaction_stores[self.start:self.end]
+
+    @property
+    def purchase_sums(self) -> np.array:
+        return self.store.purchase_sums[self.start:self.end]
+
+    @property
+    def transaction_sizes(self) -> np.array:
+        return np.diff(self.store.transaction_offsets[self.start:self.end + 1])
+
+    @property
+    def product_ids(self) -> np.array:
+        return self.store.product_ids[self.line_start:self.line_end]
+
+    @property
+    def quantities(self) -> np.array:
+        return self.store.quantities[self.line_start:self.line_end]
+
+    @property
+    def prices(self) -> np.array:
+        return self.store.prices[self.line_start:self.line_end]
+
+    def store_ids(self) -> np.array:
+        return self.store.store_ids[self.store_codes]
+
+    def products(self) -> np.array:
+        return self.store.products[self.product_ids]
+
+    def datetimes(self) -> list:
+        return self.store.datetimes(self.seconds)
+
+    def datetime_order(self) -> np.array:
+        # positions of transactions sorted by datetime, ties keep request order
+        return np.argsort(self.seconds, kind='stable')
+
+    def to_record(self) -> dict:
+        """
+        the client as a clients_purchases.tsv record, for code that needs dicts
+        """
+        products = self.products().tolist()
+        quantities = self.quantities.tolist()
+        prices = self.prices.tolist()
+        offsets = (self.store.transaction_offsets[self.start:self.end + 1] - self.line_start).tolist()
+        transactions = []
+        for i, (dt, store_id, purchase_sum) in enumerate(zip(
+                self.datetimes(), self.store_ids().tolist(), self.purchase_sums.tolist())):
+            transactions.append({
+                'datetime': dt,
+                'store_id': store_id,
+                'purchase_sum': purchase_sum,
+                'products': [
+                    {'product_id': products[j], 'quantity': quantities[j], 'price': prices[j]}
+                    for j in range(offsets[i], offsets[i + 1])
+                ],
+            })
+
+        return {'client_id': self.client_id, 'transaction_history': transactions}
+
+
+class TransactionStore:
+    """
+    columnar clients_purchases.tsv part (train or test histories), clients in file order:
+     - client_ids, client_offsets: transactions of client i are client_offsets[i]:client_offsets[i + 1]
+     - per transaction: transaction_offsets (purchase lines of transaction t are
+       transaction_offsets[t]:transaction_offsets[t + 1]), transaction_seconds / transaction_days
+       (seconds since test_start, (test_start - datetime).days), transaction_stores (index in `store_ids`),
+       purchase_sums
+     - per purchase line: product_ids (int32 index in `products`, the products.csv vocabulary
+       shared with ProductIdMap), float32 quantities and prices
+    `clients(start, end)` is a store of a range of clients sharing the same arrays, so offsets are absolute
+    """
+
+    def __init__(self, arrays: dict):
+        self.client_ids = arrays['client_ids']
+        self.client_offsets = arrays['client_offsets']
+        self.transaction_offsets = arrays['transaction_offsets']
+        self.transaction_seconds = arrays['transaction_seconds']
+        self.transaction_days = arrays['transaction_days']
+        self.transaction_stores = arrays['transaction_stores']
+        self.purchase_sums = arrays['purchase_sums']
+        self.product_ids = arrays['product_ids']
+        self.quantities = arrays['quantities']
+        self.prices = arrays['prices']
+        self.store_ids = arrays['store_ids']
+        self.products = arrays['products']
+
+    def to_arrays(self) -> dict:
+        return {
+            'client_ids': self.client_ids,
+            'client_offsets': self.client_offsets,
+            'transaction_offsets': self.transaction_offsets,
+            'transaction_seconds': self.transaction_seconds,
+            'transaction_days': self.transaction_days,
+            'transaction_stores': self.transaction_stores,
+            'purchase_sums': self.purchase_sums,
+            'product_ids': self.product_ids,
+            'quantities': self.quantities,
+            'prices': self.prices,
+            'store_ids': self.store_ids,
+            'products': self.products,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: dict):
+        return cls(arrays)
+
+    @classmethod
+    def from_records(cls, records: list, product_id_map):
+        """
+        records (requests or clients_purchases.tsv json) decoded once into columns,
+        quantities and prices stay float64 here, only the saved store is float32
+        """
+        return cls(_concatenate_part([_part_columns(records, product_id_map)], product_id_map.product_ids))
+
+    def __len__(self):
+        return len(self.client_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.clients(index.start or 0, index.stop)
+        return ClientView(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield ClientView(self, i)
+
+    def clients(self, start: int = 0, end: int = None):
+        arrays = self.to_arrays()
+        end = len(self) if end is None else min(end, len(self))
+        start = min(start, end)
+        arrays['client_ids'] = self.client_ids[start:end]
+        arrays['client_offsets'] = self.client_offsets[start:end + 1]
+        return TransactionStore(arrays)
+
+    def to_records(self) -> list:
+        return [client.to_record() for client in self]
+
+    @property
+    def transactions(self) -> tuple:
+        return int(self.client_offsets[0]), int(self.client_offsets[-1])
+
+    @property
+    def lines(self) -> tuple:
+        start, end = self.transactions
+        return int(self.transaction_offsets[start]), int(self.transaction_offsets[end])
+
+    def transaction_clients(self) -> np.array:
+        """
+        client index (in this store) of every transaction of `transactions` range
+        """
+        return np.repeat(np.arange(len(self)), np.diff(self.client_offsets))
+
+    def transaction_sizes(self) -> np.array:
+        start, end = self.transactions
+        return np.diff(self.transaction_offsets[start:end + 1])
+
+    def line_transactions(self) -> np.array:
+        """
+        transaction index (relative to the first one of `transactions` range) of every purchase line of `lines` range
+        """
+        sizes = self.transaction_sizes()
+        return np.repeat(np.arange(len(sizes)), sizes)
+
+    def datetimes(self, seconds: np.array) -> list:
+        dts = np.datetime64(test_start, 's') + np.asarray(seconds).astype('timedelta64[s]')
+        return np.datetime_as_string(dts, unit='s').tolist()
+
+
+def load_transaction_store(store_dir: Path, part: str = 'train', mmap_mode: str = 'r') -> TransactionStore:
+    return TransactionStore.from_arrays(load_artifacts(os.path.join(store_dir, part), mmap_mode).arrays)
+
+
+def line_aligned_chunks(fp: Path, chunk_size: int) -> list:
+    file_size = os.path.getsize(fp)
+    bounds = [0]
+    with open(fp, 'rb') as f:
+        while bounds[-1] + chunk_size < file_size:
+            f.seek(bounds[-1] + chunk_size)
+            f.readline()
+            if f.tell() >= file_size:
+                break
+            bounds.append(f.tell())
+
+    bounds.append(file_size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _part_columns(records: list, product_id_map) -> dict:
+    client_sizes = [len(record['transaction_history']) for record in records]
+    transactions = [tr for record in records for tr in record['transaction_history']]
+    lines = [product for tr in transactions for product in tr['products']]
+    return {
+        'client_ids': np.array([record['client_id'] for record in records], dtype=str),
+        'client_sizes': np.array(client_sizes, dtype=np.int64),
+        'transaction_sizes': np.array([len(tr['products']) for tr in transactions], dtype=np.int64),
+        'datetimes': np.array([tr['datetime'] for tr in transactions], dtype='datetime64[s]'),
+        'store_ids': np.array([tr['store_id'] for tr in transactions], dtype=str),
+        'purchase_sums': np.array([tr['purchase_sum'] for tr in transactions], dtype=np.float64),
+        'product_ids': product_id_map.to_ids([product['product_id'] for product in lines]).astype(np.int32),
+        'quantities': np.array([product['quantity'] for product in lines], dtype=np.float64),
+        'prices': np.array([product.get('price', np.nan) for product in lines], dtype=np.float64),
+    }
+
+
+def _convert_chunk(product_id_map, task: tuple) -> list:
+    fp, start, end = task
+    with open(fp, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    parts = tuple([] for _ in PARTS)
+    for line in data.decode().split('\n'):
+        if line.strip():
+            for records, record in zip(parts, line.split('\t')):
+                records.append(json.loads(record))
+
+    return [_part_columns(records, product_id_map) for records in parts]
+
+
+def _concatenate_part(chunks: list, product_ids: np.array) -> dict:
+    columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+    seconds = (columns['datetimes'] - np.datetime64(test_start, 's')).astype(np.int64)
+    if len(seconds) and np.abs(seconds).max() > np.iinfo(np.int32).max:
+        raise ValueError('transaction datetime is too far from test_start')
+    store_ids, transaction_stores = np.unique(columns['store_ids'], return_inverse=True)
+
+    return {
+        'client_ids': columns['client_ids'],
+        'client_offsets': np.concatenate([[0], np.cumsum(columns['client_sizes'])]).astype(np.int64),
+        'transaction_offsets': np.concatenate([[0], np.cumsum(columns['transaction_sizes'])]).astype(np.int64),
+        'transaction_seconds': seconds.astype(np.int32),
+        # floor, as timedelta.days of (test_start - datetime)
+        'transaction_days': (-seconds // 86400).astype(np.int32),
+        'transaction_stores': transaction_stores.astype(np.int32),
+        'purchase_sums': columns['purchase_sums'],
+        'product_ids': columns['product_ids'],
+        'quantities': columns['quantities'],
+        'prices': columns['prices'],
+        'store_ids': store_ids,
+        'products': np.asarray(product_ids, dtype=str),
+    }
+
+
+def build_transaction_store(
+        clients_purchases_fp: Path,
+        product_id_map,
+        store_dir: Path,
+        n_jobs: int = 1,
+        chunk_size: int = 32 * 2 ** 20,
+):
+    """
+    clients_purchases.tsv -> store_dir/train, store_dir/test, client i of both is line i of the file.
+    chunks of lines are json-decoded by `n_jobs` forked processes, product ids must be in `product_id_map`
+    """
+    tasks = [(clients_purchases_fp, start, end) for start, end in line_aligned_chunks(clients_purchases_fp, chunk_size)]
+    chunks = fork_map(_convert_chunk, product_id_map, tasks, n_jobs)
+
+    for i, part in enumerate(PARTS):
+        arrays = _concatenate_part([chunk[i] for chunk in chunks], product_id_map.product_ids)
+        arrays['quantities'] = arrays['quantities'].astype(np.float32)
+        arrays['prices'] = arrays['prices'].astype(np.float32)
+        save_artifacts(os.path.join(store_dir, part), arrays)
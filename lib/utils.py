@@ -1,10 +1,12 @@
 import json
+import multiprocessing
 import pickle
+import time
 from collections import namedtuple
+from contextlib import contextmanager
 
-import attr
+import numpy as np
 from pathlib import Path
-from typing import Dict
 
 
 Query = namedtuple("Query", "history answers")
@@ -22,18 +24,6 @@ def parse_check_queries_file(filename: Path):
     return queries
 
 
-def read_products_file(filename: Path) -> dict:
-    records = {}
-    with open(filename, "r") as f:
-        header = f.readline().strip().split(',')
-
-        for line in f:
-            record = ProductsRow(*line.strip().split(','))
-            records[record.product_id] = record
-
-    return records
-
-
 def deduplicate(items: list):
     seen = set()
     dedup = []
@@ -45,46 +35,72 @@ def deduplicate(items: list):
     return dedup
 
 
-def maybe_float(x):
-    return float(x) if x else 0
+def top_k_indices(scores: np.array, k: int) -> np.array:
+    """
+    indices of k best scores, ordered like a stable sort by score desc
+    (ties keep original order), without sorting all of the scores
+    """
+    scores = np.asarray(scores)
+    if len(scores) > k:
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        candidates = np.flatnonzero(scores >= threshold)
+    else:
+        candidates = np.arange(len(scores))
+    order = np.lexsort((candidates, -scores[candidates]))
+
+    return candidates[order][:k]
+
+
+@contextmanager
+def timed(timings: dict, stage: str):
+    # adds seconds of the block to timings[stage], does nothing without timings
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.) + time.perf_counter() - start
+
 
+# (fn, shared) of the running fork_map, workers of its pool inherit it
+_fork_task = None
 
-@attr.s(slots=True)
-class ProductsRow:
-    product_id = attr.ib()
-    level_1 = attr.ib()
-    level_2 = attr.ib()
-    level_3 = attr.ib()
-    level_4 = attr.ib()
-    segment_id = attr.ib(converter=maybe_float)
-    brand_id = attr.ib()
-    vendor_id = attr.ib()
-    netto = attr.ib(converter=maybe_float)
-    is_own_trademark = attr.ib(converter=bool)
-    is_alcohol = attr.ib(converter=bool)
-    max_dt = attr.ib(converter=maybe_float)
-    min_dt = attr.ib(converter=maybe_float)
-    avg_dt = attr.ib(converter=maybe_float)
-    max_q = attr.ib(converter=maybe_float)
-    min_q = attr.ib(converter=maybe_float)
-    avg_q = attr.ib(converter=maybe_float)
-    unique_clients = attr.ib(converter=maybe_float)
-    max_p = attr.ib(converter=maybe_float)
-    min_p = attr.ib(converter=maybe_float)
-    avg_p = attr.ib(converter=maybe_float)
-    max_tr_size = attr.ib(converter=maybe_float)
-    min_tr_size = attr.ib(converter=maybe_float)
-    avg_tr_size = attr.ib(converter=maybe_float)
-    unique_clients_n = attr.ib(converter=maybe_float)
-    product_count = attr.ib(converter=maybe_float)
-    unique_stores = attr.ib(converter=maybe_float)
-
-
-def inplace_hash_join(left_list: dict, products_data: Dict[str, ProductsRow]):
-    for product_id in left_list['product_id']:
-        for k, v in attr.asdict(products_data[product_id]).items():
-            if k != 'product_id':
-                left_list[k].append(v)
+
+def _call_shared(task):
+    fn, shared = _fork_task
+    return fn(shared, task)
+
+
+def fork_map(fn, shared, tasks: list, n_jobs: int = 1, lazy: bool = False):
+    """
+    [fn(shared, task) for task in tasks], in task order, by a pool of `n_jobs` forked processes (in this one
+    if n_jobs <= 1). `shared` (records, models, memory-mapped arrays) is set in a module global before forking,
+    so workers inherit it without pickling, only tasks and results go through pipes. fn needn't be picklable.
+    lazy=True returns an iterator (imap): results come one by one and only a few are in memory at once
+    """
+
+    def results():
+        global _fork_task
+        if n_jobs <= 1:
+            for task in tasks:
+                yield fn(shared, task)
+            return
+
+        previous = _fork_task
+        _fork_task = fn, shared
+        try:
+            with multiprocessing.get_context('fork').Pool(n_jobs) as pool:
+                yield from pool.imap(_call_shared, tasks)
+        finally:
+            _fork_task = previous
+
+    return results() if lazy else list(results())
+
+
+def maybe_float(x):
+    return float(x) if x else 0
 
 
 def pickle_dump(fp: Path, obj: object):
@@ -1,22 +1,22 @@
-from run_queries import normalized_average_precision
-from lib.recommender import CatBoostRecommenderWithPopularFallback
+from lib.evaluation import EvaluationData, evaluate
+from lib.recommender import CatBoostRecommenderWithPopularFallback, DotProductRecommender
 
 
 def validate(
         recommender: CatBoostRecommenderWithPopularFallback,
         history: list,
         dot_only: bool = False,
-):
-    scores = []
-    for user_seed, test_data in history:
-        if test_data['transaction_history']:
-            next_transaction = test_data['transaction_history'][0]
-            gt_items = [p['product_id'] for p in next_transaction['products']]
-            if dot_only:
-                score = recommender.validate_dot(user_seed, gt_items, normalized_average_precision)
-            else:
-                score = recommender.validate(user_seed, gt_items, normalized_average_precision)
+        n_jobs: int = 1,
+) -> float:
+    """
+    MAP@30 on (train record, test record) pairs, with dot_only - of the same candidates ranked by client_product_dot
+    """
+    if dot_only:
+        recommender = DotProductRecommender(recommender)
+    train_records = [user_seed for user_seed, _ in history]
+    test_records = [test_data for _, test_data in history]
+    data = EvaluationData.from_records(train_records, test_records)
+    score = evaluate({'model': recommender}, data, n_jobs)['model'].map
 
-            scores.append(score)
-
-    print(sum(scores) / len(scores))
+    print(score)
+    return score
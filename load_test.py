@@ -0,0 +1,246 @@
+"""
+replays queries against /recommend (server.py, async_server.py) and reports latency percentiles, throughput,
+errors and MAP@30 of the responses as json:
+
+    python load_test.py --url http://localhost:8000/recommend --queries data/check_queries.tsv --qps 20 50 100
+    python load_test.py --queries data/clients_purchases.tsv --offset 0 --limit 10000 --concurrency 1 8 32
+
+--qps is an open loop: requests are sent on schedule whether earlier ones have finished or not
+(at most --max_in_flight at once) and latency is counted from the scheduled time, so a server that falls
+behind shows it in the tail instead of slowing the generator down.
+--concurrency is a closed loop: every client sends its next query when it gets the response to the previous one.
+every load level starts with --warmup seconds that are not measured, connections are kept alive and reused.
+request bodies are serialized before the run and responses are parsed after it.
+warmup and the measured run replay the same queries, so the server should run without result cache
+(the default, CACHE_SIZE_MB / --cache_size_mb 0), otherwise the measured requests are cache hits.
+a run against a server with the cache is a separate experiment, --label it
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+
+import aiohttp
+import numpy as np
+
+from lib.evaluation import EvaluationData
+from lib.metrics import METRICS, recommendation_metrics
+from lib.utils import deduplicate
+
+K = 30
+PERCENTILES = (50, 90, 99, 99.9)
+# upper bounds of latency histogram buckets, ms
+HISTOGRAM_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+class Measurement:
+    """
+    requests of one run: query index, latency and outcome (http status or error kind) of every request
+    + bodies of 200 responses, parsed only in `summary`
+    """
+
+    def __init__(self):
+        self.indices = []
+        self.latencies = []
+        self.outcomes = []
+        self.responses = {}
+        self.start = time.perf_counter()
+        self.end = self.start
+
+    def add(self, index: int, latency: float, outcome: str, body: bytes = None):
+        if outcome == '200':
+            self.responses[len(self.indices)] = body
+        self.indices.append(index)
+        self.latencies.append(latency)
+        self.outcomes.append(outcome)
+        self.end = time.perf_counter()
+
+    def summary(self, gt_items: list) -> dict:
+        elapsed = max(self.end - self.start, 1e-9)
+        latencies = np.array(self.latencies) * 1000
+        outcomes = Counter(self.outcomes)
+        ok = outcomes.pop('200', 0)
+
+        # failed requests get empty recommendations (0), as in run_queries.py
+        recommendations = [[] for _ in self.indices]
+        for i, body in self.responses.items():
+            try:
+                recommendations[i] = deduplicate(json.loads(body)['recommended_products'])[:K]
+            except (ValueError, KeyError, TypeError):
+                outcomes['bad_response'] += 1
+        metrics = recommendation_metrics([gt_items[i] for i in self.indices], recommendations, K)
+
+        counts, _ = np.histogram(latencies, bins=[0] + list(HISTOGRAM_MS) + [np.inf])
+        return {
+            'requests': len(self.indices),
+            'ok': ok,
+            'errors': dict(outcomes),
+            'error_rate': (len(self.indices) - ok) / max(len(self.indices), 1),
+            'seconds': elapsed,
+            'throughput_rps': ok / elapsed,
+            'latency_ms': {
+                'mean': float(latencies.mean()) if len(latencies) else 0.,
+                **{
+                    f'p{percentile:g}': float(np.percentile(latencies, percentile)) if len(latencies) else 0.
+                    for percentile in PERCENTILES
+                },
+                'max': float(latencies.max()) if len(latencies) else 0.,
+            },
+            'histogram_ms': {
+                f'<{bound}': int(count) for bound, count in zip(list(HISTOGRAM_MS) + ['inf'], counts)
+            },
+            **{f'{metric}@{K}': float(metrics[metric].mean()) if len(self.indices) else 0. for metric in METRICS},
+        }
+
+
+async def send(
+        session: aiohttp.ClientSession,
+        url: str,
+        bodies: list,
+        index: int,
+        sent: float,
+        measurement: Measurement,
+):
+    """
+    one request, latency is counted from `sent` (the scheduled time in the open loop)
+    """
+    body = None
+    try:
+        async with session.post(url, data=bodies[index], headers=JSON_HEADERS) as resp:
+            body = await resp.read()
+            outcome = str(resp.status)
+    except asyncio.TimeoutError:
+        outcome = 'timeout'
+    except aiohttp.ClientError as e:
+        outcome = type(e).__name__
+    measurement.add(index, time.perf_counter() - sent, outcome, body)
+
+
+async def open_loop(
+        session: aiohttp.ClientSession,
+        url: str,
+        bodies: list,
+        qps: float,
+        duration: float,
+        max_in_flight: int,
+) -> Measurement:
+    measurement = Measurement()
+    in_flight = asyncio.Semaphore(max_in_flight)
+    tasks = []
+
+    async def scheduled_send(index: int, scheduled: float):
+        try:
+            await send(session, url, bodies, index, scheduled, measurement)
+        finally:
+            in_flight.release()
+
+    for i in range(int(qps * duration)):
+        scheduled = measurement.start + i / qps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await in_flight.acquire()
+        tasks.append(asyncio.ensure_future(scheduled_send(i % len(bodies), scheduled)))
+
+    await asyncio.gather(*tasks)
+    return measurement
+
+
+async def closed_loop(
+        session: aiohttp.ClientSession,
+        url: str,
+        bodies: list,
+        concurrency: int,
+        duration: float,
+) -> Measurement:
+    measurement = Measurement()
+    deadline = measurement.start + duration
+
+    async def client(i: int):
+        while time.perf_counter() < deadline:
+            await send(session, url, bodies, i % len(bodies), time.perf_counter(), measurement)
+            i += concurrency
+
+    await asyncio.gather(*[client(i) for i in range(concurrency)])
+    return measurement
+
+
+async def run_level(args, bodies: list, gt_items: list, mode: str, level: float) -> dict:
+    connections = int(level) if mode == 'concurrency' else args.max_in_flight
+    connector = aiohttp.TCPConnector(limit=connections, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        async def run(duration: float) -> Measurement:
+            if mode == 'qps':
+                return await open_loop(session, args.url, bodies, level, duration, args.max_in_flight)
+            return await closed_loop(session, args.url, bodies, int(level), duration)
+
+        # warmup opens connections and replays the same queries, the measured run starts from the first one again
+        if args.warmup > 0:
+            await run(args.warmup)
+        measurement = await run(args.duration)
+
+    return {
+        'label': args.label,
+        'url': args.url,
+        'queries': args.queries,
+        'mode': mode,
+        mode: level,
+        **measurement.summary(gt_items),
+    }
+
+
+def read_queries(args) -> EvaluationData:
+    with open(args.queries, 'r') as f:
+        _, second = f.readline().split('\t')
+    if 'product_ids' in json.loads(second):
+        data = EvaluationData.from_check_queries(args.queries)
+        end = len(data) if args.limit is None else args.offset + args.limit
+        return EvaluationData(data.queries[args.offset:end], data.gt_items[args.offset:end])
+
+    # clients_purchases.tsv: the train history is the query, the first test transaction is gt
+    return EvaluationData.from_clients_purchases(
+        args.queries,
+        args.offset,
+        args.offset + (args.limit or 10000),
+        args.clients_file if os.path.exists(args.clients_file) else None,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:8000/recommend')
+    parser.add_argument('--queries', default='data/check_queries.tsv')
+    parser.add_argument('--clients_file', default='./data/clients.csv')
+    parser.add_argument('--offset', type=int, default=0)
+    parser.add_argument('--limit', type=int, default=None)
+    load = parser.add_mutually_exclusive_group(required=True)
+    load.add_argument('--qps', type=float, nargs='+')
+    load.add_argument('--concurrency', type=int, nargs='+')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--max_in_flight', type=int, default=256)
+    parser.add_argument('--timeout', type=float, default=5)
+    parser.add_argument('--label', default='', help='name of the server mode in the report')
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    data = read_queries(args)
+    if not len(data):
+        parser.error(f'no queries in {args.queries} with --offset {args.offset} --limit {args.limit}')
+    bodies = [json.dumps(query).encode() for query in data.queries]
+    mode = 'qps' if args.qps else 'concurrency'
+
+    results = []
+    for level in args.qps or args.concurrency:
+        result = asyncio.run(run_level(args, bodies, data.gt_items, mode, level))
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
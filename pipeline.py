@@ -1,173 +1,373 @@
 import argparse
+import json
+import os
+from functools import partial
 from warnings import filterwarnings
 filterwarnings('ignore')
 
 import implicit
+import numpy as np
 import pandas as pd
 
+from lib.artifacts import MANIFEST_FILE, load_artifacts, save_artifacts
 from lib.config import TrainConfig
+from lib.feature_store import load_features, write_features
 from lib.logger import configure_logger
 from lib.product_store_features import create_product_store_stats, ProductStoreStats
 from lib.train_utils import read_clients_purchases
+from lib.transaction_store import load_transaction_store
 from lib.i2i_model import create_sparse_purchases_matrix, ProductIdMap, ImplicitRecommender, \
-    train_implicit_vectors
+    ItemNeighbors, ItemVectors, train_implicit_vectors
+from lib.product_table import ProductTable
 from lib.preprocessing import (
     create_features_from_transactions,
     create_product_features_from_users_data,
     create_target_from_transactions,
     create_gt_items_count_df
 )
-from lib.utils import pickle_dump, pickle_load
+from lib.recommender import cols
+from lib.steps import Step, StepRunner
+from lib.utils import fork_map, pickle_dump, pickle_load
 from train import train
 
 logger = configure_logger(logger_name='make_features', log_dir='logs')
 
+# clients per shard, a shard is the unit of work of the pool and of writing features
+SHARD_SIZE = 10000
+# feature columns needed by train, the rest are joined from products and clients
+TRAIN_COLUMNS = ['client_id', 'product_id', 'target'] + cols
+IMPLICIT_K = 10
+CLIENTS_FILE = './data/clients.csv'
+# stamps of finished steps, in data_dir
+STEPS_DIR = 'steps'
+FEATURES_CODE = [
+    'pipeline.py',
+    'lib/client_state.py',
+    'lib/feature_store.py',
+    'lib/hardcode.py',
+    'lib/i2i_model.py',
+    'lib/preprocessing.py',
+    'lib/product_store_features.py',
+    'lib/transaction_store.py',
+    'lib/utils.py',
+]
 
-def create_features(
-        seed_records: list,
-        target_records: list,
-        item_vectors: dict,
-        recommender: ImplicitRecommender,
-        product_store_stats: ProductStoreStats,
-):
+
+def _create_shard_features(shard_data: tuple, bounds: tuple) -> pd.DataFrame:
+    seed_records, target, item_vectors, recommender, product_store_stats = shard_data
+    start, end = bounds
     features_dict = create_features_from_transactions(
-        seed_records,
+        seed_records[start:end],
         item_vectors,
         recommender,
         product_store_stats
     )
-    features = pd.DataFrame(features_dict)
+    if not features_dict:
+        return None
+    return pd.DataFrame(features_dict).merge(target, how='left', sort=False)
+
+
+def iterate_features(
+        seed_records: list,
+        target: pd.DataFrame,
+        item_vectors: ItemVectors,
+        recommender: ItemNeighbors,
+        product_store_stats: ProductStoreStats,
+        n_jobs: int = 1,
+        shard_size: int = SHARD_SIZE,
+):
+    """
+    features merged with target for shards of `shard_size` consecutive clients, in shard order,
+    with n_jobs > 1 shards are built by forked workers. only a few shards are in memory at once
+    """
+    bounds = [(start, start + shard_size) for start in range(0, len(seed_records), shard_size)]
+    shard_data = seed_records, target, item_vectors, recommender, product_store_stats
+    for shard in fork_map(_create_shard_features, shard_data, bounds, n_jobs, lazy=True):
+        if shard is not None:
+            yield shard
+
+
+def create_features(
+        seed_records: list,
+        target_records: list,
+        item_vectors: ItemVectors,
+        recommender: ItemNeighbors,
+        product_store_stats: ProductStoreStats,
+        n_jobs: int = 1,
+):
+    """
+    the whole frame of shards, the same as the serial one for any n_jobs
+    """
     target = create_target_from_transactions(target_records)
     gt_items_count = create_gt_items_count_df(target)
-    features_df = features.merge(target, how='left', sort=False)
+    shards = iterate_features(seed_records, target, item_vectors, recommender, product_store_stats, n_jobs)
+    features_df = pd.concat(list(shards), ignore_index=True)
     return features_df, gt_items_count
 
 
+def write_features_and_target(
+        features_dir: str,
+        gt_items_count_fp: str,
+        seed_records: list,
+        target_records: list,
+        item_vectors: ItemVectors,
+        recommender: ItemNeighbors,
+        product_store_stats: ProductStoreStats,
+        n_jobs: int = 1,
+) -> dict:
+    """
+    shards are streamed to the columnar feature file (lib/feature_store.py) as they are built
+    """
+    target = create_target_from_transactions(target_records)
+    create_gt_items_count_df(target).to_csv(gt_items_count_fp, index=False)
+    shards = iterate_features(seed_records, target, item_vectors, recommender, product_store_stats, n_jobs)
+    return write_features(features_dir, shards)
+
+
+def read_records(config: TrainConfig, start: int, end: int) -> tuple:
+    """
+    seed (train part) and target (test part) histories of clients [start, end)
+    """
+    if config.transaction_store_dir:
+        # columnar clients, everything below accepts them instead of records
+        return (
+            load_transaction_store(config.transaction_store_dir, 'train').clients(start, end),
+            load_transaction_store(config.transaction_store_dir, 'test').clients(start, end),
+        )
+    return read_clients_purchases(config.client_purchases_file, start, end, config.n_jobs)
+
+
+def records_files(config: TrainConfig) -> list:
+    if config.transaction_store_dir:
+        return [os.path.join(config.transaction_store_dir, part, MANIFEST_FILE) for part in ('train', 'test')]
+    return [config.client_purchases_file]
+
+
+def train_implicit_model(config: TrainConfig, records: tuple) -> ImplicitRecommender:
+    seed_records, _ = records
+    product_id_map = ProductIdMap(pd.read_csv(config.products_file)['product_id'].values)
+    model = implicit.nearest_neighbours.CosineRecommender(K=IMPLICIT_K)
+    model.fit(create_sparse_purchases_matrix(seed_records, product_id_map).T)
+    recommender = ImplicitRecommender(model, product_id_map)
+    pickle_dump(config.implicit.model_file, recommender)
+    return recommender
+
+
+def train_vectors(config: TrainConfig, records: tuple) -> ItemVectors:
+    seed_records, _ = records
+    product_id_map = ProductIdMap(pd.read_csv(config.products_file)['product_id'].values)
+    item_vectors = train_implicit_vectors(seed_records, config.implicit, product_id_map)
+    pickle_dump(config.implicit.vectors_file, item_vectors)
+    logger.info(f'trained vectors for {len(item_vectors)} items')
+    return item_vectors
+
+
+def calc_product_store_stats(config: TrainConfig, records: tuple) -> ProductStoreStats:
+    seed_records, _ = records
+    product_store_stats = create_product_store_stats(seed_records)
+    save_artifacts(config.product_store_stats_file, product_store_stats.to_arrays())
+    return product_store_stats
+
+
+def calc_product_features(config: TrainConfig, records: tuple) -> ProductTable:
+    seed_records, _ = records
+    product_features = create_product_features_from_users_data(seed_records, config.n_jobs)
+    products = pd.read_csv(config.products_file)
+    products_enriched = pd.merge(products, product_features, how='left')
+    products_enriched.to_csv(config.products_enriched_file, index=False)
+    logger.info(f'created enriched product features, shape: {products_enriched.shape}')
+    return ProductTable.from_csv(config.products_enriched_file)
+
+
+def load_features_and_target(features_dir: str, gt_items_count_fp: str) -> tuple:
+    features_df = load_features(features_dir, TRAIN_COLUMNS)
+    logger.info(f'read features and target from {features_dir}, shape: {features_df.shape}')
+    return features_df, pd.read_csv(gt_items_count_fp)
+
+
+def calc_features(
+        config: TrainConfig,
+        features_dir: str,
+        gt_items_count_fp: str,
+        records: tuple,
+        recommender: ImplicitRecommender,
+        item_vectors: ItemVectors,
+        product_store_stats: ProductStoreStats,
+) -> tuple:
+    seed_records, target_records = records
+    # features and server use the exported neighbor table, not the implicit model
+    item_neighbors = ItemNeighbors.from_implicit(recommender)
+    manifest = write_features_and_target(
+        features_dir,
+        gt_items_count_fp,
+        seed_records,
+        target_records,
+        item_vectors,
+        item_neighbors,
+        product_store_stats,
+        config.n_jobs,
+    )
+    logger.info(f'created features and target in {features_dir}, rows: {manifest["rows"]}')
+    return load_features_and_target(features_dir, gt_items_count_fp)
+
+
+def train_model(config: TrainConfig, train_features: tuple, test_features: tuple, product_table: ProductTable) -> str:
+    train_features_df, train_gt_items_count = train_features
+    test_features_df, test_gt_items_count = test_features
+    clients_df = pd.read_csv(CLIENTS_FILE)
+    train(
+        config,
+        train_features_df.merge(clients_df, how='left'),
+        test_features_df.merge(clients_df, how='left'),
+        product_table,
+        train_gt_items_count,
+        test_gt_items_count,
+    )
+    return config.catboost.model_file
+
+
+def export_artifacts(
+        config: TrainConfig,
+        recommender: ImplicitRecommender,
+        item_vectors: ItemVectors,
+        product_store_stats: ProductStoreStats,
+        product_table: ProductTable,
+        model_file: str,
+) -> dict:
+    if not np.array_equal(item_vectors.product_id_map.product_ids, product_table.product_ids):
+        raise ValueError('item vectors and product table have different product ids')
+    arrays = product_table.to_arrays()
+    arrays.update(item_vectors.to_arrays())
+    arrays.update(ItemNeighbors.from_implicit(recommender).to_arrays())
+    arrays.update(product_store_stats.to_arrays())
+    # a new version directory + switch of the artifacts_dir symlink, the served version is never overwritten
+    manifest = save_artifacts(config.artifacts_dir, arrays, files={'catboost_model': model_file})
+    logger.info(f'saved artifacts to {config.artifacts_dir}, version: {manifest["content_hash"]}')
+    return manifest
+
+
+def load_manifest(artifacts_dir: str) -> dict:
+    with open(os.path.join(artifacts_dir, MANIFEST_FILE), 'r') as f:
+        return json.load(f)
+
+
+def create_steps(config: TrainConfig) -> list:
+    """
+    DAG of the pipeline, `code` are the sources results of a step depend on (besides its inputs)
+    """
+    records_code = ['lib/train_utils.py', 'lib/transaction_store.py']
+    implicit_params = {'epochs': config.implicit.epochs, 'num_factors': config.implicit.num_factors}
+    steps = [
+        Step(
+            'train_records',
+            run=lambda: read_records(config, config.train_start, config.train_end),
+            params={'start': config.train_start, 'end': config.train_end},
+            code=records_code,
+            files=records_files(config),
+        ),
+        Step(
+            'test_records',
+            run=lambda: read_records(config, config.test_start, config.test_end),
+            params={'start': config.test_start, 'end': config.test_end},
+            code=records_code,
+            files=records_files(config),
+        ),
+        Step(
+            'implicit_model',
+            run=lambda records: train_implicit_model(config, records),
+            load=lambda: pickle_load(config.implicit.model_file),
+            inputs=['train_records'],
+            outputs=[config.implicit.model_file],
+            params={'K': IMPLICIT_K},
+            code=['lib/i2i_model.py'],
+            files=[config.products_file],
+        ),
+        Step(
+            'vectors',
+            run=lambda records: train_vectors(config, records),
+            load=lambda: pickle_load(config.implicit.vectors_file),
+            inputs=['train_records'],
+            outputs=[config.implicit.vectors_file],
+            params=implicit_params,
+            code=['lib/i2i_model.py'],
+            files=[config.products_file],
+        ),
+        Step(
+            'product_store_stats',
+            run=lambda records: calc_product_store_stats(config, records),
+            load=lambda: ProductStoreStats.from_arrays(load_artifacts(config.product_store_stats_file).arrays),
+            inputs=['train_records'],
+            outputs=[config.product_store_stats_file],
+            code=['lib/product_store_features.py'],
+        ),
+        Step(
+            'product_features',
+            run=lambda records: calc_product_features(config, records),
+            load=lambda: ProductTable.from_csv(config.products_enriched_file),
+            inputs=['train_records'],
+            outputs=[config.products_enriched_file],
+            code=['lib/preprocessing.py', 'lib/product_aggregates.py'],
+            files=[config.products_file],
+        ),
+    ]
+    for part, features_dir, gt_items_count_fp in (
+            ('train', config.train_features_file, config.train_gt_items_count_file),
+            ('test', config.test_features_file, config.test_gt_items_count_file),
+    ):
+        steps.append(Step(
+            f'{part}_features',
+            run=partial(calc_features, config, features_dir, gt_items_count_fp),
+            load=partial(load_features_and_target, features_dir, gt_items_count_fp),
+            inputs=[f'{part}_records', 'implicit_model', 'vectors', 'product_store_stats'],
+            outputs=[features_dir, gt_items_count_fp],
+            params={'shard_size': SHARD_SIZE},
+            code=FEATURES_CODE,
+        ))
+    steps.extend([
+        Step(
+            'train_model',
+            run=lambda train_features, test_features, product_table: train_model(
+                config, train_features, test_features, product_table),
+            load=lambda: config.catboost.model_file,
+            inputs=['train_features', 'test_features', 'product_features'],
+            outputs=[config.catboost.model_file],
+            params=config.catboost.train_params,
+            code=['train.py', 'lib/recommender.py', 'lib/product_table.py'],
+            files=[CLIENTS_FILE],
+        ),
+        Step(
+            'export_artifacts',
+            run=lambda recommender, item_vectors, product_store_stats, product_table, model_file: export_artifacts(
+                config, recommender, item_vectors, product_store_stats, product_table, model_file),
+            load=lambda: load_manifest(config.artifacts_dir),
+            inputs=['implicit_model', 'vectors', 'product_store_stats', 'product_features', 'train_model'],
+            outputs=[config.artifacts_dir],
+            code=['lib/artifacts.py', 'lib/product_table.py', 'lib/i2i_model.py', 'lib/product_store_features.py'],
+        ),
+    ])
+    return steps
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config_path')
-    parser.add_argument('--train_implicit_model', action='store_true')
-    parser.add_argument('--train_vectors', action='store_true')
-    parser.add_argument('--calc_product_store_stats', action='store_true')
-    parser.add_argument('--calc_product_features', action='store_true')
-    parser.add_argument('--create_train_features', action='store_true')
-    parser.add_argument('--create_test_features', action='store_true')
-    parser.add_argument('--train_model', action='store_true')
-    parser.add_argument('--skip_data_read', action='store_true')
+    parser.add_argument('--targets', nargs='+', default=['train_model'], help='steps to bring up to date')
+    parser.add_argument('--force', nargs='+', default=[], help='steps to rerun even if cached, or all')
+    parser.add_argument('--jobs', type=int, default=1, help='independent steps to run at the same time')
+    parser.add_argument('--plan', action='store_true', help='only log which steps would run')
     args = parser.parse_args()
 
     config = TrainConfig.from_json(args.config_path)
 
     logger.info(f'config: {args.config_path}')
-
-    if not args.skip_data_read:
-        train_seed_records, train_target_recrods = read_clients_purchases(
-            config.client_purchases_file,
-            config.train_start,
-            config.train_end
-        )
-        logger.info(f'train: {config.train_start} - {config.train_end}')
-
-        test_seed_records, test_target_records = read_clients_purchases(
-            config.client_purchases_file,
-            config.test_start,
-            config.test_end
-        )
-        logger.info(f'test: {config.test_start} - {config.test_end}')
-
-    products = pd.read_csv(config.products_file)
-    product_id_map = ProductIdMap(products['product_id'].values)
-
-    if args.train_implicit_model:
-        logger.info('training implicit model...')
-        model = implicit.nearest_neighbours.CosineRecommender(K=10)
-        matrix = create_sparse_purchases_matrix(train_seed_records, product_id_map)
-        model.fit(matrix.T)
-        recommender = ImplicitRecommender(model, product_id_map)
-        pickle_dump(config.implicit.model_file, recommender)
-        logger.info(f'saved model to {config.implicit.model_file}')
-    else:
-        logger.info(f'loading implicit model from file')
-        recommender = pickle_load(config.implicit.model_file)
-
-    if args.train_vectors:
-        logger.info(f'training vectors...')
-        item_vectors = train_implicit_vectors(train_seed_records, config.implicit, product_id_map)
-        pickle_dump(config.implicit.vectors_file, item_vectors)
-        logger.info(f'trained vectors for {len(item_vectors)} items')
-    else:
-        logger.info(f'loading vectors from file')
-        item_vectors = pickle_load(config.implicit.vectors_file)
-
-    if args.calc_product_store_stats:
-        logger.info(f'calculating product/store stats...')
-        product_store_stats = create_product_store_stats(train_seed_records)
-        pickle_dump(config.product_store_stats_file, product_store_stats)
-        logger.info(f'calculated and saved product store stats')
-    else:
-        logger.info(f'loading product/store stats from file')
-        product_store_stats = pickle_load(config.product_store_stats_file)
-
-    if args.calc_product_features:
-        logger.info(f'calculating product features stats...')
-        product_features = create_product_features_from_users_data(train_seed_records)
-        products = pd.read_csv(config.products_file)
-        products_enriched = pd.merge(products, product_features, how='left')
-        products_enriched.to_csv(config.products_enriched_file, index=False)
-        logger.info(f'created enriched product features, shape: {products_enriched.shape}')
-    else:
-        logger.info(f'reading product stats from file...')
-        products_enriched = pd.read_csv(config.products_enriched_file)
-
-    if args.create_train_features:
-        logger.info(f'creating train features...')
-        train_features_df, train_gt_items_count = create_features(
-            train_seed_records,
-            train_target_recrods,
-            item_vectors,
-            recommender,
-            product_store_stats,
-        )
-        train_features_df.to_csv(config.train_features_file, index=False)
-        train_gt_items_count.to_csv(config.train_gt_items_count_file, index=False)
-        logger.info(f'created train features and target, shape: {train_features_df.shape}')
-    else:
-        logger.info(f'reading train features from file...')
-        train_features_df = pd.read_csv(config.train_features_file)
-        train_gt_items_count = pd.read_csv(config.train_gt_items_count_file)
-        logger.info(f'read train features and target, shape: {train_features_df.shape}')
-
-    if args.create_test_features:
-        logger.info(f'creating test features...')
-        test_features_df, test_gt_items_count = create_features(
-            test_seed_records,
-            test_target_records,
-            item_vectors,
-            recommender,
-            product_store_stats,
-        )
-        test_features_df.to_csv(config.test_features_file, index=False)
-        test_gt_items_count.to_csv(config.test_gt_items_count_file, index=False)
-        logger.info(f'created test features and target, shape: {test_features_df.shape}')
+    runner = StepRunner(
+        create_steps(config),
+        os.path.join(config.data_dir, STEPS_DIR),
+        force=args.force,
+        n_jobs=args.jobs,
+        logger=logger,
+    )
+    if args.plan:
+        logger.info(f'steps to run: {runner.plan(args.targets)}')
     else:
-        logger.info(f'reading test features from file...')
-        test_features_df = pd.read_csv(config.test_features_file)
-        test_gt_items_count = pd.read_csv(config.test_gt_items_count_file)
-        logger.info(f'read test features and target, shape: {test_features_df.shape}')
-
-    clients_df = pd.read_csv('./data/clients.csv')
-    test_features_df = test_features_df.merge(clients_df, how='left')
-    train_features_df = train_features_df.merge(clients_df, how='left')
-
-    if args.train_model:
-        logger.info(f'training model...')
-        train(
-            config,
-            train_features_df,
-            test_features_df,
-            products_enriched,
-            train_gt_items_count,
-            test_gt_items_count,
-        )
-
-
+        runner.run(args.targets)
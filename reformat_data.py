@@ -1,143 +1,190 @@
+"""
+purchases.csv -> tsv with one client per line: json with train history \t json with test history
+
+    python reformat_data.py --seed 42 --n_jobs 8
+
+the file is cut into chunks of ~chunk_size_mb at client boundaries, chunks are parsed by a process pool
+(pandas + vectorized grouping) and written in file order. the train/test split is the same as it always was:
+ - first row of a client always goes to train, other rows before split_date to train, the rest to test
+ - rows of a transaction are consecutive, transactions are cut where transaction_id changes
+ - a random number of test transactions (but not the last one) is moved to train, draws are made
+   in client order in the main process, so output depends only on the seed
+ - clients without test transactions are skipped, the last client of the file is dropped
+with --store_dir the written tsv is also converted to a columnar TransactionStore (lib/transaction_store.py)
+"""
+import argparse
+import io
 import json
+import multiprocessing
+import os
 import random
 from pathlib import Path
-from typing import List
 
-import attr
+import numpy as np
+import pandas as pd
 import tqdm as tqdm
 
+from lib.i2i_model import ProductIdMap
+from lib.transaction_store import build_transaction_store
 
-@attr.s(slots=True)
-class PurchaseRow:
-    client_id = attr.ib()
-    transaction_id = attr.ib()
-    transaction_datetime = attr.ib()
-    regular_points_received = attr.ib(converter=float)
-    express_points_received = attr.ib(converter=float)
-    regular_points_spent = attr.ib(converter=float)
-    express_points_spent = attr.ib(converter=float)
-    purchase_sum = attr.ib(converter=float)
-    store_id = attr.ib()
-    product_id = attr.ib()
-    product_quantity = attr.ib(converter=float)
-    trn_sum_from_iss = attr.ib(converter=float)
-    trn_sum_from_red = attr.ib()
-
-
-def parse_purchases(purchases_fp: Path, out_fp: Path, split_date: str):
-    clients_total = 0
-    clients_test = 0
-    with open(out_fp, 'w') as fout:
-        with open(purchases_fp, 'r') as fin:
-            fin.readline()
-            first_row = PurchaseRow(*fin.readline().strip().split(','))
-            current_client_id = first_row.client_id
-            client_purchases_train = [first_row]
-            client_purchases_test = []
-            for line in tqdm.tqdm(fin):
-                row = PurchaseRow(*line.strip().split(','))
-                if current_client_id != row.client_id:
-                    train_transactions = purchases_to_transactions(client_purchases_train)
-                    test_transactions = purchases_to_transactions(client_purchases_test)
-                    if len(test_transactions) > 1:
-                        split_point = random.randint(0, len(test_transactions) - 2)
-                        train_transactions += test_transactions[:split_point]
-                        test_transactions = test_transactions[split_point:]
-                    train = json.dumps({'client_id': current_client_id, 'transaction_history': train_transactions})
-                    clients_total += 1
-                    if test_transactions:
-                        # skip records w/o actions in test period
-                        test = json.dumps({'client_id': current_client_id, 'transaction_history': test_transactions})
-                        fout.write(f'{train}\t{test}\n')
-                        clients_test += 1
-                    client_purchases_train = [row]
-                    client_purchases_test = []
-                    current_client_id = row.client_id
-                else:
-                    if row.transaction_datetime < split_date:
-                        client_purchases_train.append(row)
-                    else:
-                        client_purchases_test.append(row)
+STR_COLUMNS = ['client_id', 'transaction_id', 'transaction_datetime', 'store_id', 'product_id']
+FLOAT_COLUMNS = ['purchase_sum', 'product_quantity', 'trn_sum_from_iss']
 
-    print(f'total: {clients_total}, test: {clients_test}')
 
+def client_aligned_chunks(purchases_fp: Path, chunk_size: int) -> tuple:
+    """
+    header columns and (start, end) byte ranges of ~chunk_size, every range starts with the first row of a client
+    """
+    file_size = os.path.getsize(purchases_fp)
+    with open(purchases_fp, 'rb') as f:
+        columns = f.readline().decode().strip().split(',')
+        bounds = [f.tell()]
+        while bounds[-1] + chunk_size < file_size:
+            f.seek(bounds[-1] + chunk_size)
+            f.readline()
+            line_start = f.tell()
+            line = f.readline()
+            client_id = line.split(b',', 1)[0]
+            while line and line.split(b',', 1)[0] == client_id:
+                line_start = f.tell()
+                line = f.readline()
+            if not line:
+                break
+            bounds.append(line_start)
 
-def purchases_to_transactions(client_purchases: List[PurchaseRow]) -> dict:
-    if not client_purchases:
-        return []
-    transactions = []
-    row = client_purchases[0]
-    current_transaction = {
-        'datetime': row.transaction_datetime,
-        'purchase_sum': row.purchase_sum,
-        'store_id': row.store_id,
-        'products': [{
-            'product_id': row.product_id,
-            'price': row.trn_sum_from_iss,
-            'quantity': row.product_quantity,
-        }]
-    }
-    current_transaction_id = row.transaction_id
-    for row in client_purchases[1:]:
-        if row.transaction_id != current_transaction_id:
-            transactions.append(current_transaction)
-            current_transaction = {
-                'datetime': row.transaction_datetime,
-                'purchase_sum': row.purchase_sum,
-                'store_id': row.store_id,
-                'products': [{
-                    'product_id': row.product_id,
-                    'price': row.trn_sum_from_iss,
-                    'quantity': row.product_quantity,
-                }]
-            }
-            current_transaction_id = row.transaction_id
-        else:
-            current_transaction['products'].append({
-                'product_id': row.product_id,
-                'price': row.trn_sum_from_iss,
-                'quantity': row.product_quantity,
-            })
-
-    transactions.append(current_transaction)
-
-    return transactions
-
-
-def process_client_purchases(client_purchases: List[PurchaseRow]) -> dict:
-    first_row = client_purchases[0]
-    client_record = {
-        'client_id': first_row.client_id
-    }
-    transactions = []
-    current_transaction = {}
-    current_transaction_id = -1
-    for row in client_purchases:
-        if row.transaction_id != current_transaction_id:
-            current_transaction = {
-                'datetime': row.transaction_datetime,
-                'purchase_sum': row.purchase_sum,
-                'store_id': row.store_id,
-                'products': [{
-                    'product_id': row.product_id,
-                    'price': row.trn_sum_from_iss,
-                    'quantity': row.product_quantity,
-                }]
+    bounds.append(file_size)
+    return columns, list(zip(bounds[:-1], bounds[1:]))
+
+
+def convert_chunk(task: tuple) -> list:
+    """
+    [(client_id, train transactions, test transactions), ...] in file order, transactions as json strings
+    """
+    purchases_fp, start, end, columns, split_date = task
+    with open(purchases_fp, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    df = pd.read_csv(
+        io.BytesIO(data),
+        header=None,
+        names=columns,
+        usecols=STR_COLUMNS + FLOAT_COLUMNS,
+        dtype={**{name: str for name in STR_COLUMNS}, **{name: np.float64 for name in FLOAT_COLUMNS}},
+        # string fields are written as is ('' and 'NA' included), as the row-by-row parser did
+        keep_default_na=False,
+        na_values={name: ['', 'nan', 'NaN'] for name in FLOAT_COLUMNS},
+        float_precision='round_trip',
+    )
+
+    client_ids = df['client_id'].values
+    new_client = np.ones(len(df), dtype=bool)
+    new_client[1:] = client_ids[1:] != client_ids[:-1]
+    client_index = np.cumsum(new_client) - 1
+    is_train = new_client | (df['transaction_datetime'].values < split_date)
+    transaction_ids = df['transaction_id'].values
+
+    datetimes = df['transaction_datetime'].tolist()
+    purchase_sums = df['purchase_sum'].tolist()
+    store_ids = df['store_id'].tolist()
+    product_ids = df['product_id'].tolist()
+    prices = df['trn_sum_from_iss'].tolist()
+    quantities = df['product_quantity'].tolist()
+
+    clients = [(client_id, [], []) for client_id in client_ids[new_client].tolist()]
+    for part, part_mask in ((1, is_train), (2, ~is_train)):
+        rows = np.flatnonzero(part_mask)
+        # new transaction where transaction_id or client changes between consecutive rows of the part
+        new_transaction = np.ones(len(rows), dtype=bool)
+        new_transaction[1:] = (
+            (transaction_ids[rows[1:]] != transaction_ids[rows[:-1]])
+            | (client_index[rows[1:]] != client_index[rows[:-1]])
+        )
+        starts = np.flatnonzero(new_transaction)
+        ends = np.append(starts[1:], len(rows))
+        rows, row_clients = rows.tolist(), client_index[rows].tolist()
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            first = rows[start]
+            transaction = {
+                'datetime': datetimes[first],
+                'purchase_sum': purchase_sums[first],
+                'store_id': store_ids[first],
+                'products': [
+                    {
+                        'product_id': product_ids[row],
+                        'price': prices[row],
+                        'quantity': quantities[row],
+                    }
+                    for row in rows[start:end]
+                ],
             }
-            if current_transaction_id != -1:
-                transactions.append(current_transaction)
-            current_transaction_id = row.transaction_id
-        else:
-            current_transaction['products'].append({
-                'product_id': row.product_id,
-                'price': row.trn_sum_from_iss,
-                'quantity': row.product_quantity,
-            })
+            clients[row_clients[start]][part].append(json.dumps(transaction))
 
-    client_record['transaction_history'] = transactions
-    return client_record
+    return clients
+
+
+def client_record_json(client_id: str, transactions: list) -> str:
+    # same as json.dumps({'client_id': ..., 'transaction_history': [...]}) of parsed transactions
+    return f'{{"client_id": {json.dumps(client_id)}, "transaction_history": [{", ".join(transactions)}]}}'
+
+
+def parse_purchases(
+        purchases_fp: Path,
+        out_fp: Path,
+        split_date: str,
+        seed: int = None,
+        n_jobs: int = 1,
+        chunk_size: int = 32 * 2 ** 20,
+):
+    rng = random.Random(seed)
+    columns, chunks = client_aligned_chunks(purchases_fp, chunk_size)
+    tasks = [(purchases_fp, start, end, columns, split_date) for start, end in chunks]
+
+    clients_total = 0
+    clients_test = 0
+    pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        converted = pool.imap(convert_chunk, tasks) if pool is not None else map(convert_chunk, tasks)
+        with open(out_fp, 'w') as fout:
+            previous = None
+            for clients in tqdm.tqdm(converted, total=len(tasks)):
+                for client in clients:
+                    # a client is written when the next one starts, so the last one is never written
+                    if previous is not None:
+                        client_id, train_transactions, test_transactions = previous
+                        if len(test_transactions) > 1:
+                            split_point = rng.randint(0, len(test_transactions) - 2)
+                            train_transactions = train_transactions + test_transactions[:split_point]
+                            test_transactions = test_transactions[split_point:]
+                        clients_total += 1
+                        if test_transactions:
+                            # skip records w/o actions in test period
+                            train = client_record_json(client_id, train_transactions)
+                            test = client_record_json(client_id, test_transactions)
+                            fout.write(f'{train}\t{test}\n')
+                            clients_test += 1
+                    previous = client
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print(f'total: {clients_total}, test: {clients_test}')
 
 
 if __name__ == '__main__':
-    split_date = '2019-03-02 00:00:00'
-    parse_purchases('./data/purchases.csv', './data_small/clients_purchases.tsv', split_date)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--purchases', default='./data/purchases.csv')
+    parser.add_argument('--out', default='./data_small/clients_purchases.tsv')
+    parser.add_argument('--split_date', default='2019-03-02 00:00:00')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--n_jobs', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk_size_mb', type=int, default=32)
+    parser.add_argument('--store_dir', default=None, help='also write columnar transaction store here')
+    parser.add_argument('--products', default='./data/products.csv', help='product vocabulary of the store')
+    args = parser.parse_args()
+
+    parse_purchases(args.purchases, args.out, args.split_date, args.seed, args.n_jobs, args.chunk_size_mb * 2 ** 20)
+    if args.store_dir:
+        product_id_map = ProductIdMap(pd.read_csv(args.products)['product_id'].values)
+        build_transaction_store(args.out, product_id_map, args.store_dir, args.n_jobs, args.chunk_size_mb * 2 ** 20)
+        print(f'transaction store: {args.store_dir}')
@@ -3,6 +3,7 @@ import time
 
 import requests
 
+from lib.metrics import normalized_average_precision
 from lib.utils import deduplicate
 from numpy import quantile
 
@@ -20,26 +21,6 @@ class Timer:
         self.timings.append(int((time.time() - self.start) * 1000))
 
 
-def average_precision(actual, recommended, k=30):
-    ap_sum = 0
-    hits = 0
-    for i in range(k):
-        product_id = recommended[i] if i < len(recommended) else None
-        if product_id in actual:
-            hits += 1
-            ap_sum += hits / (i + 1)
-    return ap_sum / min(len(actual), k)
-
-
-def normalized_average_precision(actual, recommended, k=30):
-    actual = set(actual)
-    if len(actual) == 0:
-        return 0.0
-
-    ap = average_precision(actual, recommended, k=k)
-    return ap
-
-
 def run_queries(url, queryset_file):
     ap_values = []
     timings = []
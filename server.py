@@ -1,45 +1,51 @@
 import os
-import pickle
+import threading
+import time
 
-import catboost
 import flask as fl
 from flask import Flask, jsonify
 
+from lib.artifacts import load_artifacts
+from lib.cache import CachedRecommender, LRUCache
+from lib.client_state import ClientStateStore
 from lib.config import TrainConfig
 from lib.hardcode import TOP_ITEMS
 from lib.logger import configure_logger
-from lib.product_store_features import ProductStoreStats
-from lib.recommender import CatBoostRecommenderWithPopularFallback, cols
-from lib.utils import read_products_file, pickle_load
+from lib.recommender import load_recommender
 
 logger = configure_logger(logger_name='server', log_dir='')
 
 
 logger.info('starting to load all stuff')
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
-config = TrainConfig.from_json('configs/config.json')
+config = TrainConfig.from_json(os.environ.get('CONFIG_PATH', 'configs/config.json'))
+
+# artifacts_dir is a symlink to the current version (lib/artifacts.py save_artifacts), export never writes
+# into the version being served. every gunicorn worker checks where it points at most once in
+# RELOAD_CHECK_SECONDS and reloads if the target changed, so a new export (or POST /reload to any worker)
+# reaches all of them. 0 - only POST /reload, in the process that handles it
+RELOAD_CHECK_SECONDS = float(os.environ.get('RELOAD_CHECK_SECONDS', 5))
 
 app = Flask(__name__)
-app.products_data = read_products_file(config.products_enriched_file)
-
-app.model = catboost.CatBoost()
-app.model.load_model(config.catboost.model_file)
-app.item_vectors = pickle_load(config.implicit.vectors_file)
-with open(config.implicit.model_file, 'rb') as f:
-    app.implicit_model = pickle.load(f)
-
-app.product_store_stats = ProductStoreStats()
-
-app.recommender = CatBoostRecommenderWithPopularFallback(
-    model=app.model,
-    implicit_model=app.implicit_model,
-    item_vectors=app.item_vectors,
-    products_data=app.products_data,
-    product_store_stats=app.product_store_stats,
-    feature_names=cols,
+app.reload_lock = threading.Lock()
+app.next_reload_check = time.monotonic() + RELOAD_CHECK_SECONDS
+app.artifacts = load_artifacts(config.artifacts_dir)
+app.artifacts_target = app.artifacts.artifact_dir
+# result cache is off by default, CACHE_SIZE_MB=64 turns it on
+app.cache = LRUCache(
+    max_bytes=int(float(os.environ.get('CACHE_SIZE_MB', 0)) * 2 ** 20),
+    ttl=float(os.environ.get('CACHE_TTL', 300)),
+)
+# CLIENT_STATES: number of clients with incrementally updated history aggregates, 0 - recompute every time
+client_states = int(os.environ.get('CLIENT_STATES', 0))
+app.client_state_store = ClientStateStore(client_states) if client_states else None
+app.recommender = CachedRecommender(
+    load_recommender(app.artifacts, app.client_state_store),
+    app.artifacts.version,
+    app.cache,
 )
 
-logger.info('ready!')
+logger.info(f'ready! artifacts version: {app.artifacts.version}')
 
 
 @app.route("/ready")
@@ -47,17 +53,77 @@ def ready():
     return "OK"
 
 
+def reload_artifacts():
+    """
+    reloads artifacts in this process, cached results of the previous version are dropped
+    """
+    with app.reload_lock:
+        artifacts = load_artifacts(config.artifacts_dir)
+        app.artifacts_target = artifacts.artifact_dir
+        if artifacts.version != app.artifacts.version:
+            # client states don't depend on models and are kept
+            app.recommender.reload(load_recommender(artifacts, app.client_state_store), artifacts.version)
+            app.artifacts = artifacts
+            logger.info(f'reloaded artifacts version: {artifacts.version}')
+
+
+@app.before_request
+def check_artifacts():
+    if not RELOAD_CHECK_SECONDS or time.monotonic() < app.next_reload_check:
+        return
+    app.next_reload_check = time.monotonic() + RELOAD_CHECK_SECONDS
+    if os.path.realpath(config.artifacts_dir) != app.artifacts_target:
+        try:
+            reload_artifacts()
+        except Exception:
+            # e.g. the version was removed by the next export, the next check retries
+            logger.exception('reload failed')
+
+
+@app.route("/reload", methods=["POST"])
+def reload():
+    """
+    reloads artifacts in the worker that handles it, the other workers follow on their next symlink check
+    """
+    reload_artifacts()
+    return jsonify({"version": app.artifacts.version})
+
+
+@app.route("/cache_stats")
+def cache_stats():
+    return jsonify(app.cache.stats())
+
+
 @app.route("/recommend", methods=["POST"])
 def recommend():
     try:
         recs = app.recommender.recommend(fl.request.json)
-    except Exception as e:
-        print(e)
+    except Exception:
+        logger.exception('query failed')
         recs = TOP_ITEMS
 
     return jsonify({"recommended_products": recs})
 
 
+@app.route("/recommend_batch", methods=["POST"])
+def recommend_batch():
+    queries = fl.request.json
+    try:
+        recs = app.recommender.recommend_batch(queries)
+    except Exception:
+        # one broken query should not take down the whole batch, the batch is retried query by query
+        logger.exception('batch failed, recommending one by one')
+        recs = []
+        for query in queries:
+            try:
+                recs.append(app.recommender.recommend(query))
+            except Exception:
+                logger.exception('query failed')
+                recs.append(TOP_ITEMS)
+
+    return jsonify({"recommended_products": recs})
+
+
 if __name__ == "__main__":
     # Only for debugging while developing
     app.run(host="0.0.0.0", debug=True, port=8000)
@@ -0,0 +1,84 @@
+"""
+features with ClientStateStore (incremental history aggregates) against features recomputed from scratch,
+for repeated, extended and edited histories of the same clients
+"""
+import json
+import os
+import random
+
+import numpy as np
+import pytest
+
+from lib.client_state import ClientStateStore
+from lib.i2i_model import ItemVectors, ProductIdMap
+from lib.preprocessing import create_client_features
+from lib.product_store_features import create_product_store_stats
+from lib.transaction_store import TransactionStore
+
+CHECK_QUERIES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'check_queries.tsv')
+
+
+def check_queries() -> list:
+    with open(CHECK_QUERIES, 'r') as f:
+        records = [json.loads(line.split('\t')[0]) for line in f]
+    return [record for record in records if any(tr['products'] for tr in record['transaction_history'])]
+
+
+def edited(records: list, product_ids: list, seed: int = 0) -> list:
+    """
+    same transaction headers (datetime, store, sum, number of lines), other products and quantities
+    """
+    rng = random.Random(seed)
+    records = json.loads(json.dumps(records))
+    for record in records:
+        for tr in record['transaction_history']:
+            for product in tr['products']:
+                product['product_id'] = rng.choice(product_ids)
+                product['quantity'] = rng.choice([1, 2, 0.5])
+    return records
+
+
+def truncated(records: list) -> list:
+    # the earlier half of every history, the full one extends it
+    records = json.loads(json.dumps(records))
+    for record in records:
+        transactions = sorted(record['transaction_history'], key=lambda tr: tr['datetime'])
+        record['transaction_history'] = transactions[:max(len(transactions) // 2, 1)]
+    return records
+
+
+@pytest.mark.parametrize('history', ['same', 'extended', 'edited'])
+def test_client_state_store_matches_full_recomputation(history):
+    records = check_queries()
+    product_ids = sorted({
+        product['product_id']
+        for record in records
+        for tr in record['transaction_history']
+        for product in tr['products']
+    })
+    product_id_map = ProductIdMap(product_ids)
+    rng = np.random.RandomState(0)
+    item_vectors = ItemVectors.from_dict(
+        {product_id: rng.normal(size=8).astype(np.float32).tolist() for product_id in product_ids},
+        product_id_map,
+    )
+    product_store_stats = create_product_store_stats(records)
+
+    first, second = {
+        'same': (records, records),
+        'extended': (truncated(records), records),
+        'edited': (records, edited(records, product_ids)),
+    }[history]
+    client_state_store = ClientStateStore()
+    for client in TransactionStore.from_records(first, product_id_map):
+        create_client_features(client, item_vectors, None, product_store_stats, client_state_store)
+
+    for client in TransactionStore.from_records(second, product_id_map):
+        expected = create_client_features(client, item_vectors, None, product_store_stats)
+        actual = create_client_features(client, item_vectors, None, product_store_stats, client_state_store)
+        assert set(actual) == set(expected)
+        for name, values in expected.items():
+            assert np.array_equal(np.asarray(actual[name]), np.asarray(values)), name
+
+    hits = client_state_store.stats()['hits']
+    assert hits == (0 if history == 'edited' else len(records))
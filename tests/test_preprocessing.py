@@ -0,0 +1,168 @@
+"""
+vectorized create_client_features against the per-row implementation it replaced (append_user_features
+of lib/preprocessing.py before the vectorization, copied below), on check queries and on shuffled histories
+with fractional quantities
+"""
+import json
+import os
+import random
+from collections import Counter
+from datetime import datetime
+from itertools import chain, groupby
+from operator import itemgetter
+
+import numpy as np
+import pytest
+
+from lib.hardcode import test_start
+from lib.i2i_model import ItemVectors, ProductIdMap
+from lib.preprocessing import create_client_features
+from lib.product_store_features import create_product_store_stats
+from lib.transaction_store import TransactionStore
+
+CHECK_QUERIES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'check_queries.tsv')
+# item vectors are float32, the old code summed them as python floats
+DOT_TOLERANCE = 1e-5
+
+
+def reference_features(user_data: dict, product_vectors: dict, recs: dict, product_store_stats) -> dict:
+    features = {}
+
+    def append(name, value):
+        features.setdefault(name, []).append(value)
+
+    trs = sorted(user_data['transaction_history'], key=lambda x: x['datetime'])
+    store_ids = [tr['store_id'] for tr in user_data['transaction_history']]
+    favorite_store, last_store = Counter(store_ids).most_common(1)[0][0], store_ids[-1]
+    products = [dict(product) for product in chain(*(x['products'] for x in trs))]
+    product_ids = [product['product_id'] for product in products]
+
+    vectors = [np.array(product_vectors[product_id]) for product_id in product_ids if product_id in product_vectors]
+    client_vector = sum(vectors[1:], vectors[0].copy()) / len(vectors) if vectors else None
+
+    def dot(product_id):
+        if client_vector is None or product_id not in product_vectors:
+            return 0
+        return np.dot(client_vector, product_vectors[product_id])
+
+    transaction_ids = [i + 1 for i, x in enumerate(trs) for _ in range(len(x['products']))]
+    transaction_ages = [
+        (test_start - datetime.fromisoformat(x['datetime'])).days
+        for x in trs
+        for _ in range(len(x['products']))
+    ]
+    for i, tid in enumerate(transaction_ids):
+        products[i]['tid'] = tid
+        products[i]['tr_age'] = transaction_ages[i]
+    total_transactions = len(trs)
+    average_psum = sum([tr['purchase_sum'] for tr in trs]) / total_transactions
+
+    def append_client_features():
+        append('total_pucrhases', total_transactions)
+        append('average_psum', average_psum)
+        append('client_id', user_data['client_id'])
+        append('last_transaction_age', transaction_ages[-1])
+        append('favorite_store_id', favorite_store)
+        append('last_store_id', last_store)
+        append('fav_store_count', product_store_stats.store_cnt(favorite_store))
+        append('last_store_count', product_store_stats.store_cnt(last_store))
+
+    key = itemgetter('product_id')
+    for product, part in groupby(sorted(products, key=key), key=key):
+        part = list(part)
+        append_client_features()
+        append('first_transaction_age', transaction_ages[0])
+        append('product_id', product)
+        append('count', sum([p['quantity'] for p in part]))
+        append('tr_count', len(part))
+        append('p_tr_share', len(part) / max(transaction_ids))
+        append('last_transaction', max([p['tid'] for p in part]) / max(transaction_ids))
+        append('first_transaction', min([p['tid'] for p in part]) / max(transaction_ids))
+        append('last_product_transaction_age', min([p['tr_age'] for p in part]))
+        append('first_product_transaction_age', max([p['tr_age'] for p in part]))
+        # the old dict stats returned None for unknown pairs, fillna(0) made it 0
+        append('fav_product_store_share', product_store_stats.product_store_share(product, favorite_store) or 0)
+        append('last_product_store_share', product_store_stats.product_store_share(product, last_store) or 0)
+        append('fav_store_product_share', product_store_stats.store_product_share(product, favorite_store) or 0)
+        append('last_store_product_share', product_store_stats.store_product_share(product, last_store) or 0)
+        append('client_product_dot', dot(product))
+        append('implicit_score', recs.get(product, 0))
+
+    seen_products = set(product_ids)
+    product_columns = [name for name in features if name not in {
+        'total_pucrhases', 'average_psum', 'client_id', 'last_transaction_age', 'favorite_store_id',
+        'last_store_id', 'fav_store_count', 'last_store_count', 'product_id', 'client_product_dot', 'implicit_score',
+    }]
+    for product_id, score in recs.items():
+        if product_id not in seen_products:
+            append_client_features()
+            append('product_id', product_id)
+            append('implicit_score', score)
+            append('client_product_dot', dot(product_id))
+            for name in product_columns:
+                append(name, 0)
+
+    return features
+
+
+def check_queries() -> list:
+    with open(CHECK_QUERIES, 'r') as f:
+        return [json.loads(line.split('\t')[0]) for line in f]
+
+
+def shuffled(records: list, seed: int = 0) -> list:
+    """
+    transactions out of datetime order, fractional quantities (weighted products)
+    """
+    rng = random.Random(seed)
+    records = json.loads(json.dumps(records))
+    for record in records:
+        rng.shuffle(record['transaction_history'])
+        for tr in record['transaction_history']:
+            for product in tr['products']:
+                if rng.random() < 0.3:
+                    product['quantity'] = round(rng.uniform(0.05, 3), 3)
+    return records
+
+
+@pytest.mark.parametrize('variant', ['check_queries', 'shuffled'])
+def test_create_client_features_matches_per_row_implementation(variant):
+    records = check_queries()
+    if variant == 'shuffled':
+        records = shuffled(records)
+    records = [record for record in records if any(tr['products'] for tr in record['transaction_history'])]
+
+    product_ids = sorted({
+        product['product_id']
+        for record in records
+        for tr in record['transaction_history']
+        for product in tr['products']
+    })
+    product_id_map = ProductIdMap(product_ids)
+    rng = np.random.RandomState(0)
+    # some products have no vector
+    product_vectors = {
+        product_id: rng.normal(size=16).astype(np.float32).tolist()
+        for product_id in product_ids
+        if rng.random_sample() < 0.8
+    }
+    item_vectors = ItemVectors.from_dict(product_vectors, product_id_map)
+    product_store_stats = create_product_store_stats(records)
+    store = TransactionStore.from_records(records, product_id_map)
+
+    for record, client in zip(records, store):
+        # implicit candidates: a few bought products and a few unseen ones
+        candidates = rng.choice(product_ids, size=8, replace=False).tolist()
+        implicit_recs = [(product_id, float(rng.random_sample())) for product_id in candidates]
+
+        expected = reference_features(record, product_vectors, dict(implicit_recs), product_store_stats)
+        actual = create_client_features(client, item_vectors, implicit_recs, product_store_stats)
+
+        assert set(actual) == set(expected)
+        for name, values in expected.items():
+            if name == 'client_product_dot':
+                np.testing.assert_allclose(actual[name], values, rtol=DOT_TOLERANCE, atol=DOT_TOLERANCE, err_msg=name)
+            elif isinstance(values[0], str):
+                assert list(actual[name]) == values, name
+            else:
+                np.testing.assert_allclose(actual[name], np.array(values, dtype=np.float64), rtol=1e-12, err_msg=name)
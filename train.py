@@ -4,6 +4,8 @@ import catboost as cb
 
 from lib.config import TrainConfig
 from lib.logger import configure_logger
+from lib.metrics import METRICS, ranking_metrics
+from lib.product_table import ProductTable
 from lib.recommender import cols, cat_cols
 
 logger = configure_logger(logger_name='train', log_dir='logs')
@@ -13,13 +15,13 @@ def train(
         config: TrainConfig,
         train_features: pd.DataFrame,
         test_features: pd.DataFrame,
-        products_enriched: pd.DataFrame,
+        product_table: ProductTable,
         train_gt_items_count: pd.DataFrame,
         test_gt_items_count: pd.DataFrame,
 ):
 
-    train_features = pd.merge(train_features, products_enriched, how='left')
-    test_features = pd.merge(test_features, products_enriched, how='left')
+    train_features = product_table.join(train_features)
+    test_features = product_table.join(test_features)
 
     columns_diff = set(train_features.columns) - set(cols)
     logger.info(f'columns not used: {columns_diff}')
@@ -54,19 +56,11 @@ def train(
         'test': test_gt_items_count,
     }
     for name, df, pool in (('val', val_df, val_pool), ('test', test_df, test_pool)):
-        gt_items_cnt = gt_cnt_map[name]
+        gt_items_cnt = gt_cnt_map[name].set_index('client_id')['gt_count']
+        # groups are codes of client ids in order of unique()
+        gt_counts = gt_items_cnt.reindex(df['client_id'].unique()).fillna(0).astype(int).values
         df['score'] = model.predict(pool)
         for order in ('score', 'target'):
-            scoring = (
-                df[['client_id', 'product_id', 'score', 'target']]
-                .merge(gt_items_cnt)
-                .sort_values(['client_id', order], ascending=[True, False])
-            )
-
-            scoring['rank'] = scoring.groupby('client_id').cumcount() + 1
-            scoring['cum_target'] = scoring.groupby('client_id')['target'].cumsum()
-            scoring['prec'] = ((scoring['rank'] <= 30) * scoring['target'] * (
-                        scoring['cum_target'] / scoring['rank']) / scoring['gt_count']).fillna(0)
-
-            score = scoring.groupby('client_id').prec.sum().fillna(0).mean()
-            logger.info(f'[{name}] order by {order} : {score}')
+            metrics = ranking_metrics(groups[name], df[order].values, df['target'].values, gt_counts)
+            others = ', '.join(f'{metric}@30: {metrics[metric]:.5f}' for metric in METRICS if metric != 'map')
+            logger.info(f'[{name}] order by {order} : {metrics["map"]} ({others})')
@@ -11,12 +11,10 @@ if __name__ == '__main__':
         'lib',
         'configs',
         'server.py',
+        'gunicorn.conf.py',
         'reformat_data.py',
         'metadata.json',
-        config.implicit.model_file,
-        config.catboost.model_file,
-        config.products_enriched_file,
-        config.implicit.vectors_file,
+        config.artifacts_dir,
     ]
     args_str = ' '.join(args)
 